@@ -0,0 +1,45 @@
+# Small in-process caches. Each gunicorn worker has its own copy, so anything cached here must either be
+# safe to serve stale or carry enough in its key (e.g. a version) to notice when it is out of date.
+import collections
+import threading
+
+
+class LRUCache(object):
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._items:
+                self._items.move_to_end(key)
+                self.hits += 1
+                return self._items[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def discard_where(self, predicate):
+        # Removes every entry for which predicate(key, value) holds; for invalidating by something other
+        # than the whole key
+        with self._lock:
+            for key in [k for k, v in self._items.items() if predicate(k, v)]:
+                del self._items[key]
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
@@ -0,0 +1,199 @@
+# Resolution of amendment chains. Each register_details row that rectifies, renews or (part-)cancels an
+# entry points back at the row it replaces through 'amends', so an entry's history is a linked list running
+# from the original registration to the current (head) entry. These queries walk the list inside Postgres
+# rather than with one query per hop.
+
+
+# register_chain holds, for every register_details row, the chain it belongs to (chain_id: the details id of
+# the original registration) and its distance from the start of the chain (chain_position). It is kept up to
+# date by link_chain whenever 'amends' is written, so reading a chain is an index lookup on chain_id; the
+# walk along the 'amends' links then happens in Python.
+
+# The details of the highest-sequence register row for a registration number and date
+START_BY_REGISTRATION = "SELECT details_id AS id FROM register " \
+                        "WHERE registration_no = %(reg_no)s AND date = %(date)s " \
+                        "ORDER BY reg_sequence_no DESC FETCH FIRST 1 ROW ONLY"
+
+START_BY_DETAILS = "SELECT %(details_id)s::int AS id"
+
+# Every member of the chain containing 'start', with the columns needed for entry summaries
+CHAIN_SQL = "WITH start AS ({start}) " \
+            "SELECT c.details_id, c.details_id = s.id AS is_start, d.amendment_type, d.amends, d.class_of_charge, " \
+            "r.registration_no, r.date, r.reg_sequence_no, r.expired_on " \
+            "FROM start s JOIN register_chain sc ON sc.details_id = s.id " \
+            "JOIN register_chain c ON c.chain_id = sc.chain_id " \
+            "JOIN register_details d ON d.id = c.details_id " \
+            "LEFT JOIN register r ON r.details_id = d.id " \
+            "ORDER BY c.chain_position, c.details_id, r.id"
+
+# Changes whenever the chain gains a member or one of its members is cancelled
+VERSION_SQL = "WITH start AS ({start}) " \
+              "SELECT sc.chain_id, count(*) AS members, max(c.details_id) AS latest, " \
+              "count(d.cancelled_by) AS cancelled " \
+              "FROM start s JOIN register_chain sc ON sc.details_id = s.id " \
+              "JOIN register_chain c ON c.chain_id = sc.chain_id " \
+              "JOIN register_details d ON d.id = c.details_id " \
+              "GROUP BY sc.chain_id"
+
+# The whole chain containing a details id, recomputed from the 'amends' links: up to the start, then down
+# through everything that amends it
+CHAIN_FROM_LINKS_SQL = "WITH RECURSIVE up(id, amends, depth) AS (" \
+                       "  SELECT id, amends, 0 FROM register_details WHERE id = %(details_id)s" \
+                       "  UNION ALL" \
+                       "  SELECT d.id, d.amends, u.depth + 1 FROM register_details d JOIN up u ON d.id = u.amends" \
+                       "  WHERE u.depth < 10000), " \
+                       "origin AS (SELECT id FROM up ORDER BY depth DESC FETCH FIRST 1 ROW ONLY), " \
+                       "down(id, position) AS (" \
+                       "  SELECT id, 0 FROM origin" \
+                       "  UNION ALL" \
+                       "  SELECT d.id, w.position + 1 FROM register_details d JOIN down w ON d.amends = w.id" \
+                       "  WHERE w.position < 10000) " \
+                       "SELECT (SELECT id FROM origin) AS chain_id, id, position FROM down"
+
+# What register_chain should contain, recomputed from the 'amends' links, set against what it does contain
+CHECK_SQL = "WITH RECURSIVE chain(id, chain_id, position) AS (" \
+            "  SELECT d.id, d.id, 0 FROM register_details d " \
+            "  WHERE d.amends IS NULL OR NOT EXISTS (SELECT 1 FROM register_details p WHERE p.id = d.amends)" \
+            "  UNION ALL" \
+            "  SELECT d.id, c.chain_id, c.position + 1 FROM register_details d JOIN chain c ON d.amends = c.id" \
+            "  WHERE c.position < 10000) " \
+            "SELECT d.id AS details_id, e.chain_id AS expected_chain_id, e.position AS expected_position, " \
+            "rc.chain_id, rc.chain_position " \
+            "FROM register_details d LEFT JOIN chain e ON e.id = d.id " \
+            "LEFT JOIN register_chain rc ON rc.details_id = d.id " \
+            "WHERE e.chain_id IS DISTINCT FROM rc.chain_id OR e.position IS DISTINCT FROM rc.chain_position " \
+            "ORDER BY d.id"
+
+
+def entry_summary_from_rows(details_id, rows):
+    # rows: the register/register_details rows of one details id
+    if len(rows) == 0 or rows[0]['registration_no'] is None:
+        raise RuntimeError('No rows returned for id {}'.format(details_id))
+
+    registrations = []
+    for row in rows:
+        registrations.append({
+            'number': row['registration_no'],
+            'date': row['date'].strftime('%Y-%m-%d'),
+            'sequence': row['reg_sequence_no']
+        })
+
+    data = {
+        'registrations': registrations,
+        'id': details_id,
+        'class_of_charge': rows[0]['class_of_charge'],
+        'application': "New Registration" if rows[0]['amendment_type'] is None else rows[0]['amendment_type'],
+        'amends': rows[0]['amends']
+    }
+
+    if rows[0]['expired_on'] is None:
+        data['expired_date'] = None
+    else:
+        data['expired_date'] = rows[0]['expired_on'].strftime("%Y-%m-%d")
+
+    return data
+
+
+def read_chain(cursor, start, params):
+    # Returns (start details id, {details_id: [summary rows]}, {details_id: [ids amending it]})
+    cursor.execute(CHAIN_SQL.format(start=start), params)
+    start_id = None
+    members = {}
+    amended_by = {}
+    for row in cursor.fetchall():
+        if row['details_id'] not in members:
+            members[row['details_id']] = []
+            if row['amends'] is not None:
+                amended_by.setdefault(row['amends'], []).append(row['details_id'])
+        members[row['details_id']].append(row)
+        if row['is_start']:
+            start_id = row['details_id']
+    return start_id, members, amended_by
+
+
+def walk_forward(start_id, members, amended_by, follow_part_cans):
+    next_id = start_id
+    while True:
+        # This is nasty, but the part cans exclusion was added to fix one bug, but in turn has broken
+        # additional information generation
+        ids = [i for i in amended_by.get(next_id, [])
+               if follow_part_cans or members[i][0]['amendment_type'] not in [None, 'Part Cancellation']]
+
+        if len(ids) == 0:
+            return next_id
+
+        if len(ids) > 1:
+            raise RuntimeError('Unexpected multiple amendment in get_head_of_chain')
+
+        next_id = ids[0]
+
+
+def walk_back(details_id, members):
+    results = []
+    next_id = details_id
+    while next_id is not None:
+        if next_id not in members:
+            raise RuntimeError('No rows returned for id {}'.format(next_id))
+        entry = entry_summary_from_rows(next_id, members[next_id])
+        results.append(entry)
+        next_id = entry['amends']
+    return results
+
+
+def find_head(cursor, reg_no, date, follow_part_cans=False):
+    start_id, members, amended_by = read_chain(cursor, START_BY_REGISTRATION, {'reg_no': reg_no, 'date': date})
+    if start_id is None:
+        raise RuntimeError('No registration found for {} {}'.format(reg_no, date))
+    return walk_forward(start_id, members, amended_by, follow_part_cans)
+
+
+def history_from_details(cursor, details_id):
+    start_id, members, amended_by = read_chain(cursor, START_BY_DETAILS, {'details_id': details_id})
+    return walk_back(details_id, members)
+
+
+def history_from_registration(cursor, reg_no, date):
+    start_id, members, amended_by = read_chain(cursor, START_BY_REGISTRATION, {'reg_no': reg_no, 'date': date})
+    if start_id is None:
+        return []
+    return walk_back(start_id, members)
+
+
+def history_from_head(cursor, reg_no, date, follow_part_cans=False):
+    # Equivalent to history_from_details(cursor, find_head(cursor, reg_no, date, follow_part_cans))
+    start_id, members, amended_by = read_chain(cursor, START_BY_REGISTRATION, {'reg_no': reg_no, 'date': date})
+    if start_id is None:
+        raise RuntimeError('No registration found for {} {}'.format(reg_no, date))
+    return walk_back(walk_forward(start_id, members, amended_by, follow_part_cans), members)
+
+
+def chain_version(cursor, reg_no, date):
+    # Returns (chain_id, version) for the chain holding a registration, or None if there isn't one
+    cursor.execute(VERSION_SQL.format(start=START_BY_REGISTRATION), {'reg_no': reg_no, 'date': date})
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return row['chain_id'], '{}-{}-{}'.format(row['members'], row['latest'], row['cancelled'])
+
+
+def get_chain_id(cursor, details_id):
+    cursor.execute("SELECT chain_id FROM register_chain WHERE details_id = %(id)s", {'id': details_id})
+    row = cursor.fetchone()
+    return None if row is None else row['chain_id']
+
+
+def link_chain(cursor, details_id):
+    # Call whenever 'amends' is set on details_id. Re-derives register_chain for the chain it now belongs to.
+    cursor.execute(CHAIN_FROM_LINKS_SQL, {'details_id': details_id})
+    rows = cursor.fetchall()
+    ids = [row['id'] for row in rows]
+    cursor.execute("DELETE FROM register_chain WHERE details_id = ANY(%(ids)s)", {'ids': ids})
+    values = ",".join(cursor.mogrify("(%s, %s, %s)", (row['chain_id'], row['id'], row['position'])).decode('utf-8')
+                      for row in rows)
+    cursor.execute("INSERT INTO register_chain (chain_id, details_id, chain_position) VALUES " + values)
+
+
+def check_chains(cursor):
+    # Returns the details rows whose register_chain entry is missing or disagrees with the 'amends' links
+    cursor.execute(CHECK_SQL)
+    return cursor.fetchall()
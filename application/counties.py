@@ -0,0 +1,116 @@
+# Process-wide cache of the county and county_search_keys reference tables, which are small and only change
+# through the dev loading routes. Each worker loads them once (at startup where the database is up, otherwise
+# on first use) and again after COUNTY_CACHE_SECONDS or when its own loading routes invalidate it; other
+# workers catch up within the TTL.
+import threading
+import time
+import logging
+import psycopg2
+import psycopg2.extras
+from application import app
+from application.pool import get_pool
+from application.metrics import REFERENCE_CACHE_LOOKUPS
+
+
+class CountyReference(object):
+    # A snapshot of the tables with the lookups the routes, searches and writes need. Treat as read-only.
+    def __init__(self, county_rows, search_key_rows):
+        self.names = []                 # county names, in id order
+        self.welsh_names = []           # (name, welsh_name), in id order
+        self.ids_by_name = {}           # upper-case name -> id (the first, should a name repeat)
+        self.all_ids_by_name = {}       # upper-case name -> every id with that name
+        self.english_by_welsh = {}      # upper-case Welsh name -> upper-case English name
+        for row in county_rows:
+            self.names.append(row['name'])
+            self.welsh_names.append((row['name'], row['welsh_name']))
+            self.ids_by_name.setdefault(row['name'].upper(), row['id'])
+            self.all_ids_by_name.setdefault(row['name'].upper(), []).append(row['id'])
+            if row['welsh_name'] is not None:
+                self.english_by_welsh[row['welsh_name'].upper()] = row['name'].upper()
+
+        # county_search_keys.name -> every matching row's key / county_council flag, so callers can still tell
+        # a missing area from an ambiguous one
+        self.search_keys = {}
+        self.county_council = {}
+        for row in search_key_rows:
+            self.search_keys.setdefault(row['name'], []).append(row['key'])
+            self.county_council.setdefault(row['name'], []).append(row['county_council'])
+
+    def english_names(self, welsh_name):
+        return [name for name, welsh in self.welsh_names
+                if welsh is not None and welsh.upper() == welsh_name.upper() and name]
+
+    def welsh_names_of(self, name):
+        return [welsh for english, welsh in self.welsh_names if english.upper() == name.upper() and welsh]
+
+    def ids_of(self, names):
+        # Every county id whose name is one of names (upper-case); names that aren't counties match nothing
+        return sorted(county_id for name in set(names) for county_id in self.all_ids_by_name.get(name, []))
+
+
+def load_county_reference(cursor):
+    cursor.execute("SELECT id, name, welsh_name FROM county ORDER BY id")
+    county_rows = cursor.fetchall()
+    cursor.execute("SELECT name, key, county_council FROM county_search_keys ORDER BY name, key")
+    return CountyReference(county_rows, cursor.fetchall())
+
+
+class ReferenceCache(object):
+    def __init__(self, name, loader, ttl):
+        self.name = name
+        self.loader = loader
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._value = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    def get(self, cursor):
+        # Reloads through the caller's cursor when stale, so it sees the caller's own transaction
+        value, loaded_at = self._value, self._loaded_at
+        if value is not None and time.monotonic() - loaded_at < self.ttl:
+            self.hits += 1
+            REFERENCE_CACHE_LOOKUPS.labels(self.name, 'hit').inc()
+            return value
+
+        self.misses += 1
+        REFERENCE_CACHE_LOOKUPS.labels(self.name, 'miss').inc()
+        value = self.loader(cursor)
+        with self._lock:
+            self._value, self._loaded_at = value, time.monotonic()
+        return value
+
+    def invalidate(self):
+        with self._lock:
+            self._value, self._loaded_at = None, None
+
+
+county_cache = ReferenceCache('county', load_county_reference, app.config['COUNTY_CACHE_SECONDS'])
+
+
+def county_reference(cursor):
+    return county_cache.get(cursor)
+
+
+def invalidate_counties():
+    logging.info('County reference cache invalidated')
+    county_cache.invalidate()
+
+
+def preload_counties():
+    # Called at startup. A database that isn't up yet just means loading on first use instead.
+    pool = get_pool(app.config)
+    try:
+        connection = pool.checkout()
+    except psycopg2.Error as e:
+        logging.warning('County reference data not preloaded: %s', e)
+        return
+    try:
+        cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+        county_cache.get(cursor)
+        cursor.close()
+    except psycopg2.Error as e:
+        logging.warning('County reference data not preloaded: %s', e)
+    finally:
+        pool.release(connection)
@@ -1,32 +1,73 @@
 from application import app
 import psycopg2
+import psycopg2.extras
 import json
 import datetime
 import logging
 import re
+import time
 from application.data_diff import get_rectification_type, eo_name_string, names_match, all_names_match, party_a_is_subset_of_b
 from application.search_key import create_registration_key
 from application.logformat import format_message
+from application.pool import get_pool
+from application.instrument import instrumented
+from application.metrics import REGISTER_LOCK_WAIT
+from application.chain import find_head, history_from_registration, history_from_head, link_chain, \
+    chain_version, get_chain_id
+from application.cache import LRUCache
+from application.exchange import publish_cancellation
+from application.counties import county_reference
+from application.search_index import refresh_search_index, expire_in_search_index
+from application.search import distinct_results, result_id
 #from application.additional_info import get_additional_info
 
+# First key of the advisory locks taken while working out a register row's sequence number
+REGISTER_SEQUENCE_LOCK = 1
+
+
 def connect(cursor_factory=None):
-    connection = psycopg2.connect(app.config['PSQL_CONNECTION'])
-    return connection.cursor(cursor_factory=cursor_factory)
+    return get_pool(app.config).cursor(cursor_factory=instrumented(cursor_factory))
 
 
 def complete(cursor):
-    cursor.connection.commit()
-    cursor.close()
-    cursor.connection.close()
+    connection = cursor.connection
+    try:
+        connection.commit()
+    finally:
+        cursor.close()
+        get_pool(app.config).release(connection)
 
 
 def rollback(cursor):
-    cursor.connection.rollback()
-    cursor.close()
-    cursor.connection.close()
+    connection = cursor.connection
+    try:
+        connection.rollback()
+    finally:
+        cursor.close()
+        get_pool(app.config).release(connection)
 
 
-def insert_address(cursor, address, party_id):
+# Multi-row inserts for the write path. psycopg2 2.6 has no execute_values, so rows are mogrified into a
+# single VALUES list. Ids are taken from the table's sequence up front rather than relying on the order of
+# RETURNING, so callers can map each id back to the object it was inserted for.
+def allocate_ids(cursor, table, count):
+    if count == 0:
+        return []
+    cursor.execute("SELECT nextval(pg_get_serial_sequence(%(table)s, 'id')) FROM generate_series(1, %(count)s)",
+                   {'table': table, 'count': count})
+    return [row[0] for row in cursor.fetchall()]
+
+
+def insert_rows(cursor, table, columns, rows):
+    if len(rows) == 0:
+        return
+    template = "(" + ", ".join(["%s"] * len(columns)) + ")"
+    values = ", ".join(cursor.mogrify(template, row).decode('utf-8') for row in rows)
+    cursor.execute("INSERT INTO " + table + " (" + ", ".join(columns) + ") VALUES " + values)
+
+
+def address_values(address):
+    # Returns (address_detail columns or None, address_string)
     if 'address_lines' in address and len(address['address_lines']) > 0:
         lines = address['address_lines'][0:5]   # First five lines
         remaining = ", ".join(address['address_lines'][5:])
@@ -38,42 +79,41 @@ def insert_address(cursor, address, party_id):
 
         county = address['county']
         postcode = address['postcode']       # Postcode in the last
-        cursor.execute("INSERT INTO address_detail ( line_1, line_2, line_3, line_4, line_5, line_6 ,county, postcode) "
-                       "VALUES( %(line1)s, %(line2)s, %(line3)s, %(line4)s, %(line5)s, %(line6)s, %(county)s, "
-                       "%(postcode)s ) RETURNING id",
-                       {
-                           "line1": lines[0], "line2": lines[1], "line3": lines[2],
-                           "line4": lines[3], "line5": lines[4], "line6": lines[5],
-                           "county": county, "postcode": postcode,
-                       })
-        detail_id = cursor.fetchone()[0]
         address_string = "{}, {}, {}".format(", ".join(address['address_lines']), address["county"],
                                              address["postcode"])
+        return tuple(lines) + (county, postcode), address_string
     elif 'address_string' in address:
-        address_string = address['address_string']
-        detail_id = None
+        return None, address['address_string']
     else:
         raise Exception('Invalid address object')
 
-    cursor.execute("INSERT INTO address (address_type, address_string, detail_id) " +
-                   "VALUES( %(type)s, %(string)s, %(detail)s ) " +
-                   "RETURNING id",
-                   {
-                       "type": address['type'],
-                       "string": address_string,
-                       "detail": detail_id
-                   })
-    address['id'] = cursor.fetchone()[0]
 
-    cursor.execute("INSERT INTO party_address (address_id, party_id) " +
-                   "VALUES ( %(address)s, %(party)s ) RETURNING id",
-                   {
-                       "address": address['id'], "party": party_id
-                   })
-    return address['id']
+def insert_addresses(cursor, party_addresses):
+    # party_addresses: [(party_id, address)]. Sets address['id'] on each.
+    values = [address_values(address) for party_id, address in party_addresses]
+
+    details = [detail for detail, address_string in values if detail is not None]
+    detail_ids = iter(allocate_ids(cursor, 'address_detail', len(details)))
+    address_ids = allocate_ids(cursor, 'address', len(values))
+
+    detail_rows = []
+    address_rows = []
+    for (party_id, address), (detail, address_string), address_id in zip(party_addresses, values, address_ids):
+        detail_id = None
+        if detail is not None:
+            detail_id = next(detail_ids)
+            detail_rows.append((detail_id,) + detail)
+        address_rows.append((address_id, address['type'], address_string, detail_id))
+        address['id'] = address_id
+
+    insert_rows(cursor, 'address_detail', ['id', 'line_1', 'line_2', 'line_3', 'line_4', 'line_5', 'line_6',
+                                           'county', 'postcode'], detail_rows)
+    insert_rows(cursor, 'address', ['id', 'address_type', 'address_string', 'detail_id'], address_rows)
+    insert_rows(cursor, 'party_address', ['address_id', 'party_id'],
+                [(address['id'], party_id) for party_id, address in party_addresses])
 
 
-def insert_party_name(cursor, party_id, name):
+def party_name_values(cursor, name):
     name_string = None
     forename = None
     middle_names = None
@@ -110,58 +150,75 @@ def insert_party_name(cursor, party_id, name):
 
     # get_searchable_string(name_string=None, company=None, local_auth=None, local_auth_area=None, other=None):
     name_key = create_registration_key(cursor, name)
-    cursor.execute("INSERT INTO party_name ( party_name, forename, middle_names, surname, alias_name, "
-                   "complex_number, complex_name, name_type_ind, company_name, local_authority_name, "
-                   "local_authority_area, other_name, searchable_string, subtype ) "
-                   "VALUES ( %(name)s, %(forename)s, %(midnames)s, %(surname)s, %(alias)s, "
-                   "%(comp_num)s, %(comp_name)s, %(type)s, %(company)s, "
-                   "%(loc_auth)s, %(loc_auth_area)s, %(other)s, %(search_name)s, %(subtype)s ) "
-                   "RETURNING id", {
-                       "name": name_string, "forename": forename, "midnames": middle_names,
-                       "surname": surname, "alias": is_alias, "comp_num": complex_number, "comp_name": complex_name,
-                       "type": name['type'], "company": company, "loc_auth": local_auth,
-                       "loc_auth_area": local_auth_area, "other": other, "search_name": name_key['key'],
-                       'subtype': name_key['indicator']
-                   })
-
-    name_id = cursor.fetchone()[0]
-    return_data = {
-        'id': name_id,
-        'name': name
-    }
-
-    cursor.execute("INSERT INTO party_name_rel (party_name_id, party_id) " +
-                   "VALUES( %(name)s, %(party)s ) RETURNING id",
-                   {
-                       "name": name_id, "party": party_id
-                   })
-
-    return return_data
+    return (name_string, forename, middle_names, surname, is_alias, complex_number, complex_name, name['type'],
+            company, local_auth, local_auth_area, other, name_key['key'], name_key['indicator'])
+
+
+def insert_party_names(cursor, party_names):
+    # party_names: [(party_id, name)]. Returns [{'id': name id, 'name': name}] in the same order.
+    values = [party_name_values(cursor, name) for party_id, name in party_names]
+    name_ids = allocate_ids(cursor, 'party_name', len(party_names))
+    insert_rows(cursor, 'party_name', ['id', 'party_name', 'forename', 'middle_names', 'surname', 'alias_name',
+                                       'complex_number', 'complex_name', 'name_type_ind', 'company_name',
+                                       'local_authority_name', 'local_authority_area', 'other_name',
+                                       'searchable_string', 'subtype'],
+                [(name_id,) + value for name_id, value in zip(name_ids, values)])
+    insert_rows(cursor, 'party_name_rel', ['party_name_id', 'party_id'],
+                [(name_id, party_id) for name_id, (party_id, name) in zip(name_ids, party_names)])
+    return [{'id': name_id, 'name': name} for name_id, (party_id, name) in zip(name_ids, party_names)]
+
+
+# Registration numbers run from 1000 each year. The next number for each year is held in registration_counter
+# and taken with a row-level UPDATE, so concurrent registrations queue on that one row (until commit) rather
+# than locking the register table against readers. A rolled-back registration hands its number back.
+def allocate_registration_no(cursor, year):
+    while True:
+        cursor.execute("UPDATE registration_counter SET next_no = next_no + 1 WHERE year = %(year)s "
+                       "RETURNING next_no - 1 AS reg", {'year': year})
+        row = cursor.fetchone()
+        if row is not None:
+            return row['reg']
+
+        # First registration of the year (or the counter was never seeded); start from whatever the register
+        # already holds. If another transaction gets there first, go round again and use its row.
+        cursor.execute("SAVEPOINT registration_counter")
+        try:
+            cursor.execute("INSERT INTO registration_counter (year, next_no) "
+                           "SELECT %(year)s, COALESCE(MAX(registration_no) + 1, 1000) FROM register "
+                           "WHERE date >= %(start)s AND date < %(end)s", {
+                               'year': year,
+                               'start': "{}-01-01".format(year),
+                               'end': "{}-01-01".format(year + 1)
+                           })
+            cursor.execute("RELEASE SAVEPOINT registration_counter")
+        except psycopg2.IntegrityError:
+            cursor.execute("ROLLBACK TO SAVEPOINT registration_counter")
+
+
+def reserve_registration_no(cursor, year, reg_no):
+    # For registrations that bring their own number (migrated records), so the counter never hands it out
+    cursor.execute("UPDATE registration_counter SET next_no = GREATEST(next_no, %(no)s + 1) "
+                   "WHERE year = %(year)s", {'year': year, 'no': reg_no})
 
 
 def insert_registration(cursor, details_id, name_id, date, county_id, orig_reg_no=None, expires_date=None):
     logging.debug('Insert registration')
-    cursor.execute('LOCK TABLE register in ACCESS EXCLUSIVE MODE;')
+    year = int(date[:4])  # date is a string
+    lock_start = time.perf_counter()
     if orig_reg_no is None:
         # Get the next registration number
-        year = date[:4]  # date is a string
-        cursor.execute('select MAX(registration_no) + 1 AS reg '
-                       'from register  '
-                       'where date >=%(start)s AND date < %(end)s',
-                       {
-                           'start': "{}-01-01".format(year),
-                           'end': "{}-01-01".format(int(year) + 1)
-                       })
-
-        rows = cursor.fetchall()
-        if rows[0]['reg'] is None:
-            reg_no = 1000
-        else:
-            reg_no = int(rows[0]['reg'])
+        reg_no = allocate_registration_no(cursor, year)
     else:
         reg_no = orig_reg_no
+        reserve_registration_no(cursor, year, int(reg_no))
+
+    # Check if registration_no and date already exist, if they do then increase sequence number. Writers
+    # of the same number and date take turns for the rest of the transaction.
+    cursor.execute("SELECT pg_advisory_xact_lock(%(lock_class)s, hashtext(%(key)s))", {
+        'lock_class': REGISTER_SEQUENCE_LOCK, 'key': '{}/{}'.format(reg_no, date)
+    })
+    REGISTER_LOCK_WAIT.observe(time.perf_counter() - lock_start)
 
-    # Check if registration_no and date already exist, if they do then increase sequence number
     cursor.execute('select MAX(reg_sequence_no) + 1 AS seq_no '
                    'from register  '
                    'where registration_no=%(reg_no)s AND date=%(date)s',
@@ -189,6 +246,7 @@ def insert_registration(cursor, details_id, name_id, date, county_id, orig_reg_n
                        'seq': version
                    })
     reg_id = cursor.fetchone()[0]
+    refresh_search_index(cursor, [reg_id])
     return reg_no, reg_id
 
 
@@ -199,6 +257,7 @@ def mark_as_no_reveal_by_details(cursor, details_id, expired_date=None):
     cursor.execute("UPDATE register SET expired_on=%(exp)s WHERE details_id=%(did)s", {
         "exp": expired_date, "did": details_id
     })
+    expire_in_search_index(cursor, "r.details_id=%(did)s", {"did": details_id})
 
 
 def mark_as_no_reveal(cursor, reg_no, date, expired_date=None):
@@ -208,6 +267,7 @@ def mark_as_no_reveal(cursor, reg_no, date, expired_date=None):
     cursor.execute("UPDATE register SET expired_on=%(exp)s WHERE registration_no=%(regno)s AND date=%(date)s", {
         "exp": expired_date, "regno": reg_no, "date": date
     })
+    expire_in_search_index(cursor, "r.registration_no=%(regno)s AND r.date=%(date)s", {"regno": reg_no, "date": date})
 
 
 def mark_as_no_reveal_by_id(cursor, register_id, expired_date=None):
@@ -217,6 +277,7 @@ def mark_as_no_reveal_by_id(cursor, register_id, expired_date=None):
     cursor.execute("UPDATE register SET expired_on=%(exp)s WHERE id = %(id)s ", {
         "exp": expired_date, "id": register_id
     })
+    expire_in_search_index(cursor, "r.id = %(id)s", {"id": register_id})
 
 
 def insert_register_details(cursor, request_id, data, date, amends):
@@ -298,7 +359,9 @@ def insert_register_details(cursor, request_id, data, date, amends):
                        "amd_type": amend_info_type, "amd_detl_c": amend_info_details_current,
                        "amd_detl_o": amend_info_details_orig
                    })
-    return cursor.fetchone()[0]
+    details_id = cursor.fetchone()[0]
+    link_chain(cursor, details_id)
+    return details_id
 
 
 # pylint: disable=too-many-arguments
@@ -331,7 +394,7 @@ def insert_request(cursor, user_id, applicant, application_type, date, original_
     return cursor.fetchone()[0]
 
 
-def insert_party(cursor, details_id, party):
+def party_values(details_id, party):
     occupation = None
     date_of_birth = None
     residence_withheld = False
@@ -346,13 +409,7 @@ def insert_party(cursor, details_id, party):
             date_of_birth = None
         residence_withheld = party['residence_withheld']
 
-    cursor.execute("INSERT INTO party (register_detl_id, party_type, occupation, date_of_birth, residence_withheld) " +
-                   "VALUES( %(reg_id)s, %(type)s, %(occupation)s, %(dob)s, %(rw)s ) RETURNING id",
-                   {
-                       "reg_id": details_id, "type": party['type'], "occupation": occupation,
-                       "dob": date_of_birth, "rw": residence_withheld
-                   })
-    return cursor.fetchone()[0]
+    return details_id, party['type'], occupation, date_of_birth, residence_withheld
 
 
 def insert_details(cursor, request_id, data, date, amends_id):
@@ -360,24 +417,37 @@ def insert_details(cursor, request_id, data, date, amends_id):
     # register details
     register_details_id = insert_register_details(cursor, request_id, data, date, amends_id)
 
+    # Each level (parties, then their addresses and names) goes in as one statement
+    party_ids = allocate_ids(cursor, 'party', len(data['parties']))
+    insert_rows(cursor, 'party', ['id', 'register_detl_id', 'party_type', 'occupation', 'date_of_birth',
+                                  'residence_withheld'],
+                [(party_id,) + party_values(register_details_id, party)
+                 for party_id, party in zip(party_ids, data['parties'])])
+
     debtor_id = None
     debtor = None
-    names = []
-    for party in data['parties']:
-        party_id = insert_party(cursor, register_details_id, party)
-
+    party_addresses = []
+    party_names = []
+    is_debtor_name = []
+    for party_id, party in zip(party_ids, data['parties']):
         if party['type'] == 'Debtor':
             debtor_id = party_id
             debtor = party
 
         if 'addresses' in party:
             for address in party['addresses']:
-                insert_address(cursor, address, party_id)
+                party_addresses.append((party_id, address))
 
         for name in party['names']:
-            name_info = insert_party_name(cursor, party_id, name)
-            if party['type'] == 'Debtor':
-                names.append(name_info)
+            party_names.append((party_id, name))
+            is_debtor_name.append(party['type'] == 'Debtor')
+
+    insert_addresses(cursor, party_addresses)
+
+    names = []
+    for name_info, is_debtor in zip(insert_party_names(cursor, party_names), is_debtor_name):
+        if is_debtor:
+            names.append(name_info)
 
     # party_trading
     if debtor_id is not None:
@@ -477,11 +547,10 @@ def insert_counties(cursor, details_id, counties):
     if len(counties) == 1 and (counties[0].upper() == 'NO COUNTY' or counties[0] == ""):
         return []
 
-    ids = []
-    for county in counties:
-        county_detl_id, county_id = insert_lc_county(cursor, details_id, county)
-        ids.append({'id': county_id, 'name': county})
-    return ids
+    county_ids = get_county_ids(cursor, counties)
+    insert_rows(cursor, 'detl_county_rel', ['county_id', 'details_id'],
+                [(county_ids[county.upper()], details_id) for county in counties])
+    return [{'id': county_ids[county.upper()], 'name': county} for county in counties]
 
     
 def insert_record(cursor, data, request_id, date, amends=None, orig_reg_no=None):
@@ -549,6 +618,7 @@ def set_amends(cursor, new_detl_id, original_detl_id):
                    {
                        "original_detl_id": original_detl_id, "new_detl_id": new_detl_id
                    })
+    link_chain(cursor, new_detl_id)
 
 
 def get_alteration_type(original_details, data):
@@ -748,7 +818,9 @@ def insert_rectification(cursor, user_id, rect_reg_no, rect_reg_date, data, pab_
                 mark_as_no_reveal_by_details(cursor, pab_details_id, pab_ex_date)
 
             update_previous_details(cursor, request_id, pab_details_id)
+            invalidate_additional_info(cursor, pab_details_id)
 
+    invalidate_additional_info(cursor, original_details_id)
     logging.debug('End of insert rectification')
     return original_regs, reg_nos, request_id
 
@@ -813,18 +885,13 @@ def get_registration(cursor, reg_id, date=None):
     return result
 
 
-def get_registration_no_from_details_id(cursor, details_id):
-    cursor.execute("select r.registration_no, r.date, d.amendment_type from register r, register_details d where " +
-                   "  r.details_id = %(id)s AND r.details_id = d.id",
-                   {'id': details_id})
-    rows = cursor.fetchall()
-    if len(rows) == 0:
-        raise RuntimeError("No registration found for details {}".format(details_id))
-    else:
-        return {
-            'number': rows[0]['registration_no'],
-            'date': rows[0]['date'].strftime('%Y-%m-%d')
-        }
+def registration_summary(row):
+    return {
+        'number': row['registration_no'],
+        'date': row['date'].strftime('%Y-%m-%d'),
+        'class': row['class_of_charge'],
+        'uri': row['date'].strftime('%Y-%m-%d') + '/' + str(row['registration_no'])
+    }
 
 
 def get_all_registrations(cursor):
@@ -837,35 +904,75 @@ def get_all_registrations(cursor):
 
     results = []
     for row in rows:
-        results.append({
-            'number': row['registration_no'],
-            'date': row['date'].strftime('%Y-%m-%d'),
-            'class': row['class_of_charge'],
-            'uri': row['date'].strftime('%Y-%m-%d') + '/' + str(row['registration_no'])
-        })
+        results.append(registration_summary(row))
     return results
 
 
-def get_corrections_by_date(cursor, date):
-    cursor.execute("select r.registration_no, r.date, d.class_of_charge, d.amends, d.cancelled_by, d.request_id, d.amendment_type "
-                   "from register r, register_details d, request q "
-                   "where r.details_id = d.id and d.request_id = q.id and q.application_type='Correction' "
-                   "and q.application_date=%(date)s", {'date': date})
+def all_registrations_query(after=None, limit=None):
+    # Registrations in (date, number, register id) order, optionally starting after a given key. 'after' is
+    # (date, number) or (date, number, register id); the former skips every register row for that number.
+    sql = 'select r.id as register_id, r.registration_no, r.date, d.class_of_charge ' \
+          'from register r, register_details d ' \
+          'where d.id = r.details_id '
+    params = {}
+    if after is not None and len(after) == 3:
+        sql += 'and (r.date, r.registration_no, r.id) > (%(date)s, %(no)s, %(id)s) '
+        params = {'date': after[0], 'no': after[1], 'id': after[2]}
+    elif after is not None:
+        sql += 'and (r.date, r.registration_no) > (%(date)s, %(no)s) '
+        params = {'date': after[0], 'no': after[1]}
+
+    sql += 'order by r.date, r.registration_no, r.id '
+    if limit is not None:
+        sql += 'limit %(limit)s'
+        params['limit'] = limit
+    return sql, params
+
+
+def get_registrations_page(cursor, after=None, limit=100):
+    # Returns (registrations, key to pass as 'after' for the next page, or None on the last page)
+    sql, params = all_registrations_query(after, limit)
+    cursor.execute(sql, params)
     rows = cursor.fetchall()
+    next_key = None
+    if len(rows) == limit:
+        next_key = (rows[-1]['date'].strftime('%Y-%m-%d'), rows[-1]['registration_no'], rows[-1]['register_id'])
+    return [registration_summary(row) for row in rows], next_key
+
+
+def iter_all_registrations(after=None, limit=None, itersize=2000):
+    # Generator over registration summaries, read through a server-side cursor so only itersize rows are
+    # held at a time. Holds a pooled connection until exhausted or closed.
+    pool = get_pool(app.config)
+    connection = pool.checkout()
+    try:
+        cursor = connection.cursor('all_registrations', cursor_factory=instrumented(psycopg2.extras.DictCursor))
+        cursor.itersize = itersize
+        sql, params = all_registrations_query(after, limit)
+        cursor.execute(sql, params)
+        for row in cursor:
+            yield registration_summary(row)
+        cursor.close()
+        connection.commit()
+    finally:
+        pool.release(connection)
+
+
+def group_by_request(rows, with_register_id=False):
+    # One item per request, in order of first appearance, holding that request's registrations. Rows
+    # should come ordered by request_id; the dict just saves relying on it.
     results = []
+    items = {}
     for row in rows:
         request_id = row['request_id']
-        item = None
-        for r in results:
-            if r['id'] == request_id:
-                item = r
-                break
+        item = items.get(request_id)
         if item is None:
             item = {
                 'application': '',
                 'id': request_id,
                 'data': []
             }
+            items[request_id] = item
             results.append(item)
 
         if row['amends'] is None:
@@ -873,219 +980,177 @@ def get_corrections_by_date(cursor, date):
         else:
             item['application'] = row['amendment_type']  # 'amend'
 
-        item['data'].append({
+        reg = {
             'number': row['registration_no'],
             'date': row['date'].strftime('%Y-%m-%d'),
             'class_of_charge': row['class_of_charge']
-        })
+        }
+        if with_register_id:
+            reg['register_id'] = row['register_id']
+        item['data'].append(reg)
     return results
 
+
+def get_corrections_by_date(cursor, date):
+    cursor.execute("select r.registration_no, r.date, d.class_of_charge, d.amends, d.cancelled_by, d.request_id, d.amendment_type "
+                   "from register r, register_details d, request q "
+                   "where r.details_id = d.id and d.request_id = q.id and q.application_type='Correction' "
+                   "and q.application_date=%(date)s "
+                   "order by d.request_id, r.id", {'date': date})
+    rows = cursor.fetchall()
+    return group_by_request(rows)
+
         
 def get_registrations_by_date(cursor, date):
     cursor.execute('select r.registration_no, r.date, d.class_of_charge, d.amends, d.cancelled_by, d.request_id, '
                    'd.amendment_type '
                    'from register r, register_details d '
-                   'where r.details_id = d.id and r.date=%(date)s', {'date': date})
+                   'where r.details_id = d.id and r.date=%(date)s '
+                   'order by d.request_id, r.id', {'date': date})
     rows = cursor.fetchall()
 
-    results = []
-    for row in rows:
-        request_id = row['request_id']
-        item = None
-        for r in results:
-            if r['id'] == request_id:
-                item = r
-                break
-        if item is None:
-            item = {
-                'application': '',
-                'id': request_id,
-                'data': []
-            }
-            results.append(item)
+    return group_by_request(rows) + get_corrections_by_date(cursor, date)
 
-        if row['amends'] is None:
-            item['application'] = 'new'
-        else:
-            item['application'] = row['amendment_type']  # 'amend'
 
-        item['data'].append({
-            'number': row['registration_no'],
-            'date': row['date'].strftime('%Y-%m-%d'),
-            'class_of_charge': row['class_of_charge']
-        })
-    return results + get_corrections_by_date(cursor, date)
+def name_from_row(row):
+    name_type = row['name_type_ind']
+    name = {
+        'type': name_type
+    }
+    if name_type == 'Private Individual':
+        fornames = [row['forename']]
+        middle = row['middle_names']
+        if middle is not None and middle != "":
+            fornames += middle.split(' ')
+
+        name['private'] = {
+            'forenames': fornames,
+            'surname': row['surname']
+        }
+    elif name_type == 'Rural Council' or name_type == 'Parish Council' \
+            or name_type == 'County Council' or name_type == 'Other Council':
+        name['local'] = {
+            'name': row['local_authority_name'],
+            'area': row['local_authority_area']
+        }
+    elif name_type == 'Development Corporation' or name_type == 'Other' or name_type == 'Coded Name':
+        name['other'] = row['other_name']
+    elif name_type == 'Limited Company':
+        name['company'] = row['company_name']
+    elif name_type == 'Complex Name':
+        name['complex'] = {
+            'name': row['complex_name'],
+            'number': row['complex_number']
+        }
+    else:
+        raise RuntimeError("Unknown name type: {}".format(name_type))
 
+    name['search_key'] = row['searchable_string']
+    name['subtype'] = row['subtype']
+    return name
 
-def read_names(cursor, party, party_id, lead_debtor_id):
-    cursor.execute('select n.id, forename, middle_names, surname, complex_number, complex_name, '
-                   'name_type_ind, company_name, local_authority_name, local_authority_area, '
-                   'other_name, searchable_string, subtype '
-                   'from party_name n, party_name_rel pn '
-                   'where n.id = pn.party_name_id and pn.party_id = %(id)s order by n.id', {
-                       'id': party_id
-                   })
-    rows = cursor.fetchall()
 
+def order_names(rows, lead_debtor_id):
     names_list = []
     for row in rows:
-        name_id = row['id']
-
-        name_type = row['name_type_ind']
-        name = {
-            'type': name_type
-        }
-        if name_type == 'Private Individual':
-            fornames = [row['forename']]
-            middle = row['middle_names']
-            if middle is not None and middle != "":
-                fornames += middle.split(' ')
-
-            name['private'] = {
-                'forenames': fornames,
-                'surname': row['surname']
-            }
-        elif name_type == 'Rural Council' or name_type == 'Parish Council' \
-                or name_type == 'County Council' or name_type == 'Other Council':
-            name['local'] = {
-                'name': row['local_authority_name'],
-                'area': row['local_authority_area']
-            }
-        elif name_type == 'Development Corporation' or name_type == 'Other' or name_type == 'Coded Name':
-            name['other'] = row['other_name']
-        elif name_type == 'Limited Company':
-            name['company'] = row['company_name']
-        elif name_type == 'Complex Name':
-            name['complex'] = {
-                'name': row['complex_name'],
-                'number': row['complex_number']
-            }
-        else:
-            raise RuntimeError("Unknown name type: {}".format(name_type))
-
-        name['search_key'] = row['searchable_string']
-        name['subtype'] = row['subtype']
-
-        if name_id == lead_debtor_id:
+        name = name_from_row(row)
+        if row['id'] == lead_debtor_id:
             names_list.insert(0, name)
         else:
             names_list.append(name)
-
-    party['names'] = names_list
+    return names_list
 
 
-def get_address_detail(cursor, address, detail_id):
-    cursor.execute('SELECT line_1, line_2, line_3, line_4, line_5, line_6, country_id, county, postcode '
-                   'FROM address_detail '
-                   'WHERE id=%(id)s', {
-                       'id': detail_id
-                   })
-    rows = cursor.fetchall()
-    if len(rows) == 0:
-        return
-    if len(rows) > 1:
-        raise RuntimeError("Unexpected multitude of address details")
-
-    row = rows[0]
+def set_address_detail(address, row):
     address['address_lines'] = []
-    if row['line_1'] is not None and row['line_1'] != '':
-        address['address_lines'].append(row['line_1'])
-    if row['line_2'] is not None and row['line_2'] != '':
-        address['address_lines'].append(row['line_2'])
-    if row['line_3'] is not None and row['line_3'] != '':
-        address['address_lines'].append(row['line_3'])
-    if row['line_4'] is not None and row['line_4'] != '':
-        address['address_lines'].append(row['line_4'])
-    if row['line_5'] is not None and row['line_5'] != '':
-        address['address_lines'].append(row['line_5'])
-    if row['line_6'] is not None and row['line_6'] != '':
-        address['address_lines'].append(row['line_6'])
+    for line in ['line_1', 'line_2', 'line_3', 'line_4', 'line_5', 'line_6']:
+        if row[line] is not None and row[line] != '':
+            address['address_lines'].append(row[line])
 
     address['county'] = row['county']
     address['postcode'] = row['postcode']
 
 
-def read_addresses(cursor, party, party_id):
-    cursor.execute('SELECT address_type, address_string, detail_id '
-                   'FROM party_address pa, address a '
-                   'WHERE pa.party_id = %(pid)s AND pa.address_id = a.id', {
-                       'pid': party_id
-                   })
-    rows = cursor.fetchall()
-    party['addresses'] = []
-    for row in rows:
-        address = {
-            'type': row['address_type'],
-            'address_string': row['address_string']
-        }
-        get_address_detail(cursor, address, row['detail_id'])
-
-        if 'address_lines' not in address:
-            address['address_lines'] = [address['address_string']]
-            address['postcode'] = ''
-            address['county'] = ''
-
-        party['addresses'].append(address)
-
-
-def read_parties(cursor, data, details_id, legal_ref, lead_debtor_id):
-    cursor.execute("SELECT id, party_type, occupation, date_of_birth, residence_withheld "
-                   "FROM party "
-                   "WHERE register_detl_id = %(id)s and party_type != 'Court' ", {
-                       'id': details_id
-                   })
-    rows = cursor.fetchall()
-    data['parties'] = []
-    for row in rows:
-        party = {
-            'type': row['party_type']
-        }
-
-        if row['occupation']:
-            party['occupation'] = row['occupation']
-
-        if party['type'] == 'Debtor':
-
-            if row['date_of_birth'] is not None:
-                party['date_of_birth'] = row['date_of_birth'].strftime('%Y-%m-%d')
-            else:
-                party['date_of_birth'] = None
-            party['residence_withheld'] = row['residence_withheld']
-            party['case_reference'] = legal_ref
-            read_addresses(cursor, party, row['id'])
-
-        data['parties'].append(party)
-        read_names(cursor, party, row['id'], lead_debtor_id)
-
-
-def get_lc_counties(cursor, details_id, lead_county_id):
-    cursor.execute("SELECT name FROM county WHERE id=%(id)s", {'id': lead_county_id})
-    row = cursor.fetchone()
-    
-    if row is None:  # This is a migrated record with no recorded county
-        counties = []
-    else:
-        counties = [row['name']]
-
-        cursor.execute("select dcr.county_id, c.name  from detl_county_rel dcr, county c " +
-                       "where dcr.details_id = %(id)s and dcr.county_id = c.id ", {'id': details_id})
-        rows = cursor.fetchall()
-
-        if len(rows) != 0:
-            for row in rows:
-                cty = row['name']
-                if cty not in counties:
-                    counties.append(cty)
-
-    return counties
+def set_address_without_detail(address):
+    if 'address_lines' not in address:
+        address['address_lines'] = [address['address_string']]
+        address['postcode'] = ''
+        address['county'] = ''
+
+
+# Loads everything get_details_from_rows needs beyond the register/register_details rows themselves, for any
+# number of entries, in a single round trip. One result row per register id; related rows come back as JSON.
+DETAIL_RELATIONS_SQL = """
+SELECT k.register_id,
+  (SELECT name FROM county WHERE id = k.county_id) AS lead_county,
+  (SELECT json_agg(c.name ORDER BY dcr.id) FROM detl_county_rel dcr, county c
+    WHERE dcr.details_id = k.details_id AND dcr.county_id = c.id) AS counties,
+  (SELECT json_build_object('number', r.registration_no, 'date', to_char(r.date, 'YYYY-MM-DD'))
+    FROM register r WHERE r.details_id = k.amends ORDER BY r.id FETCH FIRST 1 ROW ONLY) AS amends_registration,
+  EXISTS (SELECT 1 FROM register_details WHERE amends = k.details_id) AS has_amendment,
+  (SELECT json_build_object('number', r.registration_no, 'date', to_char(r.date, 'YYYY-MM-DD'),
+                            'type', d.amendment_type)
+    FROM register r, register_details d WHERE r.details_id = d.id AND d.amends = k.details_id
+    ORDER BY r.id FETCH FIRST 1 ROW ONLY) AS amended_by,
+  (SELECT json_agg(json_build_object(
+      'id', p.id, 'party_type', p.party_type, 'occupation', p.occupation,
+      'date_of_birth', to_char(p.date_of_birth, 'YYYY-MM-DD'), 'residence_withheld', p.residence_withheld,
+      'names', (SELECT json_agg(json_build_object(
+                  'id', n.id, 'forename', n.forename, 'middle_names', n.middle_names, 'surname', n.surname,
+                  'complex_number', n.complex_number, 'complex_name', n.complex_name,
+                  'name_type_ind', n.name_type_ind, 'company_name', n.company_name,
+                  'local_authority_name', n.local_authority_name, 'local_authority_area', n.local_authority_area,
+                  'other_name', n.other_name, 'searchable_string', n.searchable_string, 'subtype', n.subtype
+                ) ORDER BY n.id)
+                FROM party_name n, party_name_rel pn WHERE n.id = pn.party_name_id AND pn.party_id = p.id),
+      'addresses', (SELECT json_agg(json_build_object(
+                      'address_type', a.address_type, 'address_string', a.address_string,
+                      'has_detail', ad.id IS NOT NULL, 'line_1', ad.line_1, 'line_2', ad.line_2,
+                      'line_3', ad.line_3, 'line_4', ad.line_4, 'line_5', ad.line_5, 'line_6', ad.line_6,
+                      'county', ad.county, 'postcode', ad.postcode
+                    ) ORDER BY pa.id)
+                    FROM party_address pa JOIN address a ON pa.address_id = a.id
+                    LEFT JOIN address_detail ad ON ad.id = a.detail_id
+                    WHERE pa.party_id = p.id)
+    ) ORDER BY p.id)
+    FROM party p WHERE p.register_detl_id = k.details_id AND p.party_type != 'Court') AS parties,
+  (SELECT json_build_object('key_number', q.key_number, 'application_reference', q.application_reference,
+                            'customer_name', q.customer_name, 'customer_address', q.customer_address,
+                            'customer_addr_type', q.customer_addr_type)
+    FROM request q WHERE q.id = k.request_id) AS applicant,
+  m.register_id IS NOT NULL AS is_migrated, m.original_regn_no, m.extra_data,
+  (SELECT json_agg(a.class_of_charge ORDER BY a.id) FROM addl_class_of_charge a
+    WHERE a.date = r.date::date
+      AND CASE WHEN m.register_id IS NOT NULL THEN a.orig_number = m.original_regn_no
+               ELSE a.number = r.registration_no END) AS addl_classes
+FROM unnest(%(register_ids)s::int[], %(details_ids)s::int[], %(county_ids)s::int[],
+            %(request_ids)s::int[], %(amends)s::int[]) AS k(register_id, details_id, county_id, request_id, amends)
+JOIN register r ON r.id = k.register_id
+LEFT JOIN LATERAL (SELECT register_id, original_regn_no, extra_data FROM migration_status
+                   WHERE register_id = k.register_id ORDER BY id FETCH FIRST 1 ROW ONLY) m ON true
+"""
+
+
+def load_detail_relations(cursor, lead_rows):
+    # lead_rows: the first register row of each entry to be loaded. Returns {register_id: relations}
+    if len(lead_rows) == 0:
+        return {}
+
+    cursor.execute(DETAIL_RELATIONS_SQL, {
+        'register_ids': [row['register_id'] for row in lead_rows],
+        'details_ids': [row['id'] for row in lead_rows],
+        'county_ids': [row['county_id'] for row in lead_rows],
+        'request_ids': [row['request_id'] for row in lead_rows],
+        'amends': [row['amends'] for row in lead_rows]
+    })
+    return {row['register_id']: row for row in cursor.fetchall()}
 
 
-def get_details_from_rows(cursor, rows, fetch_amend_detail=False):
-    assert len(rows) > 0
+def build_details(rows, related, fetch_amend_detail=False, with_addl_class=False):
+    # Assembles the entry document from its register rows and the output of load_detail_relations. The
+    # key order and content must match the original per-relation loader exactly; see TestDetailsParity.
     details_id = rows[0]['id']
-    lead_county = rows[0]['county_id']
     lead_debtor_id = rows[0]['debtor_reg_name_id']
-    request_id = rows[0]['request_id']
 
     add_info = ''
     if rows[0]['additional_info'] is not None:
@@ -1101,7 +1166,6 @@ def get_details_from_rows(cursor, rows, fetch_amend_detail=False):
         'class_of_charge': rows[0]['class_of_charge'],
         'status': 'current',
         'entered_addl_info': add_info
-        # 'additional_information': add_info
     }
 
     if rows[0]['expired_on'] is None:
@@ -1115,8 +1179,15 @@ def get_details_from_rows(cursor, rows, fetch_amend_detail=False):
                 "expires": rows[0]['prio_notice_expires'].strftime('%Y-%m-%d')
             }
 
+        counties = []
+        if related['lead_county'] is not None:  # None is a migrated record with no recorded county
+            counties = [related['lead_county']]
+            for cty in related['counties'] or []:
+                if cty not in counties:
+                    counties.append(cty)
+
         data['particulars'] = {
-            'counties': get_lc_counties(cursor, details_id, lead_county),
+            'counties': counties,
             'district': rows[0]['district'],
             'description': rows[0]['short_description']
         }
@@ -1124,26 +1195,23 @@ def get_details_from_rows(cursor, rows, fetch_amend_detail=False):
         if rows[0]['priority_notice_no']:
             data['particulars']['priority_notice'] = rows[0]['priority_notice_no']
 
-    register_id = rows[0]['register_id']
     data['register_id'] = rows[0]['register_id']
     if len(rows) > 1:
         data['alternate_register_ids'] = []
         for row in rows[1:]:
             data['alternate_register_ids'].append(row['register_id'])
 
-    logging.debug('------------------')
-
     legal_ref = rows[0]['legal_body_ref']
-    logging.debug(legal_ref)
-    logging.debug(add_info)
-
     if legal_ref is not None and add_info is not None:
         if re.search("^\d+ OF \d{4}$", legal_ref, re.IGNORECASE) and re.search("\d+ OF \d{4}", add_info, re.IGNORECASE):
             # loading migration record
             legal_ref = add_info
 
     if rows[0]['amends'] is not None:
-        amend_of = get_registration_no_from_details_id(cursor, rows[0]['amends'])
+        amend_of = related['amends_registration']
+        if amend_of is None:
+            raise RuntimeError("No registration found for details {}".format(rows[0]['amends']))
+
         if not fetch_amend_detail and (amend_of['number'] == data['registration']['number'] and amend_of['date'] == data['registration']['date']):
             pass  # Don't show 'amends_registration' where its an update to an existing regn
 
@@ -1161,58 +1229,71 @@ def get_details_from_rows(cursor, rows, fetch_amend_detail=False):
                 data['amends_registration'][ait] = rows[0]['amend_info_details']
 
     if rows[0]['cancelled_by'] is not None:
-        cursor.execute("select amends, amendment_type from register_details where amends=%(id)s",
-                       {"id": details_id})
-        amd_rows = cursor.fetchall()
-        if len(amd_rows) > 0:
+        if related['has_amendment']:
             data['status'] = 'superseded'
         else:
             data['status'] = 'cancelled'
             data['cancellation'] = {'reference': rows[0]['cancelled_by']}
-            # TODO: this is bugged
-            # cursor.execute('select application_date from request where id=%(id)s', {'id': data['cancellation_ref']})
-            # cancel_rows = cursor.fetchall()
-            # data['cancellation']['date'] = cancel_rows[0]['application_date'].isoformat()
 
-    cursor.execute('select r.registration_no, r.date, d.amendment_type, d.amends FROM register r, register_details d ' +
-                   'WHERE r.details_id=d.id AND d.amends=%(id)s', {'id': details_id})
-    rows = cursor.fetchall()
-    if len(rows) > 0:
-        data['amended_by'] = {
-            'number': rows[0]['registration_no'],
-            'date': rows[0]['date'].strftime('%Y-%m-%d'),
-            'type': rows[0]['amendment_type']
+    if related['amended_by'] is not None:
+        data['amended_by'] = related['amended_by']
+
+    data['parties'] = []
+    for row in related['parties'] or []:
+        party = {
+            'type': row['party_type']
         }
 
-    read_parties(cursor, data, details_id, legal_ref, lead_debtor_id)
+        if row['occupation']:
+            party['occupation'] = row['occupation']
 
-    cursor.execute("select key_number, application_reference, customer_name, customer_address, "
-                   "customer_addr_type FROM "
-                   "request WHERE id=%(rid)s", {'rid': request_id})
-    rows = cursor.fetchall()
-    if len(rows) > 0:
-            data['applicant'] = {
-                'name': rows[0]['customer_name'],
-                'address': rows[0]['customer_address'],
-                'key_number': rows[0]['key_number'],
-                'reference': rows[0]['application_reference'],
-                'address_type': rows[0]['customer_addr_type'],
-            }
+        if party['type'] == 'Debtor':
+            party['date_of_birth'] = row['date_of_birth']
+            party['residence_withheld'] = row['residence_withheld']
+            party['case_reference'] = legal_ref
+            party['addresses'] = []
+            for addr_row in row['addresses'] or []:
+                address = {
+                    'type': addr_row['address_type'],
+                    'address_string': addr_row['address_string']
+                }
+                if addr_row['has_detail']:
+                    set_address_detail(address, addr_row)
+                set_address_without_detail(address)
+                party['addresses'].append(address)
 
-    cursor.execute("SELECT extra_data, original_regn_no FROM migration_status WHERE register_id=%(id)s", {
-        "id": register_id
-    })
-    rows = cursor.fetchall()
-    if len(rows) > 0:
+        data['parties'].append(party)
+        party['names'] = order_names(row['names'] or [], lead_debtor_id)
+
+    if related['applicant'] is not None:
+        data['applicant'] = {
+            'name': related['applicant']['customer_name'],
+            'address': related['applicant']['customer_address'],
+            'key_number': related['applicant']['key_number'],
+            'reference': related['applicant']['application_reference'],
+            'address_type': related['applicant']['customer_addr_type'],
+        }
+
+    if related['is_migrated']:
         data['migrated'] = {
-            'original_number': rows[0]['original_regn_no'],
-            'extra_data': rows[0]['extra_data']
+            'original_number': related['original_regn_no'],
+            'extra_data': related['extra_data']
         }
 
-    # name, address, keyn, ref
+    if with_addl_class:
+        # Only first-sequence entries carry additional classes; the lookup itself is done in DETAIL_RELATIONS_SQL
+        if data['registration']['sequence'] <= 1 and related['addl_classes']:
+            data['additional_classes'] = related['addl_classes']
+
     return data
 
 
+def get_details_from_rows(cursor, rows, fetch_amend_detail=False, with_addl_class=False):
+    assert len(rows) > 0
+    related = load_detail_relations(cursor, [rows[0]])[rows[0]['register_id']]
+    return build_details(rows, related, fetch_amend_detail, with_addl_class)
+
+
 def get_registration_details_by_id(cursor, details_id, fetch_amend_detail=False):
     cursor.execute("SELECT r.registration_no, r.date, r.expired_on, rd.class_of_charge, rd.id, r.id as register_id, "
                    "rd.legal_body_ref, rd.cancelled_by, rd.amends, rd.request_id, rd.additional_info, "
@@ -1231,35 +1312,6 @@ def get_registration_details_by_id(cursor, details_id, fetch_amend_detail=False)
     return get_details_from_rows(cursor, rows, fetch_amend_detail)
 
 
-def get_addl_class(cursor, data):
-    # Determing whether to use new reg no or original...
-
-    if data['registration']['sequence'] > 1:  # This data can only exist for migrated records
-        return
-
-    if 'migrated' in data and data['migrated']['original_number'] != data['registration']['number']:
-        cursor.execute("SELECT class_of_charge FROM addl_class_of_charge WHERE "
-                       "orig_number =%(no)s AND date=%(date)s ",
-                       {
-                           "no": data['migrated']['original_number'],
-                           "date": data['registration']['date']
-                       })
-    else:
-        cursor.execute("SELECT class_of_charge FROM addl_class_of_charge WHERE "
-                       "number=%(no)s AND date=%(date)s ",
-                       {
-                           "no": data['registration']['number'],
-                           "date": data['registration']['date']
-                       })
-    rows = cursor.fetchall()
-    classes = []
-    for row in rows:
-        classes.append(row['class_of_charge'])
-
-    if len(classes) > 0:
-        data['additional_classes'] = classes
-
-
 def get_registration_details_by_register_id(cursor, register_id):
 
     sql = "SELECT r.registration_no, r.date, r.expired_on, rd.class_of_charge, rd.id, r.id as register_id, " \
@@ -1275,9 +1327,7 @@ def get_registration_details_by_register_id(cursor, register_id):
     if len(rows) == 0:
         return None
 
-    data = get_details_from_rows(cursor, rows)
-    get_addl_class(cursor, data)
-    return data
+    return get_details_from_rows(cursor, rows, with_addl_class=True)
 
 
 def get_registration_details(cursor, reg_no, date, class_of_charge=None):
@@ -1301,43 +1351,69 @@ def get_registration_details(cursor, reg_no, date, class_of_charge=None):
     if len(rows) == 0:
         return None
 
-    data = get_details_from_rows(cursor, rows)
-    get_addl_class(cursor, data)
-    return data
+    return get_details_from_rows(cursor, rows, with_addl_class=True)
 
 
-def get_head_of_chain(cursor, reg_no, date, follow_part_cans=False):
-    # reg_no/date could be anywhere in the 'chain', though typically would be the start
-    # as cancelled_by is a request_id, navigate by request_ids until we find the uncancelled
-    # head entry
-    cursor.execute('SELECT d.request_id, d.id FROM register r, register_details d '
-                   'WHERE registration_no=%(reg)s AND date=%(date)s AND r.details_id = d.id ' +
-                   'ORDER BY r.reg_sequence_no DESC ' +
-                   'FETCH FIRST 1 ROW ONLY',
-                   {"reg": reg_no, "date": date})
-    row = cursor.fetchone()
-    detail_id = row['id']  # row['request_id']
+DETAILS_COLUMNS = "r.registration_no, r.date, r.expired_on, rd.class_of_charge, rd.id, r.id as register_id, " \
+                  "rd.legal_body_ref, rd.cancelled_by, rd.amends, rd.request_id, rd.additional_info, rd.district, " \
+                  "rd.short_description, r.county_id, r.debtor_reg_name_id, rd.amendment_type, " \
+                  "rd.priority_notice_ind, rd.prio_notice_expires, rd.amend_info_type, " \
+                  "rd.amend_info_details, rd.amend_info_details_orig, r.reg_sequence_no, rd.priority_notice_no "
 
-    # start at request id; get id where amends_id = this-id
 
-    next_id = detail_id
-    while True:
-        # This is nasty, but the part cans exclusion was added to fix one bug, but in turn has broken
-        # additional information generation
-        if follow_part_cans:
-            cursor.execute('SELECT id FROM register_details WHERE amends = %(id)s', {"id": next_id})
-        else:
-            cursor.execute("SELECT id FROM register_details WHERE amends = %(id)s "
-                           " and amendment_type <> 'Part Cancellation' ", {"id": next_id})
-        rows = cursor.fetchall()
+def get_registration_details_bulk(cursor, register_ids):
+    # As get_registration_details_by_register_id, for many entries at once. Returns {register_id: details};
+    # ids that don't exist are left out.
+    register_ids = list(set(register_ids))
+    if len(register_ids) == 0:
+        return {}
 
-        if len(rows) == 0:
-            return next_id
+    cursor.execute("SELECT " + DETAILS_COLUMNS +
+                   "FROM register r, register_details rd "
+                   "WHERE r.id = ANY(%(ids)s) AND r.details_id = rd.id", {'ids': register_ids})
+    rows = cursor.fetchall()
+    related = load_detail_relations(cursor, rows)
 
-        if len(rows) > 1:
-            raise RuntimeError('Unexpected multiple amendment in get_head_of_chain')
+    results = {}
+    for row in rows:
+        results[row['register_id']] = build_details([row], related[row['register_id']], with_addl_class=True)
+    return results
 
-        next_id = rows[0]['id']
+
+def get_register_ids(cursor, registrations):
+    # Resolves [(reg_no, date)] to the register id get_registration_details would load for each - the
+    # highest sequence number. Returns {(reg_no, date): register_id} keyed by the values passed in.
+    if len(registrations) == 0:
+        return {}
+
+    cursor.execute("SELECT DISTINCT ON (k.idx) k.idx, r.id "
+                   "FROM unnest(%(nos)s::int[], %(dates)s::date[]) WITH ORDINALITY AS k(reg_no, date, idx), "
+                   "register r "
+                   "WHERE r.registration_no = k.reg_no AND r.date = k.date "
+                   "ORDER BY k.idx, r.reg_sequence_no DESC", {
+                       'nos': [reg[0] for reg in registrations],
+                       'dates': [reg[1] for reg in registrations]
+                   })
+    results = {}
+    for row in cursor.fetchall():
+        results[registrations[row['idx'] - 1]] = row['id']
+    return results
+
+
+def restrict_to_lead_county(details):
+    # The lead county alone, where the entry covers several; equivalent to get_county
+    # for details loaded by get_registration_details(_bulk)
+    if 'particulars' in details:
+        if 'counties' in details['particulars']:
+            if len(details['particulars']['counties']) > 1:
+                details['particulars']['counties'] = details['particulars']['counties'][:1]
+
+
+def get_head_of_chain(cursor, reg_no, date, follow_part_cans=False):
+    # reg_no/date could be anywhere in the 'chain', though typically would be the start.
+    # The part cans exclusion (follow_part_cans=False) was added to fix one bug, but in turn broke
+    # additional information generation, hence the option.
+    return find_head(cursor, reg_no, date, follow_part_cans)
 
 
 def get_request_id(cursor, details_id):
@@ -1373,18 +1449,19 @@ def supersede_register(cursor, registration_no, registration_date, original_deta
     # create a new row and associate it with the new details id.
     sql = "insert into register(registration_no, debtor_reg_name_id, details_id, date,  county_id, expired_on, " \
           " reg_sequence_no) values (%(registration_no)s, %(debtor_reg_name_id)s, %(details_id)s, %(date)s, " \
-          " %(county_id)s, %(exp)s, %(reg_sequence_no)s)"
+          " %(county_id)s, %(exp)s, %(reg_sequence_no)s) RETURNING id"
     cursor.execute(sql, {"registration_no": registration_no, "debtor_reg_name_id": debtor_reg_name_id,
                          "details_id": new_details_id, "date": registration_date, "county_id": county_id,
                          "exp": datetime.datetime.now().strftime('%Y-%m-%d'),
                          "reg_sequence_no": seq_no
                          })
+    refresh_search_index(cursor, [cursor.fetchone()[0]])
     # mark the superseded row as no_reveal
     mark_as_no_reveal_by_id(cursor, orig_register_id)
     return rows[0]
 
 
-def insert_cancellation(data, user_id):
+def insert_cancellation(data, user_id, publish=False):
     cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
     try:
         orig_registration_no = data["registration_no"]
@@ -1455,7 +1532,11 @@ def insert_cancellation(data, user_id):
         # Mark all cancellation registrations as no reveal.
         for reg in reg_nos:
             mark_as_no_reveal(cursor, reg['number'], reg['date'])
+        invalidate_additional_info(cursor, original_details_id)
+        invalidate_additional_info(cursor, canc_details_id)
         logging.audit(format_message("Cancelled entry: %s"), json.dumps(reg_nos))
+        if publish:
+            publish_cancellation(cursor, reg_nos)
         complete(cursor)
         logging.info(format_message("Cancellation committed"))
     except:
@@ -1484,29 +1565,19 @@ def insert_renewal(data, user_id):
     return len(reg_nos), reg_nos, renewal_request_id, original_regs
 
 
-def insert_lc_county(cursor, register_details_id, county):
-    county_id = get_county_id(cursor, county)
-    cursor.execute("INSERT INTO detl_county_rel (county_id, details_id) " +
-                   "VALUES( %(county_id)s, %(details_id)s ) RETURNING id",
-                   {
-                       "county_id": county_id, "details_id": register_details_id
-                   })
-    rows = cursor.fetchall()
-    if len(rows) == 0:
-        raise RuntimeError("Invalid county ID: {}".format(county))
-
-    return rows[0], county_id
+def get_county_ids(cursor, counties):
+    # Returns {upper-case county name: id} for all of counties
+    known = county_reference(cursor).ids_by_name
+    ids = {}
+    for county in counties:
+        if county.upper() not in known:
+            raise RuntimeError("Invalid county: {}".format(county))
+        ids[county.upper()] = known[county.upper()]
+    return ids
 
 
 def get_county_id(cursor, county):
-    cursor.execute("SELECT id FROM county WHERE UPPER(name) = %(county)s",
-                   {
-                       "county": county.upper()
-                   })
-    rows = cursor.fetchall()
-    if len(rows) == 0:
-        raise RuntimeError("Invalid county: {}".format(county))
-    return rows[0]['id']
+    return get_county_ids(cursor, [county])[county.upper()]
 
 
 def get_register_request_details(request_id):
@@ -1607,61 +1678,38 @@ def get_search_details(search_details_id):
                 'name': row['complex_name'],
                 'number': row['complex_number']
             }
-        results = []
-        cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
-
-        res_id_list = sorted(set(row['result'])) #  workaround to remove duplicates in search_results.result
-        for res_id in res_id_list:
-            details = get_registration_details_from_register_id(res_id)
-
-            results.append(details)
-
-        name_data['results'] = results
+        # search_results.result can repeat an id (an entry matched on more than one name or county); the
+        # certificate lists each once, by id
+        name_data['results'] = sorted(distinct_results(row['result']), key=result_id)
         sn_data.append(name_data)
+
+    cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
+    try:
+        all_ids = []
+        for name_data in sn_data:
+            all_ids += name_data['results']
+        details = get_registration_details_bulk(cursor, all_ids)
+        for res_data in details.values():
+            get_search_result_details(cursor, res_data)
+
+        for name_data in sn_data:
+            results = []
+            for res_id in name_data['results']:
+                if res_id not in details:
+                    raise RuntimeError("No registration found for register id {}".format(res_id))
+                results.append([details[res_id]])
+            name_data['results'] = results
+    finally:
         complete(cursor)
     return sn_data
 
 
-def get_registration_details_from_register_id(register_id):
-    cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
-    res_data = get_registration_details_by_register_id(cursor,register_id)
-    if 'particulars' in res_data:
-        if 'counties' in res_data['particulars']:
-            if len(res_data['particulars']['counties']) > 1:
-                county = get_county_by_reg_id(cursor, register_id)
-                res_data['particulars']['counties'] = county
+def get_search_result_details(cursor, res_data):
+    restrict_to_lead_county(res_data)
     addl_info = get_additional_info(cursor, res_data)
     if addl_info is not None:
         res_data['additional_information'] = addl_info
-    data = [res_data]
-    complete(cursor)
-
-    # cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
-    # sql = 'select registration_no, date from register where id = %(register_id)s '
-    # cursor.execute(sql, {"register_id": register_id})
-    # rows = cursor.fetchall()
-    # complete(cursor)
-    # results = []
-    # for row in rows:
-    #     results.append({
-    #         'number': str(row['registration_no']),
-    #         'date': str(row['date'])
-    #     })
-    # cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
-    # data = []
-    # for res in results:
-    #     res_data = get_registration_details(cursor, res['number'], res['date'])
-    #     if 'particulars' in res_data:
-    #         if 'counties' in res_data['particulars']:
-    #             if len(res_data['particulars']['counties']) > 1:
-    #                 county = get_county(cursor, res['number'], res['date'])
-    #                 res_data['particulars']['counties'] = county
-    #     addl_info = get_additional_info(cursor, res_data)
-    #     if addl_info is not None:
-    #         res_data['additional_information'] = addl_info
-    #     data.append(res_data)
-    # complete(cursor)
-    return data
+    return res_data
 
 
 def get_k22_request_id(registration_no, registration_date):
@@ -1682,79 +1730,8 @@ def get_k22_request_id(registration_no, registration_date):
     return data
 
 
-def get_entry_summary(cursor, details_id):
-    cursor.execute('SELECT r.registration_no, r.date, r.reg_sequence_no, r.expired_on, d.amendment_type, d.amends, '
-                   ' d.class_of_charge '
-                   'FROM register r, register_details d '
-                   'WHERE r.details_id = d.id AND d.id = %(did)s', {
-                       'did': details_id
-                   })
-    rows = cursor.fetchall()
-
-    if len(rows) == 0:
-        raise RuntimeError('No rows returned for id {}'.format(details_id))
-
-    # if len(rows) != 1:
-    #     raise RuntimeError("Unexpected return row count in get_entry_summary")
-    registrations = []
-    for row in rows:
-        registrations.append({
-            'number': row['registration_no'],
-            'date': row['date'].strftime('%Y-%m-%d'),
-            'sequence': row['reg_sequence_no']
-        })
-
-    data = {
-        'registrations': registrations,
-        'id': details_id,
-        'class_of_charge': rows[0]['class_of_charge'],
-        'application': "New Registration" if rows[0]['amendment_type'] is None else rows[0]['amendment_type'],
-        'amends': rows[0]['amends']
-    }
-
-    if rows[0]['expired_on'] is None:
-        data['expired_date'] = None
-    else:
-        data['expired_date'] = rows[0]['expired_on'].strftime("%Y-%m-%d")
-
-    return data
-
-
-def get_registration_history_from_details(cursor, details_id):
-    results = []
-    entry = get_entry_summary(cursor, details_id)
-    results.append(entry)
-
-    while entry['amends'] is not None:
-        entry = get_entry_summary(cursor, entry['amends'])
-        results.append(entry)
-
-    return results
-
-
 def get_registration_history(cursor, reg_no, date):
-    results = []
-    cursor.execute('SELECT details_id '
-                   'FROM register '
-                   'WHERE registration_no=%(reg_no)s AND date = %(date)s' +
-                   'ORDER BY reg_sequence_no DESC ' +
-                   'FETCH FIRST 1 ROW ONLY', {
-                       'date': date, 'reg_no': reg_no
-                   })
-    rows = cursor.fetchall()
-    if len(rows) > 1:
-        raise RuntimeError("Unexpected multiple return rows in get_registration_history")
-
-    if len(rows) == 0:
-        return []
-
-    entry = get_entry_summary(cursor, rows[0]['details_id'])
-    results.append(entry)
-    while entry['amends'] is not None:
-        entry = get_entry_summary(cursor, entry['amends'])
-        results.append(entry)
-
-    return results
+    return history_from_registration(cursor, reg_no, date)
 
 
 # There's a convention on how the additional information is to be recorded on the various
@@ -2056,7 +2033,67 @@ def get_migration_info(cursor, reg_no, date):
     return rows[0]['extra_data']
 
 
+additional_info_cache = LRUCache(app.config['ADDL_INFO_CACHE_SIZE'])
+
+
+# Additional information only changes when the entry's chain does, so it is cached against the chain's
+# version: in this process and, if ADDL_INFO_CACHE_TABLE is set, in the addl_info_cache table
 def get_additional_info(cursor, details):
+    reg_no = details['registration']['number']
+    date = details['registration']['date']
+    version = chain_version(cursor, reg_no, date)
+    if version is None:
+        return compute_additional_info(cursor, details)
+
+    chain_id, version = version
+    key = (details['details_id'], reg_no, date)
+    cached = additional_info_cache.get(key)
+    if cached is not None and cached[1] == version:
+        return cached[2]
+
+    if app.config['ADDL_INFO_CACHE_TABLE']:
+        cursor.execute("SELECT text FROM addl_info_cache WHERE details_id = %(did)s AND registration_no = %(no)s "
+                       "AND date = %(date)s AND chain_version = %(version)s", {
+                           'did': key[0], 'no': reg_no, 'date': date, 'version': version
+                       })
+        row = cursor.fetchone()
+        if row is not None:
+            additional_info_cache.put(key, (chain_id, version, row['text']))
+            return row['text']
+
+    addl_info = compute_additional_info(cursor, details)
+    additional_info_cache.put(key, (chain_id, version, addl_info))
+
+    if app.config['ADDL_INFO_CACHE_TABLE']:
+        # Another worker may be storing the same thing; losing that race is fine
+        cursor.execute("SAVEPOINT addl_info_cache")
+        try:
+            cursor.execute("DELETE FROM addl_info_cache WHERE details_id = %(did)s AND registration_no = %(no)s "
+                           "AND date = %(date)s", {'did': key[0], 'no': reg_no, 'date': date})
+            cursor.execute("INSERT INTO addl_info_cache (details_id, registration_no, date, chain_id, "
+                           "chain_version, text) VALUES (%(did)s, %(no)s, %(date)s, %(chain)s, %(version)s, %(text)s)",
+                           {
+                               'did': key[0], 'no': reg_no, 'date': date, 'chain': chain_id,
+                               'version': version, 'text': addl_info
+                           })
+            cursor.execute("RELEASE SAVEPOINT addl_info_cache")
+        except psycopg2.IntegrityError:
+            cursor.execute("ROLLBACK TO SAVEPOINT addl_info_cache")
+    return addl_info
+
+
+def invalidate_additional_info(cursor, details_id):
+    # Call after adding to or cancelling within the chain holding details_id. Other workers notice the
+    # change through the chain version.
+    chain_id = get_chain_id(cursor, details_id)
+    if chain_id is None:
+        return
+    additional_info_cache.discard_where(lambda key, value: value[0] == chain_id)
+    if app.config['ADDL_INFO_CACHE_TABLE']:
+        cursor.execute("DELETE FROM addl_info_cache WHERE chain_id = %(chain)s", {'chain': chain_id})
+
+
+def compute_additional_info(cursor, details):
     migrated = get_migration_info(cursor, details['registration']['number'], details['registration']['date'])
     # if migrated is not None:
     #     if 'amend_info' in migrated:
@@ -2065,10 +2102,8 @@ def get_additional_info(cursor, details):
     #         return ''
 
     # details is being passed in...
-    head_details_id = get_head_of_chain(cursor, details['registration']['number'],
-                                        details['registration']['date'], True)
-    logging.debug('Head is ' + str(head_details_id))
-    history = get_registration_history_from_details(cursor, head_details_id)
+    history = history_from_head(cursor, details['registration']['number'], details['registration']['date'], True)
+    logging.debug('Head is ' + str(history[0]['id']))
     # logging.debug(len(history))
     # logging.debug(history)
 
@@ -2171,43 +2206,15 @@ def get_multi_registrations(cursor, registration_date, registration_no):
     cursor.execute("select r.registration_no, r.date, r.reg_sequence_no, d.class_of_charge, d.amends, d.cancelled_by, "
                    "d.request_id, d.amendment_type, r.id as register_id "
                    " from register r, register_details d where r.details_id = d.id and "
-                   "r.date=%(date)s and r.registration_no=%(registration_no)s and cancelled_by is null ",
+                   "r.date=%(date)s and r.registration_no=%(registration_no)s and cancelled_by is null "
+                   "order by d.request_id, r.id",
                    {'date': registration_date, 'registration_no': registration_no})
     rows = cursor.fetchall()
     if len(rows) == 0:
         return []
 
-    results = []
-    max_seq = -1
-    for row in rows:
-        if row['reg_sequence_no'] > max_seq:
-            max_seq = row['reg_sequence_no']
-
-        request_id = row['request_id']
-        item = None
-        for r in results:
-            if r['id'] == request_id:
-                item = r
-                break
-        if item is None:
-            item = {
-                'application': '',
-                'id': request_id,
-                'data': []
-            }
-            results.append(item)
-
-        if row['amends'] is None:
-            item['application'] = 'new'
-        else:
-            item['application'] = row['amendment_type']  # 'amend'
-
-        item['data'].append({
-            'number': row['registration_no'],
-            'date': row['date'].strftime('%Y-%m-%d'),
-            'class_of_charge': row['class_of_charge'],
-            'register_id': row["register_id"]
-        })
+    max_seq = max(row['reg_sequence_no'] for row in rows)
+    results = group_by_request(rows, with_register_id=True)
 
     logging.debug('GET ADDITIONAL CLASSES')
     if max_seq == 1:
@@ -2246,15 +2253,6 @@ def get_multi_registrations(cursor, registration_date, registration_no):
     return results
 
 
-def get_county_by_reg_id(cursor, reg_id):
-    sql = "select a.name from county a, register b where b.id=%(reg)s " \
-          " and b.county_id = a.id;"
-    cursor.execute(sql, {"reg": reg_id})
-    row = cursor.fetchone()
-    county = row['name']
-    return [county]
-
-
 def get_county(cursor, reg_no, reg_date):
     sql = "select max(reg_sequence_no) as seq_no from register where registration_no=%(reg)s AND date=%(date)s"
     cursor.execute(sql, {"reg": reg_no, "date": reg_date})
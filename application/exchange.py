@@ -1,12 +1,139 @@
 import kombu
-from kombu.common import maybe_declare
-import sys
+import os
+import json
+import time
+import queue
+import atexit
+import threading
 import logging
-from application.logformat import format_message
+import psycopg2.extras
+from application.pool import get_pool
+
+
+class ErrorPublisher(object):
+    # Puts errors on the 'errors' queue from a background thread over one long-lived connection, so neither
+    # the request thread nor the broker pays for a connection per error. If the broker is unavailable the
+    # thread keeps retrying (backing off up to retry_seconds) while errors wait in a bounded buffer; once that
+    # is full, further errors are dropped - they have already been logged by the caller.
+    def __init__(self, uri, queue_name='errors', max_pending=1000, retry_seconds=30):
+        self.uri = uri
+        self.queue_name = queue_name
+        self.retry_seconds = retry_seconds
+        self.pending = queue.Queue(max_pending)
+        self.pid = os.getpid()
+        self.published = 0
+        self.dropped = 0
+        self._connection = None
+        self._simple_queue = None
+        self._thread = None
+        self._stop = object()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    def publish(self, error):
+        self._ensure_started()
+        try:
+            self.pending.put_nowait(error)
+        except queue.Full:
+            self.dropped += 1
+            logging.error('Error publication buffer full; error not queued')
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='error-publisher', daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while True:
+            error = self.pending.get()
+            try:
+                if error is self._stop:
+                    self._disconnect()
+                    return
+                self._publish_with_retry(error)
+            finally:
+                self.pending.task_done()
+
+    def _publish_with_retry(self, error):
+        # Once stopping, each error still gets one attempt; only the retries are skipped
+        delay = min(0.5, self.retry_seconds)
+        while True:
+            try:
+                if self._simple_queue is None:
+                    self._connection = kombu.Connection(hostname=self.uri)
+                    self._connection.ensure_connection(max_retries=1)
+                    self._simple_queue = self._connection.SimpleQueue(self.queue_name)
+                self._simple_queue.put(error)
+                self.published += 1
+                return
+            except Exception as e:
+                self._disconnect()
+                if self._stopping.is_set():
+                    self.dropped += 1
+                    logging.warning('Unable to publish error while stopping; dropped: %s', e)
+                    return
+                logging.warning('Unable to publish error, retrying in %.1fs: %s', delay, e)
+                self._stopping.wait(delay)
+                delay = min(delay * 2, self.retry_seconds)
+
+    def _disconnect(self):
+        try:
+            if self._simple_queue is not None:
+                self._simple_queue.close()
+            if self._connection is not None:
+                self._connection.release()
+        except Exception:
+            pass
+        self._simple_queue = None
+        self._connection = None
+
+    def flush(self):
+        # Blocks until everything queued so far has been published
+        if self._thread is not None:
+            self.pending.join()
+
+    def stop(self, timeout=5):
+        # Gives whatever is queued up to timeout seconds to go (one attempt each), but stops retrying an
+        # unavailable broker
+        if self._thread is not None and self.pid == os.getpid():
+            self._stopping.set()
+            try:
+                self.pending.put(self._stop, timeout=timeout)
+            except queue.Full:
+                return
+            self._thread.join(timeout)
+
+
+_error_publisher = None
+_error_publisher_lock = threading.Lock()
+
+
+def get_error_publisher(config):
+    # One per worker process; one inherited across a fork has no thread or connection, so start afresh
+    global _error_publisher
+    pid = os.getpid()
+    if _error_publisher is None or _error_publisher.pid != pid:
+        with _error_publisher_lock:
+            if _error_publisher is None or _error_publisher.pid != pid:
+                _error_publisher = ErrorPublisher(config['AMQP_URI'],
+                                                  max_pending=config['ERROR_PUBLISH_BUFFER'],
+                                                  retry_seconds=config['ERROR_PUBLISH_RETRY_SECONDS'])
+    return _error_publisher
+
+
+def stop_error_publisher():
+    if _error_publisher is not None:
+        _error_publisher.stop()
+
+
+atexit.register(stop_error_publisher)
 
 
 def setup_messaging(config):
-    pass
+    global record_events
+    record_events = config['OUTBOX_RELAY']
     # if 'MQ_USERNAME' in config:
     #     host = "amqp://{}:{}@{}:{}".format(config['MQ_USERNAME'], config['MQ_PASSWORD'], config['MQ_HOSTNAME'],
     #                                        config['MQ_PORT'])
@@ -25,35 +152,180 @@ def setup_messaging(config):
     #     return None
 
 
-def publish_new_bankruptcy(producer, data):
-    pass
-    # if producer is not None:
-    #     publish = {
-    #         "application": "new",
-    #         "data": data
-    #     }
-    #     logging.info("Sending: %s", publish)
-    #     producer.publish(publish)
-    # else:
-    #     logging.info("Suppressing publication")
-
-def publish_amendment(producer, data):
-    pass
-    # if producer is not None:
-    #     publish = {
-    #         "application": "amend",
-    #         "data": data
-    #     }
-    #     logging.info("Sending: %s", publish)
-    #     producer.publish(publish)
-
-
-def publish_cancellation(producer, data):
-    pass
-    # if producer is not None:
-    #     publish = {
-    #         "application": "cancel",
-    #         "data": data
-    #     }
-    #     logging.info("Sending: %s", publish)
-    #     producer.publish(publish)
+# Events for the new.bankruptcy exchange go through event_outbox: publish_* add a row in the caller's
+# transaction, so an event exists if and only if the change it describes was committed, and OutboxRelay
+# publishes the rows afterwards. Only one relay at a time (across all workers) holds OUTBOX_RELAY_LOCK, and
+# it publishes in id order, so events for the same registration arrive in the order they were committed. A
+# row is marked published only after the broker has accepted it, which makes delivery at-least-once:
+# consumers should de-duplicate on the event_id header.
+#
+# Retention: the active relay deletes published rows once they are OUTBOX_RETENTION_HOURS old; unpublished rows
+# stay until a relay publishes them. With OUTBOX_RELAY off nothing would ever publish or delete the rows, so no
+# events are recorded at all (as before the outbox, publication is simply suppressed). Rows left unpublished
+# when the relay is switched off are sent once it is switched back on.
+
+# Advisory lock class for the relay; distinct from data.REGISTER_SEQUENCE_LOCK
+OUTBOX_RELAY_LOCK = 2
+
+# Set from OUTBOX_RELAY by setup_messaging
+record_events = False
+
+
+def write_event(cursor, application, data):
+    if not record_events:
+        logging.info("Suppressing publication: no outbox relay")
+        return
+    cursor.execute("INSERT INTO event_outbox (application, payload) VALUES (%(application)s, %(payload)s)", {
+        'application': application, 'payload': json.dumps(data)
+    })
+
+
+def publish_new_bankruptcy(cursor, data):
+    write_event(cursor, 'new', data)
+
+
+def publish_amendment(cursor, data):
+    write_event(cursor, 'amend', data)
+
+
+def publish_cancellation(cursor, data):
+    write_event(cursor, 'cancel', data)
+
+
+def relay_batch(cursor, producer, batch_size):
+    # Publishes up to batch_size unpublished events and marks them published in cursor's transaction, which
+    # the caller commits (even if publishing failed part way, so the ones that went aren't sent again).
+    # Returns the number published; 0 when another relay holds the lock.
+    cursor.execute("SELECT pg_try_advisory_xact_lock(%(lock_class)s, 0) AS locked",
+                   {'lock_class': OUTBOX_RELAY_LOCK})
+    if not cursor.fetchone()['locked']:
+        return 0
+
+    cursor.execute("SELECT id, application, payload FROM event_outbox WHERE published_at IS NULL "
+                   "ORDER BY id FETCH FIRST %(limit)s ROWS ONLY", {'limit': batch_size})
+    rows = cursor.fetchall()
+
+    published = []
+    try:
+        for row in rows:
+            producer.publish({'application': row['application'], 'data': row['payload']},
+                             headers={'event_id': row['id']})
+            published.append(row['id'])
+    finally:
+        if len(published) > 0:
+            cursor.execute("UPDATE event_outbox SET published_at = now() WHERE id = ANY(%(ids)s)",
+                           {'ids': published})
+    return len(published)
+
+
+def expire_events(cursor, hours):
+    cursor.execute("DELETE FROM event_outbox WHERE published_at < now() - %(hours)s * interval '1 hour'",
+                   {'hours': hours})
+
+
+class OutboxRelay(object):
+    def __init__(self, config):
+        self.config = config
+        self.uri = config['AMQP_URI']
+        self.batch_size = config['OUTBOX_BATCH_SIZE']
+        self.poll_seconds = config['OUTBOX_POLL_SECONDS']
+        self.retention_hours = config['OUTBOX_RETENTION_HOURS']
+        self.pid = os.getpid()
+        self.published = 0
+        self._connection = None
+        self._producer = None
+        self._thread = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._last_expiry = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='outbox-relay', daemon=True)
+                    self._thread.start()
+
+    def wake(self):
+        # Called after committing an event, so it doesn't wait for the next poll
+        self._wake.set()
+
+    def stop(self, timeout=5):
+        if self._thread is not None and self.pid == os.getpid():
+            self._stopping.set()
+            self._wake.set()
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                count = self.relay()
+            except Exception as e:
+                logging.warning('Outbox relay failed: %s', e)
+                self._disconnect()
+                count = 0
+            if count < self.batch_size:
+                self._wake.wait(self.poll_seconds)
+                self._wake.clear()
+
+    def get_producer(self):
+        if self._producer is None:
+            self._connection = kombu.Connection(hostname=self.uri, transport_options={'confirm_publish': True})
+            self._connection.ensure_connection(max_retries=1)
+            exchange = kombu.Exchange(type="topic", name="new.bankruptcy", delivery_mode='persistent')
+            self._producer = kombu.Producer(self._connection.channel(), exchange=exchange, routing_key='simple',
+                                            serializer='json')
+        return self._producer
+
+    def _disconnect(self):
+        try:
+            if self._connection is not None:
+                self._connection.release()
+        except Exception:
+            pass
+        self._connection = None
+        self._producer = None
+
+    def relay(self):
+        pool = get_pool(self.config)
+        connection = pool.checkout()
+        try:
+            cursor = connection.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            try:
+                count = relay_batch(cursor, self.get_producer(), self.batch_size)
+                if count == 0 and time.monotonic() - self._last_expiry > 600:
+                    expire_events(cursor, self.retention_hours)
+                    self._last_expiry = time.monotonic()
+            finally:
+                connection.commit()
+                cursor.close()
+        finally:
+            pool.release(connection)
+        self.published += count
+        return count
+
+
+_outbox_relay = None
+_outbox_relay_lock = threading.Lock()
+
+
+def get_outbox_relay(config):
+    # One per worker process, started on first use when OUTBOX_RELAY is set; see get_error_publisher
+    global _outbox_relay
+    pid = os.getpid()
+    if _outbox_relay is None or _outbox_relay.pid != pid:
+        with _outbox_relay_lock:
+            if _outbox_relay is None or _outbox_relay.pid != pid:
+                _outbox_relay = OutboxRelay(config)
+                if config['OUTBOX_RELAY']:
+                    _outbox_relay.start()
+    return _outbox_relay
+
+
+def stop_outbox_relay():
+    if _outbox_relay is not None:
+        _outbox_relay.stop()
+
+
+atexit.register(stop_outbox_relay)
@@ -0,0 +1,123 @@
+# Dependency checks for GET /health. Load balancers poll it every few seconds from every instance, so a
+# result is reused for HEALTH_CACHE_SECONDS and only one request at a time actually probes; the others wait
+# for (and share) its result.
+import threading
+import time
+import datetime
+import logging
+import kombu
+import psycopg2
+from application import app
+from application.pool import get_pool, pool_stats
+
+
+def elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+def check_postgres():
+    start = time.perf_counter()
+    result = {'status': 'OK'}
+    timeout = app.config['HEALTH_PROBE_TIMEOUT']
+    try:
+        # Bounded waits throughout: for a pooled connection, then for the query. A full pool or a hung
+        # database fails the probe within HEALTH_PROBE_TIMEOUT rather than holding up every poll behind it.
+        pool = get_pool(app.config)
+        connection = pool.checkout(timeout)
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SET LOCAL statement_timeout = %(ms)s", {'ms': int(timeout * 1000)})
+            # Replication lag only means something on a standby; on the primary it is reported as None
+            cursor.execute("SELECT pg_is_in_recovery(), "
+                           "EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())")
+            in_recovery, lag = cursor.fetchone()
+            cursor.close()
+        finally:
+            # Rolls back the probe's transaction
+            pool.release(connection)
+        result['replica'] = in_recovery
+        result['replication_lag_seconds'] = float(lag) if in_recovery and lag is not None else None
+    except (psycopg2.Error, RuntimeError) as e:  # RuntimeError covers PoolTimeout
+        result = {'status': 'Error', 'error': str(e)}
+    result['latency_ms'] = elapsed_ms(start)
+
+    stats = pool_stats()
+    if stats is not None:
+        result['pool'] = {
+            'in_use': stats['in_use'],
+            'idle': stats['idle'],
+            'max_size': stats['max_size'],
+            'saturation': round(stats['in_use'] / stats['max_size'], 3),
+            'waits': stats['waits'],
+            'timeouts': stats['timeouts']
+        }
+    return result
+
+
+def check_amqp():
+    # The queue raise_error publishes to; its depth is a rough measure of how much is going wrong
+    start = time.perf_counter()
+    result = {'status': 'OK'}
+    try:
+        # ensure_connection(max_retries=1) makes two attempts; with no wait between them, each gets half the budget
+        with kombu.Connection(hostname=app.config['AMQP_URI'],
+                              connect_timeout=app.config['HEALTH_PROBE_TIMEOUT'] / 2) as connection:
+            connection.ensure_connection(max_retries=1, interval_start=0, interval_step=0, interval_max=0)
+            queue = connection.SimpleQueue('errors')
+            result['errors_queue_depth'] = queue.qsize()
+            queue.close()
+    except Exception as e:
+        result = {'status': 'Error', 'error': str(e)}
+    result['latency_ms'] = elapsed_ms(start)
+    return result
+
+
+CHECKS = {
+    'postgres': check_postgres,
+    'amqp': check_amqp
+}
+
+# Without these the service can't serve requests. Anything else failing (AMQP only carries raised errors)
+# leaves it 'Degraded', which GET /health still answers with a 200 so load balancers keep the node in service.
+CRITICAL = ['postgres']
+
+_cached = None          # (result, time.monotonic() when checked)
+_probe_lock = threading.Lock()
+
+
+def run_checks():
+    dependencies = {}
+    for name, check in CHECKS.items():
+        dependencies[name] = check()
+        if dependencies[name]['status'] != 'OK':
+            logging.warning('Health check failed for %s: %s', name, dependencies[name].get('error'))
+
+    if all(d['status'] == 'OK' for d in dependencies.values()):
+        status = 'OK'
+    elif any(dependencies[name]['status'] != 'OK' for name in CRITICAL if name in dependencies):
+        status = 'Error'
+    else:
+        status = 'Degraded'
+    return {
+        'status': status,
+        'checked_at': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'dependencies': dependencies
+    }
+
+
+def get_health():
+    # Returns (result, age in seconds of the result)
+    global _cached
+    ttl = app.config['HEALTH_CACHE_SECONDS']
+    with _probe_lock:
+        now = time.monotonic()
+        if _cached is None or now - _cached[1] >= ttl:
+            _cached = (run_checks(), time.monotonic())
+            now = _cached[1]
+        return _cached[0], now - _cached[1]
+
+
+def clear_health_cache():
+    global _cached
+    with _probe_lock:
+        _cached = None
@@ -0,0 +1,78 @@
+# Cursor instrumentation. connect() hands out cursors whose execute() times each statement and reports it
+# (with its row count and a fingerprint) through logformat.record_query, which keeps the per-request totals.
+# Statements slower than SLOW_QUERY_MS are logged as warnings, by fingerprint only, so no parameter values
+# (names, addresses) reach the logs.
+import functools
+import logging
+import re
+import time
+import psycopg2.extensions
+from flask import current_app, has_app_context
+from application.logformat import record_query
+
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER_LITERAL = re.compile(r"\b\d+(?:\.\d+)?\b")
+PLACEHOLDER = re.compile(r"%\(\w+\)s|%s")
+REPEATED_TUPLES = re.compile(r"\(\?(?:, \?)*\)(?:,\s*\(\?(?:, \?)*\))+")
+REPEATED_VALUES = re.compile(r"\?(?:\s*,\s*\?)+")
+WHITESPACE = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=1024)
+def fingerprint(sql):
+    # The statement with literals and parameters replaced by '?' and lists of them collapsed, so that the
+    # same query with different values (or a different number of VALUES rows) has the same fingerprint
+    result = STRING_LITERAL.sub('?', sql)
+    result = PLACEHOLDER.sub('?', result)
+    result = NUMBER_LITERAL.sub('?', result)
+    result = WHITESPACE.sub(' ', result).strip()
+    result = REPEATED_TUPLES.sub('(?)...', result)
+    return REPEATED_VALUES.sub('?...', result)
+
+
+def statement_text(sql):
+    if isinstance(sql, bytes):
+        return sql.decode('utf-8', 'replace')
+    return str(sql)
+
+
+def slow_query_ms():
+    return current_app.config['SLOW_QUERY_MS'] if has_app_context() else None
+
+
+class InstrumentedCursorMixin(object):
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._record(query, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._record(query, time.perf_counter() - start)
+
+    def _record(self, query, duration):
+        # rowcount is -1 for named cursors and failed statements
+        rows = self.rowcount if self.rowcount >= 0 else None
+        statement = fingerprint(statement_text(query))
+        record_query(duration, rows, statement)
+
+        threshold = slow_query_ms()
+        if threshold is not None and duration * 1000 >= threshold:
+            logging.warning('Slow query %.1fms (%s rows): %s', duration * 1000, rows, statement)
+
+
+_instrumented = {}
+
+
+def instrumented(cursor_factory=None):
+    # The instrumented subclass of a cursor class (the plain psycopg2 cursor when None)
+    base = psycopg2.extensions.cursor if cursor_factory is None else cursor_factory
+    if base not in _instrumented:
+        _instrumented[base] = type('Instrumented' + base.__name__, (InstrumentedCursorMixin, base), {})
+    return _instrumented[base]
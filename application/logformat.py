@@ -1,13 +1,73 @@
-from flask import request
+from flask import request, g, has_request_context, current_app
+import time
+
+
+def start_request():
+    # Called from before_request: everything the log lines of this request need, read from the headers once
+    g.transaction_id = request.headers.get('X-Transaction-ID', '')
+    g.user = request.headers.get('X-LC-Username', '?')
+    g.request_start = time.perf_counter()
+    g.db_time = 0.0
+    g.query_count = 0
+    g.rows_fetched = 0
+    g.queries = {}
+
+
+def record_query(duration, rows, statement=None):
+    # Called by the instrumented cursors after each statement; duration in seconds, statement a fingerprint.
+    # A no-op outside a request (manage.py commands, the consumer).
+    if has_request_context() and 'query_count' in g:
+        g.db_time += duration
+        g.query_count += 1
+        if rows is not None and rows > 0:
+            g.rows_fetched += rows
+        if statement is not None:
+            totals = g.queries.setdefault(statement, [0, 0.0])
+            totals[0] += 1
+            totals[1] += duration
+
+
+def repeated_queries(minimum=2):
+    # [(fingerprint, count, seconds)] for statements run at least minimum times this request, most frequent
+    # first: how N+1 loops show up
+    if 'queries' not in g:
+        return []
+    repeated = [(statement, count, seconds) for statement, (count, seconds) in g.queries.items() if count >= minimum]
+    return sorted(repeated, key=lambda item: -item[1])
+
+
+def log_context():
+    # Attached to every log record created during a request (see log.logger.set_context_provider)
+    if has_request_context() and 'user' in g:
+        return {'transaction_id': g.transaction_id, 'user': g.user}
+    return None
+
+
+def request_summary(response):
+    if 'request_start' not in g:
+        start_request()
+    return {
+        'endpoint': request.endpoint,
+        'route': None if request.url_rule is None else request.url_rule.rule,
+        'http_method': request.method,
+        'status': response.status_code,
+        'latency_ms': round((time.perf_counter() - g.request_start) * 1000, 3),
+        'db_time_ms': round(g.db_time * 1000, 3),
+        'query_count': g.query_count,
+        'rows_fetched': g.rows_fetched
+    }
 
 
 def format_message(message):
-    transid = ''
-    if 'X-Transaction-ID' in request.headers:
-        transid = "T:{}".format(request.headers['X-Transaction-ID'])
+    if 'user' not in g:
+        start_request()
+
+    # In JSON mode the transaction id and user are fields of their own
+    if current_app.config['LOG_FORMAT'] == 'json':
+        return message
 
-    userstr = 'U:?'
-    if 'X-LC-Username' in request.headers:
-        userstr = "U:{}".format(request.headers['X-LC-Username'])
+    transid = ''
+    if g.transaction_id != '':
+        transid = "T:{}".format(g.transaction_id)
 
-    return "{} {} {}".format(transid, userstr, message)
+    return "{} U:{} {}".format(transid, g.user, message)
@@ -0,0 +1,92 @@
+# Prometheus metrics, served by GET /metrics. Under gunicorn each worker is a separate process, so set
+# PROMETHEUS_MULTIPROC_DIR (to an empty directory, before the workers start): prometheus_client then writes
+# every worker's samples there and /metrics, whichever worker serves it, aggregates them all. The gunicorn
+# child_exit hook should call mark_worker_dead(worker.pid) so its live gauges are dropped.
+import os
+import threading
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, generate_latest, \
+    CONTENT_TYPE_LATEST, multiprocess
+
+
+REQUEST_LATENCY = Histogram('lc_request_latency_seconds', 'Request latency by Flask endpoint',
+                            ['endpoint', 'method', 'status'])
+
+APPLICATIONS_COMMITTED = Counter('lc_applications_committed_total',
+                                 'Registrations, rectifications, cancellations and renewals committed',
+                                 ['application'])
+ENTRIES_COMMITTED = Counter('lc_entries_committed_total', 'Register entries created, by application',
+                            ['application'])
+
+SEARCHES = Counter('lc_searches_total', 'Searches performed', ['search_type'])
+SEARCH_HITS = Histogram('lc_search_hits', 'Registrations found per search', ['search_type'],
+                        buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, float('inf')))
+
+# The registration counter row and the per-number advisory lock in insert_registration
+REGISTER_LOCK_WAIT = Histogram('lc_register_lock_wait_seconds',
+                               'Time insert_registration spends allocating a number and taking its lock',
+                               buckets=(.001, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, float('inf')))
+
+REFERENCE_CACHE_LOOKUPS = Counter('lc_reference_cache_lookups_total', 'Reference data cache lookups, by hit or miss',
+                                  ['cache', 'result'])
+
+POOL_CONNECTIONS = Gauge('lc_db_pool_connections', 'Pooled database connections by state', ['state'],
+                         multiprocess_mode='livesum')
+POOL_EVENTS = Counter('lc_db_pool_events', 'Pool checkouts, waits and timeouts', ['event'])
+POOL_WAIT = Counter('lc_db_pool_wait_seconds', 'Time spent waiting for a pooled connection')
+
+# The pool keeps running totals; the counters are advanced by how much each has grown since it was last seen
+_pool_totals = {}       # total -> value last added, for the pool of the process in _pool_totals_pid
+_pool_totals_pid = None
+_pool_totals_lock = threading.Lock()
+
+
+def observe_request(endpoint, method, status, seconds):
+    REQUEST_LATENCY.labels(endpoint or 'none', method, str(status)).observe(seconds)
+
+
+def count_committed(application, entries):
+    APPLICATIONS_COMMITTED.labels(application).inc()
+    ENTRIES_COMMITTED.labels(application).inc(entries)
+
+
+def count_search(search_type, hits):
+    SEARCHES.labels(search_type).inc()
+    SEARCH_HITS.labels(search_type).observe(hits)
+
+
+def update_pool_metrics(stats):
+    # stats: pool.pool_stats(), None until this worker has opened its pool
+    if stats is None:
+        return
+    POOL_CONNECTIONS.labels('in_use').set(stats['in_use'])
+    POOL_CONNECTIONS.labels('idle').set(stats['idle'])
+    POOL_CONNECTIONS.labels('max').set(stats['max_size'])
+    global _pool_totals_pid
+    with _pool_totals_lock:
+        if _pool_totals_pid != os.getpid():  # A forked worker's pool starts from nothing
+            _pool_totals.clear()
+            _pool_totals_pid = os.getpid()
+        for total, counter in [('checkouts', POOL_EVENTS.labels('checkouts')),
+                               ('waits', POOL_EVENTS.labels('waits')),
+                               ('timeouts', POOL_EVENTS.labels('timeouts')),
+                               ('wait_time', POOL_WAIT)]:
+            value = stats[total]
+            last = _pool_totals.get(total, 0)
+            # A total below the last one seen means the pool was replaced, so its totals restarted
+            counter.inc(value - last if value >= last else value)
+            _pool_totals[total] = value
+
+
+def render_metrics():
+    # Returns (body, content type)
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def mark_worker_dead(pid):
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid)
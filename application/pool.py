@@ -0,0 +1,230 @@
+# Connection pooling for the data layer. Every route goes through data.connect/complete/rollback, so
+# pooling lives behind those three calls and the route code doesn't need to know about it.
+# Each gunicorn worker gets its own pool (connections can't be shared across a fork), created lazily
+# on first use in that process.
+import os
+import time
+import threading
+import weakref
+import logging
+import psycopg2
+import psycopg2.extensions
+
+
+class PoolTimeout(RuntimeError):
+    pass
+
+
+class ConnectionPool(object):
+    def __init__(self, dsn, min_size=1, max_size=10, timeout=30, idle_timeout=300, ping_interval=30):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        self.pid = os.getpid()
+
+        self._idle = []         # [(connection, time_returned)], most recently returned last
+        self._in_use = {}       # id(connection) -> finalizer on the cursor handed out
+        self._size = 0
+        self._reclaimed = []    # connections from cursors dropped without complete/rollback
+        self._cond = threading.Condition(threading.Lock())
+
+        self.checkouts = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.checkout_time = 0.0
+        self.discarded = 0
+        self.reaped = 0
+
+    def _open(self):
+        return psycopg2.connect(self.dsn)
+
+    def _discard(self, connection):
+        # Caller holds the lock
+        self._size -= 1
+        self.discarded += 1
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def _healthy(self, connection, idle_since):
+        if connection.closed:
+            return False
+        if time.time() - idle_since < self.ping_interval:
+            return True
+        try:
+            cur = connection.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _reap(self):
+        # Caller holds the lock. Close connections that have sat idle too long, keeping min_size open.
+        now = time.time()
+        keep = []
+        for connection, idle_since in self._idle:
+            if now - idle_since > self.idle_timeout and self._size > self.min_size:
+                self._discard(connection)
+                self.reaped += 1
+            else:
+                keep.append((connection, idle_since))
+        self._idle = keep
+
+    def checkout(self, timeout=None):
+        # timeout: how long to wait for a free connection, if not the pool's own
+        if timeout is None:
+            timeout = self.timeout
+        self._release_reclaimed()
+        start = time.time()
+        waited = False
+        while True:
+            with self._cond:
+                self._reap()
+                if self._idle:
+                    connection, idle_since = self._idle.pop()
+                elif self._size < self.max_size:
+                    self._size += 1
+                    connection, idle_since = None, None
+                else:
+                    remaining = timeout - (time.time() - start)
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise PoolTimeout('Timed out waiting for a database connection ({} in use)'.format(
+                            len(self._in_use)))
+                    waited = True
+                    self._cond.wait(remaining)
+                    continue
+
+            if connection is None:
+                try:
+                    connection = self._open()
+                except:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._healthy(connection, idle_since):
+                logging.warning('Discarding unhealthy pooled connection')
+                with self._cond:
+                    self._discard(connection)
+                continue
+
+            break
+
+        elapsed = time.time() - start
+        with self._cond:
+            self.checkouts += 1
+            self.checkout_time += elapsed
+            if waited:
+                self.waits += 1
+                self.wait_time += elapsed
+                self.max_wait_time = max(self.max_wait_time, elapsed)
+        return connection
+
+    def cursor(self, cursor_factory=None):
+        connection = self.checkout()
+        try:
+            cursor = connection.cursor(cursor_factory=cursor_factory)
+        except:
+            self.release(connection, discard=True)
+            raise
+
+        # Should a caller drop a cursor without calling complete/rollback, put its connection back
+        # rather than leaking a pool slot forever.
+        with self._cond:
+            self._in_use[id(connection)] = weakref.finalize(cursor, self._reclaim, connection)
+        return cursor
+
+    def _reclaim(self, connection):
+        # Runs from the garbage collector, possibly while this thread holds the lock, so just note the
+        # connection and let the next checkout put it back.
+        self._reclaimed.append(connection)
+
+    def _release_reclaimed(self):
+        while self._reclaimed:
+            connection = self._reclaimed.pop()
+            logging.warning('Reclaiming database connection that was not released')
+            self.release(connection)
+
+    def release(self, connection, discard=False):
+        if os.getpid() != self.pid:
+            return
+
+        with self._cond:
+            finalizer = self._in_use.pop(id(connection), None)
+        if finalizer is not None:
+            finalizer.detach()
+
+        if not discard and not connection.closed:
+            try:
+                if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+            except psycopg2.Error:
+                discard = True
+        else:
+            discard = True
+
+        with self._cond:
+            if discard:
+                self._discard(connection)
+            else:
+                self._idle.append((connection, time.time()))
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            for connection, idle_since in self._idle:
+                self._discard(connection)
+            self._idle = []
+
+    def stats(self):
+        with self._cond:
+            return {
+                'size': self._size,
+                'in_use': len(self._in_use),
+                'idle': len(self._idle),
+                'max_size': self.max_size,
+                'checkouts': self.checkouts,
+                'checkout_time': self.checkout_time,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+                'timeouts': self.timeouts,
+                'discarded': self.discarded,
+                'reaped': self.reaped
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool(config):
+    global _pool
+    pid = os.getpid()
+    if _pool is None or _pool.pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool.pid != pid:
+                # A pool inherited across a fork is simply abandoned; closing its sockets here
+                # would terminate the parent's sessions.
+                _pool = ConnectionPool(config['PSQL_CONNECTION'],
+                                       min_size=config['DB_POOL_MIN_SIZE'],
+                                       max_size=config['DB_POOL_MAX_SIZE'],
+                                       timeout=config['DB_POOL_TIMEOUT'],
+                                       idle_timeout=config['DB_POOL_IDLE_TIMEOUT'],
+                                       ping_interval=config['DB_POOL_PING_INTERVAL'])
+    return _pool
+
+
+def pool_stats():
+    if _pool is None or _pool.pid != os.getpid():
+        return None
+    return _pool.stats()
@@ -1,25 +1,34 @@
-from application import app, producer
-from application.exchange import publish_new_bankruptcy, publish_amendment, publish_cancellation
-from application.logformat import format_message
-from flask import Response, request, g
+from application import app
+from application.exchange import publish_new_bankruptcy, publish_amendment, get_error_publisher, get_outbox_relay
+from application.logformat import format_message, start_request, request_summary, log_context, \
+    repeated_queries
+from flask import Response, request, g, stream_with_context
 import psycopg2
 import psycopg2.extras
 import json
 import logging
 import traceback
-import kombu
 from jsonschema import validate
 from jsonschema.exceptions import ValidationError
 from application.data import connect, get_registration_details, complete, \
     get_registration, insert_cancellation,  \
     insert_rectification, insert_new_registration, get_register_request_details, get_search_request_details, rollback, \
     get_registrations_by_date, get_all_registrations, get_k22_request_id, get_registration_history, \
-    get_additional_info, get_multi_registrations, insert_renewal, get_county, get_applicant_detl, get_registration_details_by_register_id
+    get_additional_info, get_multi_registrations, insert_renewal, get_applicant_detl, get_registration_details_by_register_id, \
+    get_registration_details_bulk, get_register_ids, restrict_to_lead_county, get_registrations_page, \
+    iter_all_registrations
 from application.schema import SEARCH_SCHEMA, validate, validate_registration, validate_migration, validate_update
 from application.search import store_search_request, perform_search, store_search_result, read_searches, \
     get_search_by_request_id, get_search_ids_by_date
 from application.oc import get_ins_office_copy
 import datetime
+import copy
+from log.logger import set_context_provider
+from application.pool import pool_stats
+from application.health import get_health
+from application.counties import county_reference, invalidate_counties, preload_counties
+from application.metrics import observe_request, count_committed, count_search, update_pool_metrics, render_metrics
+from urllib.parse import urlencode
 
 
 @app.route('/', methods=["GET"])
@@ -29,18 +38,21 @@ def index():
 
 @app.route('/health', methods=['GET'])
 def health():
-    result = {
-        'status': 'OK',
-        'dependencies': {}
-    }
-    return Response(json.dumps(result), status=200, mimetype='application/json')
+    result, age = get_health()
+    result = dict(result, cache_age_seconds=round(age, 3))
+    status = 500 if result['status'] == 'Error' else 200
+    return Response(json.dumps(result), status=status, mimetype='application/json')
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    body, content_type = render_metrics()
+    return Response(body, status=200, mimetype=content_type)
 
 
 def raise_error(error):
-    hostname = app.config['AMQP_URI']
-    connection = kombu.Connection(hostname=hostname)
-    connection.SimpleQueue('errors').put(error)
-    logging.warning(format_message('Error successfully raised.'))
+    get_error_publisher(app.config).publish(error)
+    logging.warning(format_message('Error queued for raising.'))
     logging.error(format_message(error))
 
 
@@ -68,18 +80,35 @@ def error_handler(err):
     return Response(json.dumps(error), status=500)
 
 
+set_context_provider(log_context)
+
+
 @app.before_request
 def before_request():
     # logging.info(format_message("BEGIN %s %s [%s]"),
     #             request.method, request.url, request.remote_addr)
-
-    pass
+    start_request()
+    get_outbox_relay(app.config)
 
 
 @app.after_request
 def after_request(response):
-    logging.info('END %s %s [%s] -- %s',
-                 request.method, request.url, request.remote_addr, response.status)
+    # For streamed responses this is timed to the start of the body, not the end
+    summary = request_summary(response)
+    logging.info('END %s %s [%s] -- %s %.1fms db %.1fms/%d queries/%d rows',
+                 request.method, request.url, request.remote_addr, response.status, summary['latency_ms'],
+                 summary['db_time_ms'], summary['query_count'], summary['rows_fetched'],
+                 extra={'fields': summary})
+    observe_request(request.endpoint, request.method, response.status_code, summary['latency_ms'] / 1000)
+    update_pool_metrics(pool_stats())
+
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        for statement, count, seconds in repeated_queries(app.config['REPEATED_QUERY_LOG']):
+            logging.debug('Query run %d times (%.1fms): %s', count, seconds * 1000, statement)
+
+    if app.config['QUERY_COUNT_HEADER']:
+        response.headers['X-LC-Query-Count'] = str(summary['query_count'])
+        response.headers['X-LC-DB-Time'] = '{:.1f}'.format(summary['db_time_ms'])
     return response
 
 
@@ -107,8 +136,33 @@ def registrations_by_date(date):
         return Response(json.dumps(details), status=200, mimetype='application/json')
 
 
+def parse_registrations_key(after):
+    # <date>/<no> or <date>/<no>/<register id>, as given in the Link header
+    parts = after.split('/')
+    if len(parts) not in [2, 3]:
+        raise ValueError("after must be <date>/<number>")
+    datetime.datetime.strptime(parts[0], '%Y-%m-%d')
+    return tuple([parts[0]] + [int(part) for part in parts[1:]])
+
+
+def stream_registrations(registrations, ndjson):
+    if ndjson:
+        for item in registrations:
+            yield json.dumps(item) + '\n'
+    else:
+        yield '['
+        first = True
+        for item in registrations:
+            yield ('' if first else ',') + json.dumps(item)
+            first = False
+        yield ']'
+
+
 @app.route('/registrations', methods=['GET'])
 def all_registrations():
+    if 'after' in request.args or 'limit' in request.args or 'stream' in request.args:
+        return registrations_paged()
+
     cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
     try:
         logging.audit(format_message("Retrieve all registrations"))
@@ -122,6 +176,42 @@ def all_registrations():
         return Response(json.dumps(details), status=200, mimetype='application/json')
 
 
+# GET /registrations?after=<date>/<no>&limit=<n>[&stream=json|ndjson]
+# Pages are in date, number order; a Link header gives the next page. Streamed responses are written as
+# they are read, so memory use doesn't depend on the size of the register.
+def registrations_paged():
+    stream = request.args.get('stream')
+    try:
+        after = parse_registrations_key(request.args['after']) if 'after' in request.args else None
+        limit = int(request.args['limit']) if 'limit' in request.args else None
+        if limit is not None and limit < 1:
+            raise ValueError("limit must be positive")
+        if stream not in [None, 'json', 'ndjson']:
+            raise ValueError("stream must be json or ndjson")
+    except ValueError as error:
+        return Response(json.dumps({'error': str(error)}), status=400, mimetype='application/json')
+
+    logging.audit(format_message("Retrieve all registrations"))
+    if stream is not None:
+        registrations = iter_all_registrations(after, limit, app.config['REGISTRATIONS_STREAM_ITERSIZE'])
+        mimetype = 'application/x-ndjson' if stream == 'ndjson' else 'application/json'
+        return Response(stream_with_context(stream_registrations(registrations, stream == 'ndjson')),
+                        status=200, mimetype=mimetype)
+
+    limit = min(limit or app.config['REGISTRATIONS_MAX_PAGE'], app.config['REGISTRATIONS_MAX_PAGE'])
+    cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
+    try:
+        page, next_key = get_registrations_page(cursor, after, limit)
+    finally:
+        complete(cursor)
+
+    headers = {}
+    if next_key is not None:
+        query = urlencode({'after': '/'.join(str(k) for k in next_key), 'limit': limit})
+        headers['Link'] = '<{}?{}>; rel="next"'.format(request.base_url, query)
+    return Response(json.dumps(page), status=200, mimetype='application/json', headers=headers)
+
+
 @app.route('/registrations/id/<reg_id>', methods=['GET'])
 def registration_by_id(reg_id):
     cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
@@ -235,6 +325,8 @@ def register():
         # logging.audit(format_message("Submit new entries"))
 
         new_regns, details_id, request_id = insert_new_registration(cursor, get_username(), json_data)
+        if not suppress:
+            publish_new_bankruptcy(cursor, new_regns)
         complete(cursor)
         logging.debug(new_regns)
         logging.info(format_message("Registration committed"))
@@ -243,13 +335,14 @@ def register():
         for r in new_regns:
             reg_message += str(r['number']) + ' ' + r['date'] + ', '
         logging.audit(format_message("Committed new entries: %s"), json.dumps(new_regns))
+        count_committed('registration', len(new_regns))
     except:
         if not cursor.closed:
             rollback(cursor)
         raise
 
     if not suppress:
-        publish_new_bankruptcy(producer, new_regns)
+        get_outbox_relay(app.config).wake()
 
     reg_type = 'new_registrations'
     if 'priority_notice' in json_data and json_data['priority_notice']:
@@ -319,11 +412,17 @@ def amend_registration(date, reg_no):
         }
 
         logging.audit(format_message("Updated entries: was %s, now %s"), json.dumps(originals), json.dumps(reg_nos))
+        if not suppress:
+            publish_amendment(cursor, data)
         complete(cursor)
+        count_committed('rectification', len(reg_nos))
     except:
         rollback(cursor)
         raise
 
+    if not suppress:
+        get_outbox_relay(app.config).wake()
+
     return Response(json.dumps(data), status=200)
 
 
@@ -348,15 +447,16 @@ def cancel_registration():
     logging.debug("Received: %s", json_data)
     reg = json_data['registration']
     logging.debug("Reg: %s", reg)
-    rows, nos, canc_request_id = insert_cancellation(json_data, get_username())
+    rows, nos, canc_request_id = insert_cancellation(json_data, get_username(), publish=not suppress)
     if rows == 0:
         return Response(status=404)
     else:
+        count_committed('cancellation', len(nos))
         data = {
             "cancellations": nos, "request_id": canc_request_id
         }
         if not suppress:
-            publish_cancellation(producer, nos)
+            get_outbox_relay(app.config).wake()
         return Response(json.dumps(data), status=200, mimetype='application/json')
 
 
@@ -379,6 +479,7 @@ def renew_registration():
 
         complete(cursor)
         logging.info(format_message("Renewal committed"))
+        count_committed('renewal', len(reg_nos))
     except:
         rollback(cursor)
         raise
@@ -455,6 +556,8 @@ def create_search():
         logging.audit(format_message("Submit search request: %d, ID: %d"), search_request_id, search_details_id)
         complete(cursor)
         logging.info(format_message("Search request and result committed"))
+        count_search(search_data['parameters']['search_type'],
+                     sum(len(item['name_result']) for item in results))
     except:
         rollback(cursor)
         raise
@@ -571,10 +674,12 @@ def delete_all_regs():  # pragma: no cover
     cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
     try:
         cursor.execute("TRUNCATE party_address, address, address_detail, party_trading, party_name_rel, "
-                       "party, migration_status, register, detl_county_rel, register_details, audit_log, "
+                       "party, migration_status, register, detl_county_rel, register_chain, search_index, addl_info_cache, "
+                       "register_details, registration_counter, event_outbox, audit_log, "
                        "search_results, search_name, search_details, request, ins_bankruptcy_request, "
                        "party_name, county")
         complete(cursor)
+        invalidate_counties()
     except:
         rollback(cursor)
         raise
@@ -593,7 +698,14 @@ def synchronise():  # pragma: no cover
         return Response(status=415)
 
     json_data = request.get_json(force=True)
-    publish_new_bankruptcy(producer, json_data)
+    cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
+    try:
+        publish_new_bankruptcy(cursor, json_data)
+        complete(cursor)
+    except:
+        rollback(cursor)
+        raise
+    get_outbox_relay(app.config).wake()
     return Response(status=200)
 
 
@@ -618,6 +730,7 @@ def load_counties():  # pragma: no cover
                                'e': item['eng'], 'c': item['cym']
                            })
         complete(cursor)
+        invalidate_counties()
     except:
         rollback(cursor)
         raise
@@ -633,16 +746,11 @@ def get_counties_list():
         if 'welsh' in request.args:
             welsh_req = request.args['welsh']
 
-        if welsh_req == "yes":
-            cursor.execute("SELECT name, welsh_name FROM COUNTY")
-        else:
-            cursor.execute("SELECT name FROM COUNTY")
-        rows = cursor.fetchall()
         counties = list()
-        for row in rows:
-            counties.append(row['name'])
-            if welsh_req == "yes" and row['welsh_name'] and (row['welsh_name'] != row['name']):
-                counties.append(row['welsh_name'])
+        for name, welsh_name in county_reference(cursor).welsh_names:
+            counties.append(name)
+            if welsh_req == "yes" and welsh_name and (welsh_name != name):
+                counties.append(welsh_name)
         counties.sort()
     finally:
         complete(cursor)
@@ -656,19 +764,9 @@ def get_translated_county(county_name):
         counties = list()
         counties.append(county_name)
 
-        cursor.execute("SELECT name FROM COUNTY where UPPER(welsh_name) = %(n)s", {'n': county_name.upper()})
-        rows = cursor.fetchall()
-
-        for row in rows:
-            if row['name']:
-                counties.append(row['name'])
-        else:
-            cursor.execute("SELECT welsh_name FROM COUNTY where UPPER(name) = %(n)s", {'n': county_name.upper()})
-            rows = cursor.fetchall()
-
-            for row in rows:
-                if row['welsh_name']:
-                    counties.append(row['welsh_name'])
+        reference = county_reference(cursor)
+        counties += reference.english_names(county_name)
+        counties += reference.welsh_names_of(county_name)
     finally:
         complete(cursor)
     return Response(json.dumps(counties), status=200, mimetype='application/json')
@@ -679,15 +777,12 @@ def get_translated_county(county_name):
 def validate_county_council(county_name):
     cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
     try:
-        cursor.execute("SELECT county_council FROM county_search_keys WHERE name=%(name)s",
-                       {'name': county_name.upper()})
-        rows = cursor.fetchall()
+        flags = county_reference(cursor).county_council.get(county_name.upper(), [])
 
-        if len(rows) != 1:
+        if len(flags) != 1:
             return Response(status=404)
 
-        print(rows[0])
-        if rows[0]['county_council'] is not True:
+        if flags[0] is not True:
             return Response(status=404)
 
         return Response(status=200)
@@ -719,21 +814,28 @@ def get_request_details(request_id):
         else:  # not a search - reg register details
             data = get_register_request_details(request_id)
 
-            for index, row in enumerate(data):  # Each AKA registration needs populating
-
+            # Work out which entry each AKA registration should show, then load them all at once
+            targets = []
+            target = None
+            for index, row in enumerate(data):
                 revealable = get_most_recent_revealable(cursor, row["registration_no"], row["registration_date"])
                 if revealable:
                     if index < len(revealable['registrations']):
-                        details = get_registration_details(cursor, revealable['registrations'][index]['number'],
-                                                                   revealable['registrations'][index]['date'])
+                        target = (int(revealable['registrations'][index]['number']),
+                                  revealable['registrations'][index]['date'])
                 else:  # if nothing came back from revealable
-                    details = get_registration_details(cursor, row["registration_no"], row["registration_date"])
+                    target = (int(row["registration_no"]), row["registration_date"])
+                targets.append(target)
+
+            register_ids = get_register_ids(cursor, list(set(t for t in targets if t is not None)))
+            details_by_id = get_registration_details_bulk(cursor, register_ids.values())
+
+            for row, target in zip(data, targets):
+                details = None
+                if target in register_ids:
+                    details = copy.deepcopy(details_by_id[register_ids[target]])
                 if details is not None:
-                    if 'particulars' in details:
-                        if 'counties' in details['particulars']:
-                            if len(details['particulars']['counties']) > 1:
-                                county = get_county(cursor, row['registration_no'], row['registration_date'])
-                                details['particulars']['counties'] = county
+                    restrict_to_lead_county(details)
                     addl_info = get_additional_info(cursor, details)
                     if addl_info is not None:
                         details['additional_information'] = addl_info
@@ -832,8 +934,11 @@ def get_search_request_ids():
         if not data['estate_owner']['complex']['name'] == "":
             sql += " and UPPER(c.complex_name) = %(complex_name)s "
             params['complex_name'] = data['estate_owner']['complex']['name'].upper()
-    cursor.execute(sql, params)
-    rows = cursor.fetchall()
+    try:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    finally:
+        complete(cursor)
     results = {'results': []}
     request_ids = []
     for row in rows:
@@ -936,6 +1041,7 @@ def set_area_variants():
                            'variant': item['variant_of'], 'county': item['county_council']
                        })
     complete(cursor)
+    invalidate_counties()
     return Response(status=200)
 
 
@@ -947,6 +1053,7 @@ def clear_area_variants():
     cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
     cursor.execute('DELETE FROM county_search_keys')
     complete(cursor)
+    invalidate_counties()
     return Response(status=200)
 
 
@@ -972,3 +1079,7 @@ def get_applicant(request_id):
     finally:
         complete(cursor)
     return Response(json.dumps(applicant), status=200, mimetype='application/json')
+
+
+if app.config['COUNTY_CACHE_PRELOAD']:
+    preload_counties()
@@ -417,10 +417,36 @@ SEARCH_SCHEMA = {
 }
 
 
-def validate_migration(data):
-    val = Draft4Validator(MIGRATED_REGISTRATION_SCHEMA)
+# Validators are built (and the schemas themselves checked) once, at import, rather than per request
+def compile_validator(schema):
+    Draft4Validator.check_schema(schema)
+    return Draft4Validator(schema)
+
+
+REGISTRATION_VALIDATOR = compile_validator(REGISTRATION_SCHEMA)
+MIGRATED_REGISTRATION_VALIDATOR = compile_validator(MIGRATED_REGISTRATION_SCHEMA)
+SEARCH_VALIDATOR = compile_validator(SEARCH_SCHEMA)
+
+# id(schema) -> (schema, validator) for validate(); holding the schema keeps its id from being reused
+_validators = {
+    id(SEARCH_SCHEMA): (SEARCH_SCHEMA, SEARCH_VALIDATOR)
+}
+
+
+def validator_for(schema):
+    entry = _validators.get(id(schema))
+    if entry is None:
+        entry = _validators[id(schema)] = (schema, compile_validator(schema))
+    return entry[1]
+
+
+def schema_errors(validator, data):
+    # is_valid stops at the first failure and builds no error objects, which is all a valid document needs
+    if validator.is_valid(data):
+        return []
+
     errors = []
-    for error in val.iter_errors(data):
+    for error in validator.iter_errors(data):
         path = "$"
         while len(error.path) > 0:
             item = error.path.popleft()
@@ -435,10 +461,13 @@ def validate_migration(data):
             "location": path,
             "error_message": error.message
         })
-
     return errors
 
 
+def validate_migration(data):
+    return schema_errors(MIGRATED_REGISTRATION_VALIDATOR, data)
+
+
 def validate_update(data):
     errors = validate_generic_registration(data)
     if 'update_registration' not in data:
@@ -471,32 +500,28 @@ def validate_registration(data):
     return errors
 
 
-def validate_generic_registration(data):
-    val = Draft4Validator(REGISTRATION_SCHEMA)
-    errors = []
-    for error in val.iter_errors(data):
-        path = "$"
-        while len(error.path) > 0:
-            item = error.path.popleft()
-            if isinstance(item, int):  # This is an assumption!
-                path += "[" + str(item) + "]"
-            else:
-                path += "." + item
-        if path == '$':
-            path = '$.'
-        logging.debug(error.message + "|" + path)
-        errors.append({
-            "location": path,
-            "error_message": error.message
-        })
+# Name type -> (the attribute that must hold the name, how the type is described in the error)
+NAME_TYPE_ATTRIBUTES = {
+    'Private Individual': ('private', 'private individual'),
+    'County Council': ('local', 'county council'),
+    'Parish Council': ('local', 'parish council'),
+    'Rural Council': ('local', 'rural council'),
+    'Other Council': ('local', 'other council'),
+    'Development Corporation': ('other', 'development corporation'),
+    'Limited Company': ('company', 'limited company'),
+    'Complex Name': ('complex', 'complex names'),
+    'Other': ('other', 'other')
+}
 
-    # Fail before performing in-depth checks
-    if len(errors) > 0:
-        return errors
 
+def check_parties(parties):
+    # One pass over the parties and their names. Returns (debtor, estate owner, party errors, name errors);
+    # the two error lists are kept apart so they can be reported in the usual order.
     debtor = None
     estate_owner = None
-    for party in data['parties']:
+    party_errors = []
+    name_errors = []
+    for party in parties:
         if party['type'] == 'Debtor':
             debtor = party
         else:
@@ -504,10 +529,28 @@ def validate_generic_registration(data):
                 estate_owner = party
 
             if 'addresses' in party:
-                errors.append({'error_message': 'Addresses not allowed on non-debtor party'})
+                party_errors.append({'error_message': 'Addresses not allowed on non-debtor party'})
 
             if len(party['names']) > 1:
-                errors.append({'error_message': 'Multiple names not allowed on non-debtor party'})
+                party_errors.append({'error_message': 'Multiple names not allowed on non-debtor party'})
+
+        # Check that party types and name structure supplied match
+        for name in party['names']:
+            required = NAME_TYPE_ATTRIBUTES.get(name['type'])
+            if required is not None and required[0] not in name:
+                name_errors.append({'error_message': "Attribute '{}' required for {}".format(*required)})
+
+    return debtor, estate_owner, party_errors, name_errors
+
+
+def validate_generic_registration(data):
+    errors = schema_errors(REGISTRATION_VALIDATOR, data)
+
+    # Fail before performing in-depth checks
+    if len(errors) > 0:
+        return errors
+
+    debtor, estate_owner, errors, name_errors = check_parties(data['parties'])
 
     # Bankruptcy specific validation
     if data['class_of_charge'] in ['PAB', 'WOB']:
@@ -542,57 +585,12 @@ def validate_generic_registration(data):
         if estate_owner is None:
             errors.append({'error_message': "Party of type 'Estate Owner' required for land charge"})
 
-    # Check that party types and name structure supplied match
-    for party in data['parties']:
-        for name in party['names']:
-            if name['type'] == 'Private Individual' and 'private' not in name:
-                errors.append({'error_message': "Attribute 'private' required for private individual"})
-
-            if name['type'] == "County Council" and 'local' not in name:
-                errors.append({'error_message': "Attribute 'local' required for county council"})
-
-            if name['type'] == "Parish Council" and 'local' not in name:
-                errors.append({'error_message': "Attribute 'local' required for parish council"})
-
-            if name['type'] == "Rural Council" and 'local' not in name:
-                errors.append({'error_message': "Attribute 'local' required for rural council"})
-
-            if name['type'] == "Other Council" and 'local' not in name:
-                errors.append({'error_message': "Attribute 'local' required for other council"})
-
-            if name['type'] == "Development Corporation" and 'other' not in name:
-                errors.append({'error_message': "Attribute 'other' required for development corporation"})
-
-            if name['type'] == "Limited Company" and 'company' not in name:
-                errors.append({'error_message': "Attribute 'company' required for limited company"})
-
-            if name['type'] == "Complex Name" and 'complex' not in name:
-                errors.append({'error_message': "Attribute 'complex' required for complex names"})
+    return errors + name_errors
 
-            if name['type'] == "Other" and 'other' not in name:
-                errors.append({'error_message': "Attribute 'other' required for other"})
 
-    return errors
-
-    
 def validate(data, schema):
-    val = Draft4Validator(schema)
-    errors = []
-    for error in val.iter_errors(data):
-        path = "$"
-        while len(error.path) > 0:
-            item = error.path.popleft()
-            if isinstance(item, int):  # This is an assumption!
-                path += "[" + str(item) + "]"
-            else:
-                path += "." + item
-        if path == '$':
-            path = '$.'
-        logging.debug(error.message + "|" + path)
-        errors.append({
-            "location": path,
-            "error_message": error.message
-        })
+    # None when data is valid
+    errors = schema_errors(validator_for(schema), data)
 
     # Fail before performing in-depth checks
     if len(errors) > 0:
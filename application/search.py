@@ -2,17 +2,20 @@ import logging
 import datetime
 import json
 import time
+import os
+import threading
+import concurrent.futures
+import psycopg2.extras
+from application import app
 from application.search_key import create_search_keys
+from application.counties import county_reference
+from application.pool import get_pool, PoolTimeout
+from application.instrument import instrumented
 
 
 def load_county_dictionary(cursor):
-    cursor.execute('SELECT name, welsh_name FROM county WHERE welsh_name is not NULL');
-    rows = cursor.fetchall()
-
-    welsh_dict = {}
-    for row in rows:
-        welsh_dict[row['welsh_name'].upper()] = row['name'].upper()
-    return welsh_dict
+    # {upper-case Welsh name: upper-case English name}
+    return county_reference(cursor).english_by_welsh
 
 
 def store_search_request(cursor, data):
@@ -104,220 +107,36 @@ def store_search_result(cursor, request_id, details_id, name_id, data):
 # search banks
 # search full - all counties
 # search full - limited counties
-def merge_lists(a, b):
-    result = a + [x for x in b if x not in a]
-    return result
+def result_id(item):
+    # Search results are register ids, or dicts carrying one; two results with the same id are the same entry
+    return item['id'] if isinstance(item, dict) else item
 
 
-def get_name_type_clause(name_type):
-    if name_type == 'Private Individual':
-        return "  and pn.name_type_ind in ('Private Individual', 'Other')"
-    else:
-        return "  and pn.name_type_ind=%(nametype)s"
-
-
-
-def perform_bankruptcy_search(cursor, name_type, keys, cert_date):
-    cursor.execute("SELECT r.id, r.date, rd.class_of_charge "
-                   "FROM party_name n, register r, register_details rd, party p, party_name_rel pnr "
-                   "WHERE n.searchable_string = ANY(%(keys)s) "
-                   "  AND n.id = pnr.party_name_id "
-                   "  AND pnr.party_id = p.id "
-                   "  and p.party_type != 'Court' "
-                   "  AND p.register_detl_id = rd.id "
-                   "  AND r.details_id = rd.id "
-                   "  AND r.date <= %(date)s "
-                   "  AND (r.expired_on is NULL OR %(date)s < r.expired_on) "
-                   "  AND rd.class_of_charge in ('PAB', 'WOB', 'PA', 'WO', 'DA') "
-                   "  AND n.name_type_ind = %(nametype)s", {
-                       "keys": keys, "date": cert_date, "nametype": name_type
-                   })
-    rows = cursor.fetchall()
-    result = [{"id": row['id'], "date": row['date'], "class": row['class_of_charge']} for row in rows]
+def merge_lists(a, b):
+    # a, then the items of b not already in a. Repeats within a or within b are left alone.
+    in_a = set(result_id(x) for x in a)
+    result = a + [x for x in b if result_id(x) not in in_a]
     return result
 
 
-def perform_bankruptcy_search_complex_name(cursor, name_type, keys, number, cert_date):
-    # use perform_bankruptcy_search
-    # use SQL on number
-    # merge results
-    name_results = perform_bankruptcy_search(cursor, name_type, keys, cert_date)
-
-    cursor.execute("SELECT r.id, r.date, rd.class_of_charge "
-                   "FROM party_name n, register r, register_details rd, party p, party_name_rel pnr "
-                   "WHERE n.complex_number = %(number)s "
-                   "  AND n.id = pnr.party_name_id "
-                   "  AND pnr.party_id = p.id "
-                   "  and p.party_type != 'Court' "
-                   "  AND p.register_detl_id = rd.id "
-                   "  AND r.details_id = rd.id "
-                   "  AND r.date <= %(date)s"
-                   "  AND (r.expired_on is NULL OR %(date)s < r.expired_on)"
-                   #"  AND r.reveal='t'"
-                   "  AND rd.class_of_charge in ('PAB', 'WOB', 'PA', 'WO', 'DA') "
-                   "  AND n.name_type_ind = 'Complex Name' ", {
-                       "number": number, "date": cert_date, "nametype": name_type
-                   })
-    rows = cursor.fetchall()
-    result = [{"id": row['id'], "date": row['date'], "class": row['class_of_charge']} for row in rows]
-    return merge_lists(name_results, result)
-
-
-def perform_full_search_all_counties(cursor, name_type, keys, year_from, year_to, cert_date):
-    logging.debug('Full search: %s %s', name_type, keys[0])
-    cursor.execute("SELECT r.id, r.date, rd.class_of_charge "
-                   "FROM party_name pn, register r, party_name_rel pnr, party p, register_details rd "
-                   "WHERE pn.searchable_string = ANY(%(keys)s) "
-                   "  and pnr.party_name_id = pn.id and pnr.party_id=p.id "
-                   "  and p.party_type != 'Court' "
-                   "  and p.register_detl_id=rd.id "
-                   "  and rd.id=r.details_id " +
-                   get_name_type_clause(name_type) +
-                   #"  and pn.name_type_ind = %(nametype)s "
-                   "  and (r.debtor_reg_name_id is null or r.debtor_reg_name_id = pn.id) "
-                   "  and ("
-                   "      rd.priority_notice_ind='f' "
-                   "      or rd.priority_notice_ind IS NULL "
-                   "      or (priority_notice_ind='y' and rd.prio_notice_expires >= %(exdate)s) "
-                   "  )"
-                   "  and ( "
-                   "     extract(year from r.date) between %(from_date)s and %(to_date)s "
-                   "     or rd.class_of_charge in ('PA', 'WO', 'DA', 'PAB', 'WOB')"
-                   "  ) "
-                   "  and r.date <= %(date)s "
-                   "  AND (r.expired_on is NULL OR %(date)s < r.expired_on)",
-                   #"   and r.reveal='t'",
-                   {
-                       'keys': keys, 'from_date': year_from, 'to_date': year_to,
-                       'date': cert_date, 'exdate': cert_date, 'nametype': name_type
-                   })
-    rows = cursor.fetchall()
-    logging.debug("%d rows returned", len(rows))
-    return [{"id": row['id'], "date": row['date'], "class": row['class_of_charge']} for row in rows]
-
-
-def perform_full_search(cursor, name_type, keys, counties, year_from, year_to, cert_date):
-    cursor.execute("SELECT r.id, r.date, rd.class_of_charge "
-                   "FROM party_name pn, register r, party_name_rel pnr, party p, register_details rd "
-                   "FULL OUTER JOIN detl_county_rel dcr on rd.id = dcr.details_id "
-                   "FULL OUTER JOIN county c on dcr.county_id = c.id "
-                   "WHERE pn.searchable_string= ANY(%(keys)s) "
-                   "  and pnr.party_name_id = pn.id and pnr.party_id=p.id "
-                   "  and p.party_type != 'Court' "
-                   "  and p.register_detl_id=rd.id "
-                   "  and rd.id=r.details_id " +
-                   get_name_type_clause(name_type) +
-                   #"  and pn.name_type_ind = %(nametype)s "
-                   "  and (r.debtor_reg_name_id is null or r.debtor_reg_name_id = pn.id) "
-                   "  and ("
-                   "      rd.priority_notice_ind='f' "
-                   "      or rd.priority_notice_ind IS NULL "
-                   "      or (priority_notice_ind='y' and rd.prio_notice_expires >= %(exdate)s) "
-                   "  )"
-                   "  AND ("
-                   "      rd.class_of_charge in ('PA', 'WO', 'DA', 'PAB', 'WOB' ) "
-                   "      OR ( "
-                   "          extract(year from r.date) between %(from_date)s and %(to_date)s "
-                   "          AND ( "
-                   "              rd.class_of_charge = 'A' "
-                   "              OR UPPER(c.name) = ANY(%(counties)s) "
-                   "              OR c.name IS NULL"
-                   "          ) "
-                   "      ) "
-                   "  ) "
-                   " and r.date <= %(date)s "
-                   "  AND (r.expired_on is NULL OR %(date)s < r.expired_on)",
-                   #" and r.reveal='t'",
-                   {
-                       'keys': keys, 'from_date': year_from, 'to_date': year_to,
-                       'counties': counties, 'date': cert_date, 'exdate': cert_date,
-                       'nametype': name_type
-                   })
-    rows = cursor.fetchall()
-    return [{"id": row['id'], "date": row['date'], "class": row['class_of_charge']} for row in rows]
-
-
-def perform_full_search_complex_name_all_counties(cursor, name_type, keys, number, year_from, year_to, cert_date):
-    name_results = perform_full_search_all_counties(cursor, name_type, keys, year_from, year_to, cert_date)
-    cursor.execute("SELECT r.id, r.date, rd.class_of_charge "
-                   "FROM party_name pn, register r, party_name_rel pnr, party p, register_details rd "
-                   "WHERE pn.complex_number = %(number)s "
-                   "  and pnr.party_name_id = pn.id and pnr.party_id=p.id "
-                   "  and p.party_type != 'Court' "
-                   "  and p.register_detl_id=rd.id "
-                   "  and rd.id=r.details_id "
-                   #"  and pn.name_type_ind = 'Complex Name' "
-                   "  and (r.debtor_reg_name_id is null or r.debtor_reg_name_id = pn.id) "
-                   "  and ("
-                   "      rd.priority_notice_ind='f' "
-                   "      or rd.priority_notice_ind IS NULL "
-                   "      or (priority_notice_ind='y' and rd.prio_notice_expires >= %(exdate)s) "
-                   "  )"
-                   "  and ( "
-                   "     extract(year from r.date) between %(from_date)s and %(to_date)s "
-                   "     or rd.class_of_charge in ('PA', 'WO', 'DA', 'PAB', 'WOB')"
-                   "  ) "
-                   "  and r.date <= %(date)s "
-                   "  AND (r.expired_on is NULL OR %(date)s < r.expired_on)",
-                   #"  and r.reveal='t'",
-                   {
-                       'number': number, 'from_date': year_from, 'to_date': year_to,
-                       'date': cert_date, 'exdate': cert_date, 'nametype': name_type
-                   })
-    rows = cursor.fetchall()
-    result = [{"id": row['id'], "date": row['date'], "class": row['class_of_charge']} for row in rows]
-    return merge_lists(name_results, result)
-
-
-def perform_full_search_complex_name(cursor, name_type, keys, number, counties, year_from, year_to, cert_date):
-    name_results = perform_full_search(cursor, name_type, keys, counties, year_from, year_to, cert_date)
-    cursor.execute("SELECT r.id, r.date, rd.class_of_charge "
-                   "FROM party_name pn, register r, party_name_rel pnr, party p, register_details rd "
-                   "FULL OUTER JOIN detl_county_rel dcr on rd.id = dcr.details_id "
-                   "FULL OUTER JOIN county c on dcr.county_id = c.id "
-                   "WHERE pn.complex_number = %(number)s "
-                   "  and pnr.party_name_id = pn.id and pnr.party_id=p.id "
-                   "  and p.register_detl_id=rd.id "
-                   "  and rd.id=r.details_id "
-                   "  and pn.name_type_ind = %(nametype)s "
-                   "  and (r.debtor_reg_name_id is null or r.debtor_reg_name_id = pn.id) "
-                   "  and ("
-                   "      rd.priority_notice_ind='f' "
-                   "      or rd.priority_notice_ind IS NULL "
-                   "      or (priority_notice_ind='y' and rd.prio_notice_expires >= %(exdate)s) "
-                   "  )"
-                   "  AND ("
-                   "      rd.class_of_charge in ('PA', 'WO', 'DA', 'PAB', 'WOB' ) "
-                   "      OR ( "
-                   "          extract(year from r.date) between %(from_date)s and %(to_date)s "
-                   "          AND ( "
-                   "              rd.class_of_charge = 'A' "
-                   "              OR UPPER(c.name) = ANY(%(counties)s) "
-                   "              OR c.name IS NULL"
-                   "          ) "
-                   "      ) "
-                   "  ) "
-                   "and r.date <= %(date)s "
-                   "  AND (r.expired_on is NULL OR %(date)s < r.expired_on)",
-                   #"and r.reveal='t'",
-                   {
-                       'number': number, 'from_date': year_from, 'to_date': year_to,
-                       'counties': counties, 'date': cert_date, 'exdate': cert_date,
-                       'nametype': name_type
-                   })
-    rows = cursor.fetchall()
-    result = [{"id": row['id'], "date": row['date'], "class": row['class_of_charge']} for row in rows]
-    return merge_lists(name_results, result)
+def distinct_results(results):
+    # The results in order, without repeats of an id
+    seen = set()
+    unique = []
+    for item in results:
+        if result_id(item) not in seen:
+            seen.add(result_id(item))
+            unique.append(item)
+    return unique
 
 
-def process_search_result(result):
-    res = []
-    for item in result:
-        res.append(item['id'])
-    return res
+def county_ids(cursor, counties):
+    # counties: upper-case English names, as from search_counties
+    return county_reference(cursor).ids_of(counties)
 
 
-def perform_search(cursor, parameters, cert_date):
+def search_counties(cursor, parameters):
+    # Defaults the request's counties to ['ALL']; returns them capitalised, with English names for Welsh ones
     welsh = load_county_dictionary(cursor)
 
     if "counties" not in parameters:
@@ -326,8 +145,6 @@ def perform_search(cursor, parameters, cert_date):
     if len(parameters['counties']) == 0:
         parameters['counties'].append('ALL')
 
-    search_results = []
-
     counties = []
     # Capitalise and substitute English names for Welsh counties
     for c in parameters['counties']:
@@ -338,35 +155,273 @@ def perform_search(cursor, parameters, cert_date):
         else:
             logging.debug("%s is english", c)
             counties.append(cu)
+    return counties
+
+
+# Search: every item of a search goes into one statement as a row of 'items', and the match for an item is a
+# LATERAL subquery run once per row. Part 0 is the match on search keys, part 1 the extra complex-number match
+# (complex names only), merged in Python. The matches read search_index (see application/search_index.py),
+# one row per register row and name; the county-restricted ones test the entry's counties with EXISTS on
+# detl_county_rel, by the ids county_ids resolves from the county cache. The rules keep the quirks of the
+# queries they replaced (the complex-number match on the full search ignores name type over all counties but
+# not over selected ones, and drops the court filter there); tests/search_reference.py holds those queries.
+SEARCH_ITEMS = "WITH items (ord, keys, name_type, name_types, is_complex, number, year_from, year_to) AS (" \
+               "VALUES {values}) "
+
+SEARCH_ITEM_VALUES = "(%s::int, %s::text[], %s::text, %s::text[], %s::boolean, %s::int, %s::int, %s::int)"
+
+BATCHED_SEARCH = SEARCH_ITEMS + \
+    "SELECT i.ord, 0 AS part, m.id FROM items i CROSS JOIN LATERAL ({name_match}) m " \
+    "UNION ALL " \
+    "SELECT i.ord, 1 AS part, m.id FROM items i CROSS JOIN LATERAL ({number_match}) m WHERE i.is_complex " \
+    "ORDER BY ord, part, id"
+
+BANKRUPTCY_CONDITIONS = "  and s.party_type != 'Court' " \
+                              "  AND s.date <= %(date)s " \
+                              "  AND (s.expired_on is NULL OR %(date)s < s.expired_on) " \
+                              "  AND s.class_of_charge in ('PAB', 'WOB', 'PA', 'WO', 'DA') "
+
+BANKRUPTCY_NAME_MATCH = "SELECT s.register_id AS id FROM search_index s " \
+                              "WHERE s.searchable_string = ANY(i.keys) " \
+                              "  AND s.name_type_ind = i.name_type " + \
+                              BANKRUPTCY_CONDITIONS
+
+BANKRUPTCY_NUMBER_MATCH = "SELECT s.register_id AS id FROM search_index s " \
+                                "WHERE s.complex_number = i.number " \
+                                "  AND s.name_type_ind = 'Complex Name' " + \
+                                BANKRUPTCY_CONDITIONS
+
+FULL_SEARCH_CONDITIONS = "  and s.debtor_name_match " \
+                               "  and (" \
+                               "      s.priority_notice_ind='f' " \
+                               "      or s.priority_notice_ind IS NULL " \
+                               "      or (s.priority_notice_ind='y' and s.prio_notice_expires >= %(exdate)s) " \
+                               "  )" \
+                               "  and s.date <= %(date)s " \
+                               "  AND (s.expired_on is NULL OR %(date)s < s.expired_on)"
+
+FULL_SEARCH_ALL_COUNTIES_CONDITIONS = FULL_SEARCH_CONDITIONS + \
+    "  and s.party_type != 'Court' " \
+    "  and ( " \
+    "     s.year between i.year_from and i.year_to " \
+    "     or s.class_of_charge in ('PA', 'WO', 'DA', 'PAB', 'WOB')" \
+    "  ) "
+
+FULL_SEARCH_COUNTIES_CONDITIONS = FULL_SEARCH_CONDITIONS + \
+    "  AND (" \
+    "      s.class_of_charge in ('PA', 'WO', 'DA', 'PAB', 'WOB' ) " \
+    "      OR ( " \
+    "          s.year between i.year_from and i.year_to " \
+    "          AND ( " \
+    "              s.class_of_charge = 'A' " \
+    "              OR NOT EXISTS (SELECT 1 FROM detl_county_rel dcr WHERE dcr.details_id = s.details_id) " \
+    "              OR EXISTS (SELECT 1 FROM detl_county_rel dcr " \
+    "                         WHERE dcr.details_id = s.details_id AND dcr.county_id = ANY(%(county_ids)s))" \
+    "          ) " \
+    "      ) " \
+    "  ) "
+
+FULL_NAME_MATCH_ALL_COUNTIES = "SELECT s.register_id AS id FROM search_index s " \
+                                     "WHERE s.searchable_string = ANY(i.keys) " \
+                                     "  and s.name_type_ind = ANY(i.name_types) " + \
+                                     FULL_SEARCH_ALL_COUNTIES_CONDITIONS
+
+FULL_NUMBER_MATCH_ALL_COUNTIES = "SELECT s.register_id AS id FROM search_index s " \
+                                       "WHERE s.complex_number = i.number " + \
+                                       FULL_SEARCH_ALL_COUNTIES_CONDITIONS
+
+FULL_NAME_MATCH_COUNTIES = "SELECT s.register_id AS id FROM search_index s " \
+                                 "WHERE s.searchable_string = ANY(i.keys) " \
+                                 "  and s.name_type_ind = ANY(i.name_types) " \
+                                 "  and s.party_type != 'Court' " + \
+                                 FULL_SEARCH_COUNTIES_CONDITIONS
+
+FULL_NUMBER_MATCH_COUNTIES = "SELECT s.register_id AS id FROM search_index s " \
+                                   "WHERE s.complex_number = i.number " \
+                                   "  and s.name_type_ind = i.name_type " + \
+                                   FULL_SEARCH_COUNTIES_CONDITIONS
+
+# (name match, number match) by (search type, over all counties)
+BATCHED_MATCHES = {
+    ('banks', True): (BANKRUPTCY_NAME_MATCH, BANKRUPTCY_NUMBER_MATCH),
+    ('full', True): (FULL_NAME_MATCH_ALL_COUNTIES, FULL_NUMBER_MATCH_ALL_COUNTIES),
+    ('full', False): (FULL_NAME_MATCH_COUNTIES, FULL_NUMBER_MATCH_COUNTIES),
+}
+
+
+def search_name_types(name_type):
+    # The name types matched by the full search
+    if name_type == 'Private Individual':
+        return ['Private Individual', 'Other']
+    return [name_type]
+
+
+def batched_search_sql(cursor, search_type, all_counties, items, matches=None):
+    # items: [(keys, name_type, complex number or None, year_from, year_to)], one per search item
+    # matches: (name match, number match) in place of BATCHED_MATCHES', for checking against reference queries
+    values = ",".join(cursor.mogrify(SEARCH_ITEM_VALUES, (
+        position, keys, name_type, search_name_types(name_type), name_type == 'Complex Name', number, year_from,
+        year_to
+    )).decode('utf-8') for position, (keys, name_type, number, year_from, year_to) in enumerate(items))
+
+    if matches is not None:
+        name_match, number_match = matches
+    elif search_type != 'full':
+        name_match, number_match = BATCHED_MATCHES[('banks', True)]
+    else:
+        name_match, number_match = BATCHED_MATCHES[('full', all_counties)]
+
+    # The mogrified values are literal SQL; double any % so execute doesn't take them for placeholders
+    return BATCHED_SEARCH.format(values=values.replace('%', '%%'), name_match=name_match,
+                                 number_match=number_match)
+
+
+def perform_batched_search(cursor, search_type, all_counties, counties, items, cert_date, matches=None):
+    # Returns a list of register ids per item
+    if len(items) == 0:
+        return []
+
+    params = {'date': cert_date, 'exdate': cert_date, 'counties': counties}
+    if search_type == 'full' and not all_counties:
+        params['county_ids'] = county_ids(cursor, counties)
+    cursor.execute(batched_search_sql(cursor, search_type, all_counties, items, matches), params)
+    parts = [([], []) for _ in items]
+    for row in cursor.fetchall():
+        parts[row['ord']][row['part']].append(row['id'])
+    return [merge_lists(name_ids, number_ids) for name_ids, number_ids in parts]
+
+
+# Parallel search (SEARCH_PARALLEL): the items are split into contiguous chunks, each run as its own batched
+# query on a pooled connection by a small per-worker thread pool. Every chunk's transaction imports the
+# snapshot exported from the caller's, so the chunks see the same data a single query would, and the
+# results are joined in chunk order. The caller's transaction has to stay open (it does: we wait for every
+# chunk) for the snapshot to remain importable.
+#
+# The thread pool is shared by every request in the process, so a search first takes one slot per chunk,
+# without waiting; the slots match the threads, so a chunk never queues behind another request's. A search
+# gets as many chunks as there are free slots, and runs as one query on its own cursor if fewer than two are.
+_search_executor = None     # (pid, workers, ThreadPoolExecutor, BoundedSemaphore of free threads)
+_executor_lock = threading.Lock()
+
+
+def get_search_executor(workers):
+    # Returns (executor, slots). Replaced after a fork (an inherited executor has no threads) or when
+    # SEARCH_PARALLEL_WORKERS changes; chunks already running on the old one finish there.
+    global _search_executor
+    current = _search_executor
+    if current is None or current[:2] != (os.getpid(), workers):
+        with _executor_lock:
+            current = _search_executor
+            if current is None or current[:2] != (os.getpid(), workers):
+                if current is not None and current[0] == os.getpid():
+                    current[2].shutdown(wait=False)
+                current = (os.getpid(), workers, concurrent.futures.ThreadPoolExecutor(max_workers=workers),
+                           threading.BoundedSemaphore(workers))
+                _search_executor = current
+    return current[2], current[3]
+
+
+def acquire_slots(slots, wanted):
+    # Takes up to wanted slots without blocking; returns how many it got
+    acquired = 0
+    while acquired < wanted and slots.acquire(blocking=False):
+        acquired += 1
+    return acquired
+
+
+def split_items(items, chunk_count):
+    # Contiguous, near-equal chunks, in order
+    size, extra = divmod(len(items), chunk_count)
+    chunks = []
+    start = 0
+    for index in range(chunk_count):
+        end = start + size + (1 if index < extra else 0)
+        if end > start:
+            chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def search_in_snapshot(snapshot, checkout_timeout, search_type, all_counties, counties, items, cert_date):
+    pool = get_pool(app.config)
+    connection = pool.checkout(checkout_timeout)
+    try:
+        cursor = connection.cursor(cursor_factory=instrumented(psycopg2.extras.DictCursor))
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY")
+        cursor.execute("SET TRANSACTION SNAPSHOT %(snapshot)s", {'snapshot': snapshot})
+        results = perform_batched_search(cursor, search_type, all_counties, counties, items, cert_date)
+        cursor.close()
+        return results
+    finally:
+        # Rolls back the read-only transaction
+        pool.release(connection)
+
+
+def perform_parallel_search(cursor, search_type, all_counties, counties, items, cert_date, workers,
+                            checkout_timeout):
+    # Same results as perform_batched_search(cursor, ...)
+    if len(items) < 2 or workers < 2:
+        return perform_batched_search(cursor, search_type, all_counties, counties, items, cert_date)
+
+    executor, slots = get_search_executor(workers)
+    acquired = acquire_slots(slots, min(workers, len(items)))
+    if acquired < 2:
+        for _ in range(acquired):
+            slots.release()
+        logging.warning('No free workers for a parallel search; running it as one query')
+        return perform_batched_search(cursor, search_type, all_counties, counties, items, cert_date)
+
+    futures = []
+    try:
+        cursor.execute("SELECT pg_export_snapshot() AS snapshot")
+        snapshot = cursor.fetchone()['snapshot']
+        for chunk in split_items(items, acquired):
+            futures.append(executor.submit(search_in_snapshot, snapshot, checkout_timeout, search_type,
+                                           all_counties, counties, chunk, cert_date))
+            # Each chunk frees its slot once it has finished, however it finished
+            futures[-1].add_done_callback(lambda future: slots.release())
+    finally:
+        # Slots taken for chunks that were never submitted
+        for _ in range(acquired - len(futures)):
+            slots.release()
+    concurrent.futures.wait(futures)
 
+    results = []
+    try:
+        for future in futures:
+            results += future.result()
+    except PoolTimeout:
+        # Every connection is busy; don't queue behind other requests for more
+        logging.warning('No free connections for a parallel search; running it as one query')
+        return perform_batched_search(cursor, search_type, all_counties, counties, items, cert_date)
+    return results
+
+
+def perform_search(cursor, parameters, cert_date):
+    counties = search_counties(cursor, parameters)
+
+    items = []
     for item in parameters['search_items']:
         keys = create_search_keys(cursor, item['name_type'], item['name'])
         logging.debug('Search keys:')
         logging.debug(keys)
 
-        if item['name_type'] == 'Complex Name':
-            cnumber = item['name']['complex_number']
-
-            if parameters['search_type'] == 'full':
-                if parameters['counties'][0] == 'ALL':
-                    name_result = perform_full_search_complex_name_all_counties(cursor, item['name_type'], keys, cnumber, item['year_from'], item['year_to'], cert_date)
-                else:
-                    name_result = perform_full_search_complex_name(cursor, item['name_type'], keys, cnumber, counties, item['year_from'], item['year_to'], cert_date)
-            else:
-                name_result = perform_bankruptcy_search_complex_name(cursor, item['name_type'], keys, cnumber, cert_date)
+        number = item['name']['complex_number'] if item['name_type'] == 'Complex Name' else None
+        if parameters['search_type'] == 'full':
+            items.append((keys, item['name_type'], number, item['year_from'], item['year_to']))
         else:
-            if parameters['search_type'] == 'full':
-                if parameters['counties'][0] == 'ALL':
-                    name_result = perform_full_search_all_counties(cursor, item['name_type'], keys, item['year_from'], item['year_to'], cert_date)
-                else:
-                    name_result = perform_full_search(cursor, item['name_type'], keys, counties, item['year_from'], item['year_to'], cert_date)
-            else:
-                name_result = perform_bankruptcy_search(cursor, item['name_type'], keys, cert_date)
-
-        search_results.append({'name_result': process_search_result(name_result), 'name_id': item['name_id']})
-    # search_results.append({'name_result': results_array, 'name_id': item['name_id']})
-
-    return search_results
+            items.append((keys, item['name_type'], number, None, None))
+
+    all_counties = parameters['counties'][0] == 'ALL'
+    if app.config['SEARCH_PARALLEL'] and len(items) >= app.config['SEARCH_PARALLEL_MIN_ITEMS']:
+        results = perform_parallel_search(cursor, parameters['search_type'], all_counties, counties, items,
+                                          cert_date, app.config['SEARCH_PARALLEL_WORKERS'],
+                                          app.config['SEARCH_PARALLEL_CHECKOUT_TIMEOUT'])
+    else:
+        results = perform_batched_search(cursor, parameters['search_type'], all_counties, counties, items,
+                                         cert_date)
+    return [{'name_result': name_result, 'name_id': item['name_id']}
+            for name_result, item in zip(results, parameters['search_items'])]
 
 
 def get_search_by_request_id(cursor, id):
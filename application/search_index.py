@@ -0,0 +1,46 @@
+# search_index: the party-name search projection. Each row is one (register row, party name) as the search
+# queries used to assemble them by joining party_name, party_name_rel, party, register_details and register,
+# flattened so a search is a scan of one table through search_index_name_ix (searchable_string,
+# name_type_ind) or search_index_number_ix (complex_number). Counties stay in detl_county_rel, which the
+# county-restricted searches test with EXISTS.
+#
+# Expiry is kept as a column rather than dropping rows: whether an entry is revealed depends on the search's
+# certificate date, which may be in the past.
+#
+# The write paths keep it in step: a register row is projected when it is inserted (by which point its
+# parties and names exist, and neither changes afterwards) and expired_on is copied across whenever it is
+# set. Anything written behind the application's back needs 'manage.py rebuild_search_index'.
+
+COLUMNS = "register_id, details_id, party_name_rel_id, party_name_id, searchable_string, complex_number, " \
+          "name_type_ind, party_type, debtor_name_match, class_of_charge, date, year, expired_on, " \
+          "priority_notice_ind, prio_notice_expires"
+
+PROJECTION_SQL = "SELECT r.id, rd.id, pnr.id, pn.id, pn.searchable_string, pn.complex_number, " \
+                 "pn.name_type_ind, p.party_type::text, " \
+                 "(r.debtor_reg_name_id IS NULL OR r.debtor_reg_name_id = pn.id), rd.class_of_charge::text, " \
+                 "r.date, extract(year from r.date)::int, r.expired_on, rd.priority_notice_ind, " \
+                 "rd.prio_notice_expires " \
+                 "FROM party_name pn JOIN party_name_rel pnr ON pnr.party_name_id = pn.id " \
+                 "JOIN party p ON p.id = pnr.party_id " \
+                 "JOIN register_details rd ON rd.id = p.register_detl_id " \
+                 "JOIN register r ON r.details_id = rd.id "
+
+
+def refresh_search_index(cursor, register_ids):
+    # (Re-)projects the given register rows
+    cursor.execute("DELETE FROM search_index WHERE register_id = ANY(%(ids)s)", {'ids': register_ids})
+    cursor.execute("INSERT INTO search_index (" + COLUMNS + ") " + PROJECTION_SQL + "WHERE r.id = ANY(%(ids)s)",
+                   {'ids': register_ids})
+
+
+def expire_in_search_index(cursor, condition, params):
+    # Copies expired_on across for the register rows matching condition (a WHERE clause on register)
+    cursor.execute("UPDATE search_index s SET expired_on = r.expired_on FROM register r "
+                   "WHERE s.register_id = r.id AND " + condition, params)
+
+
+def rebuild_search_index(cursor):
+    # Returns the number of rows projected
+    cursor.execute("TRUNCATE search_index")
+    cursor.execute("INSERT INTO search_index (" + COLUMNS + ") " + PROJECTION_SQL)
+    return cursor.rowcount
@@ -8,6 +8,7 @@
 # This is similar but not identical to the key used by the legacy system. It can easily be
 # converted (by Synchroniser) to *be* identical to the legacy key
 from application import app
+from application.counties import county_reference
 import re
 import psycopg2
 
@@ -138,14 +139,12 @@ def create_limited_name_key(company):
 
 
 def fetch_name_key(cursor, name):
-    cursor.execute('SELECT key FROM county_search_keys WHERE name=%(name)s', {'name': name.upper()})
-    rows = cursor.fetchall()
-    if len(rows) == 0:
+    keys = county_reference(cursor).search_keys.get(name.upper(), [])
+    if len(keys) == 0:
         raise RuntimeError('No variants found for name {}'.format(name))
-    if len(rows) > 1:
+    if len(keys) > 1:
         raise RuntimeError('Too many variants found for name {}'.format(name))
-    key = rows[0]['key']
-    return key
+    return keys[0]
 
 
 def create_local_authority_key(area):
@@ -1,6 +1,12 @@
+import atexit
+import copy
+import json
 import logging
+import logging.handlers
+import os
+import queue
 import sys
-import inspect
+import threading
 
 
 class OutputFilter(logging.Filter):
@@ -22,26 +28,162 @@ class OutputFilter(logging.Filter):
 
 old_factory = logging.getLogRecordFactory()
 app_name = ""
+context_provider = None
+
+
+def set_context_provider(provider):
+    # provider() returns a dict of fields (transaction id, user...) for the current request, or None
+    global context_provider
+    context_provider = provider
+
+
+# Frames between record_factory and the code that called logging.debug() etc.: makeRecord, _log,
+# Logger.<level> and the module-level logging.<level>. logging.audit adds one more.
+CALLER_DEPTH = 5
+AUDIT_CALLER_DEPTH = 6
 
 
 def record_factory(*args, **kwargs):
+    # Only called once the logger has decided the record is enabled, so filtered-out debug calls never
+    # get here. sys._getframe just follows frame pointers; unlike inspect.stack() it doesn't read source.
     record = old_factory(*args, **kwargs)
     record.appname = app_name
-    if record.levelno == 25:
-        record.file = inspect.stack()[6][1]
-        record.line = inspect.stack()[6][2]
-        record.method = inspect.stack()[6][3]
-    else:
-        record.file = inspect.stack()[5][1]
-        record.line = inspect.stack()[5][2]
-        record.method = inspect.stack()[5][3]
+    try:
+        frame = sys._getframe(AUDIT_CALLER_DEPTH if record.levelno == 25 else CALLER_DEPTH)
+        record.file = frame.f_code.co_filename
+        record.line = frame.f_lineno
+        record.method = frame.f_code.co_name
+    except ValueError:  # Stack not that deep; fall back on what logging found for itself
+        record.file = record.pathname
+        record.line = record.lineno
+        record.method = record.funcName
+    # Captured here, on the logging thread; records are formatted later on the listener thread
+    record.context = None if context_provider is None else context_provider()
     return record
 
 
+class JsonFormatter(logging.Formatter):
+    # One JSON object per line: the usual fields, then the request context, then any extra={'fields': {...}}
+    def format(self, record):
+        entry = {
+            'level': record.levelname,
+            'time': '{}.{:03.0f}'.format(self.formatTime(record, "%Y-%m-%dT%H:%M:%S"), record.msecs),
+            'app': getattr(record, 'appname', app_name),
+            'file': getattr(record, 'file', record.pathname),
+            'line': getattr(record, 'line', record.lineno),
+            'method': getattr(record, 'method', record.funcName),
+            'message': record.getMessage()
+        }
+        if getattr(record, 'context', None):
+            entry.update(record.context)
+        if getattr(record, 'fields', None):
+            entry.update(record.fields)
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:  # Already formatted, by BoundedQueueHandler.prepare
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+exception_formatter = logging.Formatter()
+
+
+class BlockingStopListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # The default put_nowait fails if the queue is full at shutdown; the thread is still draining, so wait
+        self.queue.put(self._sentinel)
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    # Hands records to a listener thread that does the actual writing, so requests don't wait on file and
+    # stream I/O. When the queue is full, AUDIT (and anything more severe) waits up to block_seconds for room
+    # and, failing that, is written synchronously on the calling thread: those records are never lost, though
+    # they may then appear out of order. Anything less severe is dropped and counted.
+    def __init__(self, max_size, block_seconds, handlers):
+        super().__init__(queue.Queue(max_size))
+        self.max_size = max_size
+        self.block_seconds = block_seconds
+        self.handlers = handlers
+        self.listener = BlockingStopListener(self.queue, *handlers, respect_handler_level=True)
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record):
+        # The stdlib version formats the whole record into msg, traceback included, and clears exc_info, so
+        # JsonFormatter would never see an exception. Only resolve the message here, and carry the traceback as
+        # exc_text, which both formatters print (without holding on to the frames while the record is queued).
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if record.levelno < 25:
+            try:
+                self.queue.put_nowait(record)
+            except queue.Full:
+                with self._dropped_lock:
+                    self.dropped += 1
+            return
+
+        try:
+            self.queue.put(record, timeout=self.block_seconds)
+        except queue.Full:
+            self.listener.handle(record)
+
+    def start(self):
+        self.listener.start()
+
+    def stop(self):
+        # Drains whatever is queued, then stops the listener thread. logging.shutdown (also run at exit, after
+        # this) flushes and closes the handlers themselves.
+        if self.listener._thread is not None:
+            self.listener.stop()
+
+    def restart_in_child(self):
+        # After a fork only the forking thread survives, so the child has no listener, and the queue (and its
+        # lock) may have been copied mid-update. Records still queued were the parent's to write.
+        self.queue = queue.Queue(self.max_size)
+        self.listener = BlockingStopListener(self.queue, *self.handlers, respect_handler_level=True)
+        with self._dropped_lock:
+            self.dropped = 0
+        self.start()
+
+
+queue_handler = None
+
+
+def stop_logging():
+    # Registered with atexit; also for gunicorn's worker_exit hook
+    if queue_handler is not None:
+        queue_handler.stop()
+
+
+def restart_logging_after_fork():
+    if queue_handler is not None and queue_handler.listener._thread is not None:
+        queue_handler.restart_in_child()
+
+
+def dropped_records():
+    return 0 if queue_handler is None else queue_handler.dropped
+
+
+atexit.register(stop_logging)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=restart_logging_after_fork)
+
+
 def audit(message, *args, **kwargs):
     logging.log(25, message, *args, **kwargs)
 
 
+TEXT_FORMAT = '%(levelname)s %(asctime)s.%(msecs)03d [%(appname)s] %(file)s #%(line)s %(method)s %(message)s'
+
+
 def setup_logging(config):
     level = logging.DEBUG if config['DEBUG'] else logging.INFO
     # Our logging routines signal the start and end of the routes,
@@ -57,24 +199,33 @@ def setup_logging(config):
 
     root_logger = logging.getLogger()
     logging.setLogRecordFactory(record_factory)
-    formatter = logging.Formatter('%(levelname)s %(asctime)s.%(msecs)03d [%(appname)s] %(file)s #%(line)s %(method)s'
-                                  ' %(message)s',
-                                  "%Y-%m-%d %H:%M:%S")
+    if config['LOG_FORMAT'] == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(TEXT_FORMAT, "%Y-%m-%d %H:%M:%S")
 
     out_handler = logging.StreamHandler(sys.stdout)
     out_handler.addFilter(OutputFilter(False, False))
     out_handler.setFormatter(formatter)
-    root_logger.addHandler(out_handler)
 
     err_handler = logging.StreamHandler(sys.stderr)
     err_handler.addFilter(OutputFilter(True, False))
     err_handler.setFormatter(formatter)
-    root_logger.addHandler(err_handler)
 
     audit_handler = logging.FileHandler(config['AUDIT_LOG_FILENAME'])
     # audit_handler = logging.StreamHandler(sys.stdout)
     audit_handler.addFilter(OutputFilter(False, True))
     audit_handler.setFormatter(formatter)
-    root_logger.addHandler(audit_handler)
+
+    handlers = [out_handler, err_handler, audit_handler]
+    if config['LOG_ASYNC']:
+        global queue_handler
+        stop_logging()
+        queue_handler = BoundedQueueHandler(config['LOG_QUEUE_SIZE'], config['LOG_QUEUE_BLOCK_SECONDS'], handlers)
+        queue_handler.start()
+        root_logger.addHandler(queue_handler)
+    else:
+        for handler in handlers:
+            root_logger.addHandler(handler)
 
     root_logger.setLevel(level)
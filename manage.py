@@ -3,6 +3,7 @@ from flask.ext.script import Manager
 from flask.ext.migrate import Migrate, MigrateCommand
 from flask.ext.sqlalchemy import SQLAlchemy
 import os
+import sys
 
 app = Flask(__name__)
 app.config.from_object('config.Config')
@@ -13,5 +14,44 @@ migrate = Migrate(app, db)
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def check_chains():
+    """Check register_chain against the amends links on register_details"""
+    import psycopg2.extras
+    from application.data import connect, complete
+    from application.chain import check_chains as find_mismatches
+
+    cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
+    try:
+        rows = find_mismatches(cursor)
+    finally:
+        complete(cursor)
+
+    for row in rows:
+        print("details {}: expected chain {} position {}, found chain {} position {}".format(
+            row['details_id'], row['expected_chain_id'], row['expected_position'],
+            row['chain_id'], row['chain_position']))
+    print("{} inconsistent register_chain entries".format(len(rows)))
+    if len(rows) > 0:
+        sys.exit(1)
+
+
+@manager.command
+def rebuild_search_index():
+    """Re-project search_index from the register tables"""
+    import psycopg2.extras
+    from application.data import connect, complete, rollback
+    from application.search_index import rebuild_search_index as rebuild
+
+    cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
+    try:
+        rows = rebuild(cursor)
+        complete(cursor)
+    except:
+        rollback(cursor)
+        raise
+    print("{} search_index rows".format(rows))
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
@@ -0,0 +1,49 @@
+"""Search index without counties
+
+Revision ID: 0b6e3f7d2c58
+Revises: f4a8c1d93e26
+Create Date: 2016-06-08 15:03:52.114380
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '0b6e3f7d2c58'
+down_revision = 'f4a8c1d93e26'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # The county-restricted searches now test detl_county_rel directly, so search_index needs only one row
+    # per register row and name
+    op.execute("DELETE FROM search_index WHERE NOT first_county")
+    with op.batch_alter_table("search_index") as batch_op:
+        batch_op.drop_column('first_county')
+        batch_op.drop_column('county')
+    op.create_index('detl_county_details_county_ix', 'detl_county_rel', ['details_id', 'county_id'])
+
+
+def downgrade():
+    op.drop_index('detl_county_details_county_ix')
+    with op.batch_alter_table("search_index") as batch_op:
+        batch_op.add_column(sa.Column('county', sa.Unicode()))
+        batch_op.add_column(sa.Column('first_county', sa.Boolean(), nullable=False, server_default=sa.true()))
+    # Put back the per-county rows: refill from the register tables as the original migration did
+    op.execute("TRUNCATE search_index")
+    op.execute("INSERT INTO search_index (register_id, details_id, party_name_rel_id, party_name_id, "
+               "searchable_string, complex_number, name_type_ind, party_type, debtor_name_match, class_of_charge, "
+               "date, year, expired_on, priority_notice_ind, prio_notice_expires, county, first_county) "
+               "SELECT r.id, rd.id, pnr.id, pn.id, pn.searchable_string, pn.complex_number, pn.name_type_ind, "
+               "p.party_type::text, (r.debtor_reg_name_id IS NULL OR r.debtor_reg_name_id = pn.id), "
+               "rd.class_of_charge::text, r.date, extract(year from r.date)::int, r.expired_on, "
+               "rd.priority_notice_ind, rd.prio_notice_expires, UPPER(c.name), "
+               "row_number() OVER (PARTITION BY r.id, pnr.id ORDER BY dcr.id) = 1 "
+               "FROM party_name pn JOIN party_name_rel pnr ON pnr.party_name_id = pn.id "
+               "JOIN party p ON p.id = pnr.party_id "
+               "JOIN register_details rd ON rd.id = p.register_detl_id "
+               "JOIN register r ON r.details_id = rd.id "
+               "LEFT JOIN detl_county_rel dcr ON dcr.details_id = rd.id "
+               "LEFT JOIN county c ON c.id = dcr.county_id")
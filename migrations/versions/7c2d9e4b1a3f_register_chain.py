@@ -0,0 +1,38 @@
+"""Register chain
+
+Revision ID: 7c2d9e4b1a3f
+Revises: de2f06ae3e53
+Create Date: 2016-05-16 09:12:41.503118
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7c2d9e4b1a3f'
+down_revision = 'de2f06ae3e53'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('register_chain',
+                    sa.Column('details_id', sa.Integer(), sa.ForeignKey('register_details.id'), primary_key=True),
+                    sa.Column('chain_id', sa.Integer(), nullable=False),
+                    sa.Column('chain_position', sa.Integer(), nullable=False))
+    op.create_index('register_chain_chain_ix', 'register_chain', ['chain_id', 'chain_position'])
+
+    # Backfill: every chain starts at an entry that amends nothing (or something that no longer exists)
+    op.execute("INSERT INTO register_chain (details_id, chain_id, chain_position) "
+               "WITH RECURSIVE chain(id, chain_id, position) AS ("
+               "  SELECT d.id, d.id, 0 FROM register_details d "
+               "  WHERE d.amends IS NULL OR NOT EXISTS (SELECT 1 FROM register_details p WHERE p.id = d.amends)"
+               "  UNION ALL"
+               "  SELECT d.id, c.chain_id, c.position + 1 FROM register_details d JOIN chain c ON d.amends = c.id) "
+               "SELECT id, chain_id, position FROM chain")
+
+
+def downgrade():
+    op.drop_index('register_chain_chain_ix')
+    op.drop_table('register_chain')
@@ -0,0 +1,32 @@
+"""Additional information cache
+
+Revision ID: b84f1e6c2d90
+Revises: 7c2d9e4b1a3f
+Create Date: 2016-05-18 14:03:27.918260
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'b84f1e6c2d90'
+down_revision = '7c2d9e4b1a3f'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('addl_info_cache',
+                    sa.Column('details_id', sa.Integer(), primary_key=True),
+                    sa.Column('registration_no', sa.Integer(), primary_key=True),
+                    sa.Column('date', sa.Date(), primary_key=True),
+                    sa.Column('chain_id', sa.Integer(), nullable=False),
+                    sa.Column('chain_version', sa.String(), nullable=False),
+                    sa.Column('text', sa.Unicode()))
+    op.create_index('addl_info_cache_chain_ix', 'addl_info_cache', ['chain_id'])
+
+
+def downgrade():
+    op.drop_index('addl_info_cache_chain_ix')
+    op.drop_table('addl_info_cache')
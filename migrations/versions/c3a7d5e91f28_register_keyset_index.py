@@ -0,0 +1,25 @@
+"""Register keyset index
+
+Revision ID: c3a7d5e91f28
+Revises: b84f1e6c2d90
+Create Date: 2016-05-20 11:47:09.331862
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c3a7d5e91f28'
+down_revision = 'b84f1e6c2d90'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # Supports paging through GET /registrations in (date, number) order
+    op.create_index('register_date_no_id_ix', 'register', ['date', 'registration_no', 'id'])
+
+
+def downgrade():
+    op.drop_index('register_date_no_id_ix')
@@ -0,0 +1,30 @@
+"""Registration counter
+
+Revision ID: d6b2e0f4a815
+Revises: c3a7d5e91f28
+Create Date: 2016-05-24 10:05:52.114709
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'd6b2e0f4a815'
+down_revision = 'c3a7d5e91f28'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('registration_counter',
+                    sa.Column('year', sa.Integer(), primary_key=True),
+                    sa.Column('next_no', sa.Integer(), nullable=False))
+
+    op.execute("INSERT INTO registration_counter (year, next_no) "
+               "SELECT extract(year FROM date), MAX(registration_no) + 1 FROM register "
+               "WHERE date IS NOT NULL GROUP BY extract(year FROM date)")
+
+
+def downgrade():
+    op.drop_table('registration_counter')
@@ -0,0 +1,35 @@
+"""Event outbox
+
+Revision ID: e1f5c2a7b394
+Revises: d6b2e0f4a815
+Create Date: 2016-05-31 14:22:09.381562
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'e1f5c2a7b394'
+down_revision = 'd6b2e0f4a815'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+def upgrade():
+    op.create_table('event_outbox',
+                    sa.Column('id', sa.Integer(), primary_key=True),
+                    sa.Column('application', sa.Unicode(), nullable=False),
+                    sa.Column('payload', postgresql.JSON(), nullable=False),
+                    sa.Column('created_at', sa.DateTime(), nullable=False, server_default=sa.func.now()),
+                    sa.Column('published_at', sa.DateTime(), nullable=True))
+    # The relay reads unpublished events in id order; published ones are only touched when they expire
+    op.execute("CREATE INDEX event_outbox_unpublished_ix ON event_outbox (id) WHERE published_at IS NULL")
+    op.create_index('event_outbox_published_ix', 'event_outbox', ['published_at'])
+
+
+def downgrade():
+    op.drop_index('event_outbox_published_ix')
+    op.drop_index('event_outbox_unpublished_ix')
+    op.drop_table('event_outbox')
@@ -0,0 +1,64 @@
+"""Search index
+
+Revision ID: f4a8c1d93e26
+Revises: e1f5c2a7b394
+Create Date: 2016-06-06 10:41:27.906114
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'f4a8c1d93e26'
+down_revision = 'e1f5c2a7b394'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('search_index',
+                    sa.Column('id', sa.Integer(), primary_key=True),
+                    sa.Column('register_id', sa.Integer(), sa.ForeignKey('register.id'), nullable=False),
+                    sa.Column('details_id', sa.Integer(), nullable=False),
+                    sa.Column('party_name_rel_id', sa.Integer(), nullable=False),
+                    sa.Column('party_name_id', sa.Integer(), nullable=False),
+                    sa.Column('searchable_string', sa.Unicode()),
+                    sa.Column('complex_number', sa.Integer()),
+                    sa.Column('name_type_ind', sa.Unicode()),
+                    sa.Column('party_type', sa.Unicode()),
+                    sa.Column('debtor_name_match', sa.Boolean(), nullable=False),
+                    sa.Column('class_of_charge', sa.Unicode()),
+                    sa.Column('date', sa.Date()),
+                    sa.Column('year', sa.Integer()),
+                    sa.Column('expired_on', sa.Date()),
+                    sa.Column('priority_notice_ind', sa.Boolean()),
+                    sa.Column('prio_notice_expires', sa.Date()),
+                    sa.Column('county', sa.Unicode()),
+                    sa.Column('first_county', sa.Boolean(), nullable=False))
+    op.create_index('search_index_name_ix', 'search_index', ['searchable_string', 'name_type_ind'])
+    op.create_index('search_index_number_ix', 'search_index', ['complex_number'])
+    op.create_index('search_index_register_ix', 'search_index', ['register_id'])
+
+    # Backfill: see application/search_index.py, which this must match
+    op.execute("INSERT INTO search_index (register_id, details_id, party_name_rel_id, party_name_id, "
+               "searchable_string, complex_number, name_type_ind, party_type, debtor_name_match, class_of_charge, "
+               "date, year, expired_on, priority_notice_ind, prio_notice_expires, county, first_county) "
+               "SELECT r.id, rd.id, pnr.id, pn.id, pn.searchable_string, pn.complex_number, pn.name_type_ind, "
+               "p.party_type::text, (r.debtor_reg_name_id IS NULL OR r.debtor_reg_name_id = pn.id), "
+               "rd.class_of_charge::text, r.date, extract(year from r.date)::int, r.expired_on, "
+               "rd.priority_notice_ind, rd.prio_notice_expires, UPPER(c.name), "
+               "row_number() OVER (PARTITION BY r.id, pnr.id ORDER BY dcr.id) = 1 "
+               "FROM party_name pn JOIN party_name_rel pnr ON pnr.party_name_id = pn.id "
+               "JOIN party p ON p.id = pnr.party_id "
+               "JOIN register_details rd ON rd.id = p.register_detl_id "
+               "JOIN register r ON r.details_id = rd.id "
+               "LEFT JOIN detl_county_rel dcr ON dcr.details_id = rd.id "
+               "LEFT JOIN county c ON c.id = dcr.county_id")
+
+
+def downgrade():
+    op.drop_index('search_index_register_ix')
+    op.drop_index('search_index_number_ix')
+    op.drop_index('search_index_name_ix')
+    op.drop_table('search_index')
@@ -0,0 +1,33 @@
+# Timing for group_by_request over a synthetic registration day. Not collected by the test runner:
+#   python -m tests.benchmark_grouping
+# Times should grow linearly with the number of rows.
+from application.data import group_by_request
+import datetime
+import random
+import time
+
+
+def synthetic_day(row_count):
+    # Mostly single-registration requests with the odd multi-county/AKA one, as on a migration day
+    rows = []
+    request_id = 0
+    while len(rows) < row_count:
+        request_id += 1
+        for _ in range(random.choice([1, 1, 1, 2, 5])):
+            rows.append({
+                'registration_no': 1000 + len(rows), 'date': datetime.date(2016, 3, 1), 'class_of_charge': 'C1',
+                'amends': None, 'cancelled_by': None, 'request_id': request_id, 'amendment_type': None,
+                'register_id': len(rows)
+            })
+    return rows[:row_count]
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    for count in [10000, 25000, 50000, 100000]:
+        rows = synthetic_day(count)
+        start = time.perf_counter()
+        results = group_by_request(rows)
+        elapsed = time.perf_counter() - start
+        print("{:>7} rows, {:>6} requests: {:.3f}s ({:.2f}us/row)".format(
+            count, len(results), elapsed, elapsed * 1000000 / count))
@@ -0,0 +1,32 @@
+# Timing for registration validation with validators built once at import. Not collected by the test runner:
+#   python -m tests.benchmark_schema
+# Compares against building a Draft4Validator per call, as every POST/PUT used to.
+from application.schema import validate_registration, REGISTRATION_SCHEMA, schema_errors
+from jsonschema import Draft4Validator
+import copy
+import json
+import logging
+import os
+import time
+
+
+def timed(label, function, data, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        function(data)
+    elapsed = time.perf_counter() - start
+    print("{:<32} {:>6} calls: {:.3f}s ({:.1f}us/call)".format(label, count, elapsed, elapsed * 1000000 / count))
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)  # schema_errors logs each error at debug
+    directory = os.path.dirname(__file__)
+    valid = json.loads(open(os.path.join(directory, 'data/valid_data.json'), 'r').read())
+    valid['applicant']['address_type'] = 'RM'  # the fixture predates address_type
+    invalid = copy.deepcopy(valid)
+    invalid['parties'][0]['names'][0]['type'] = 'Nobody'
+
+    for label, data in [('valid', valid), ('invalid', invalid)]:
+        timed(label + ', validator per call', lambda d: schema_errors(Draft4Validator(REGISTRATION_SCHEMA), d),
+              data, 2000)
+        timed(label + ', precompiled', validate_registration, data, 2000)
@@ -0,0 +1,48 @@
+# Wall-clock time of a full search run as one query and split over pooled connections, for 10, 50 and 100
+# names taken from the configured database. Not collected by the test runner:
+#   python -m tests.benchmark_search
+# The parallel search needs SEARCH_PARALLEL_WORKERS + 1 connections (DB_POOL_MAX_SIZE).
+from application import app
+from application.data import connect, rollback
+from application.search import perform_batched_search, perform_parallel_search
+import datetime
+import psycopg2.extras
+import time
+
+
+def timed(search, repeats=5):
+    # Best of repeats, in seconds
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        results = search()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+if __name__ == '__main__':
+    workers = app.config['SEARCH_PARALLEL_WORKERS']
+    cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
+    try:
+        cursor.execute("SELECT searchable_string, name_type_ind, complex_number FROM party_name "
+                       "WHERE searchable_string IS NOT NULL ORDER BY id DESC FETCH FIRST 100 ROWS ONLY")
+        names = [([row['searchable_string']], row['name_type_ind'], row['complex_number'], 1925, 2016)
+                 for row in cursor.fetchall()]
+        date = datetime.date.today()
+        counties = ['DEVON', 'CORNWALL', 'SOMERSET']
+
+        for count in [10, 50, 100]:
+            items = names[:count]
+            for all_counties in [True, False]:
+                sequential, expected = timed(lambda: perform_batched_search(
+                    cursor, 'full', all_counties, counties, items, date))
+                parallel, results = timed(lambda: perform_parallel_search(
+                    cursor, 'full', all_counties, counties, items, date, workers,
+                    app.config['SEARCH_PARALLEL_CHECKOUT_TIMEOUT']))
+                assert results == expected
+                print("{:>3} names, {:<12} one query {:7.1f}ms, {} connections {:7.1f}ms ({:.2f}x)".format(
+                    len(items), 'all counties' if all_counties else '3 counties', sequential * 1000, workers,
+                    parallel * 1000, sequential / parallel))
+    finally:
+        rollback(cursor)
@@ -0,0 +1,278 @@
+# The original one-query-per-relation entry loader, from before build_details and DETAIL_RELATIONS_SQL, with
+# the lookups only it used. TestDetailsParity compares the single-query loader against it.
+from application.data import order_names, set_address_detail, set_address_without_detail
+import logging
+import re
+
+
+def get_registration_no_from_details_id(cursor, details_id):
+    cursor.execute("select r.registration_no, r.date, d.amendment_type from register r, register_details d where " +
+                   "  r.details_id = %(id)s AND r.details_id = d.id",
+                   {'id': details_id})
+    rows = cursor.fetchall()
+    if len(rows) == 0:
+        raise RuntimeError("No registration found for details {}".format(details_id))
+    else:
+        return {
+            'number': rows[0]['registration_no'],
+            'date': rows[0]['date'].strftime('%Y-%m-%d')
+        }
+
+
+def read_names(cursor, party, party_id, lead_debtor_id):
+    cursor.execute('select n.id, forename, middle_names, surname, complex_number, complex_name, '
+                   'name_type_ind, company_name, local_authority_name, local_authority_area, '
+                   'other_name, searchable_string, subtype '
+                   'from party_name n, party_name_rel pn '
+                   'where n.id = pn.party_name_id and pn.party_id = %(id)s order by n.id', {
+                       'id': party_id
+                   })
+    rows = cursor.fetchall()
+    party['names'] = order_names(rows, lead_debtor_id)
+
+
+def get_address_detail(cursor, address, detail_id):
+    cursor.execute('SELECT line_1, line_2, line_3, line_4, line_5, line_6, country_id, county, postcode '
+                   'FROM address_detail '
+                   'WHERE id=%(id)s', {
+                       'id': detail_id
+                   })
+    rows = cursor.fetchall()
+    if len(rows) == 0:
+        return
+    if len(rows) > 1:
+        raise RuntimeError("Unexpected multitude of address details")
+
+    set_address_detail(address, rows[0])
+
+
+def read_addresses(cursor, party, party_id):
+    cursor.execute('SELECT address_type, address_string, detail_id '
+                   'FROM party_address pa, address a '
+                   'WHERE pa.party_id = %(pid)s AND pa.address_id = a.id', {
+                       'pid': party_id
+                   })
+    rows = cursor.fetchall()
+    party['addresses'] = []
+    for row in rows:
+        address = {
+            'type': row['address_type'],
+            'address_string': row['address_string']
+        }
+        get_address_detail(cursor, address, row['detail_id'])
+        set_address_without_detail(address)
+        party['addresses'].append(address)
+
+
+def read_parties(cursor, data, details_id, legal_ref, lead_debtor_id):
+    cursor.execute("SELECT id, party_type, occupation, date_of_birth, residence_withheld "
+                   "FROM party "
+                   "WHERE register_detl_id = %(id)s and party_type != 'Court' ", {
+                       'id': details_id
+                   })
+    rows = cursor.fetchall()
+    data['parties'] = []
+    for row in rows:
+        party = {
+            'type': row['party_type']
+        }
+
+        if row['occupation']:
+            party['occupation'] = row['occupation']
+
+        if party['type'] == 'Debtor':
+
+            if row['date_of_birth'] is not None:
+                party['date_of_birth'] = row['date_of_birth'].strftime('%Y-%m-%d')
+            else:
+                party['date_of_birth'] = None
+            party['residence_withheld'] = row['residence_withheld']
+            party['case_reference'] = legal_ref
+            read_addresses(cursor, party, row['id'])
+
+        data['parties'].append(party)
+        read_names(cursor, party, row['id'], lead_debtor_id)
+
+
+def get_lc_counties(cursor, details_id, lead_county_id):
+    cursor.execute("SELECT name FROM county WHERE id=%(id)s", {'id': lead_county_id})
+    row = cursor.fetchone()
+    
+    if row is None:  # This is a migrated record with no recorded county
+        counties = []
+    else:
+        counties = [row['name']]
+
+        cursor.execute("select dcr.county_id, c.name  from detl_county_rel dcr, county c " +
+                       "where dcr.details_id = %(id)s and dcr.county_id = c.id ", {'id': details_id})
+        rows = cursor.fetchall()
+
+        if len(rows) != 0:
+            for row in rows:
+                cty = row['name']
+                if cty not in counties:
+                    counties.append(cty)
+
+    return counties
+
+
+def get_details_from_rows_iterative(cursor, rows, fetch_amend_detail=False):
+    assert len(rows) > 0
+    details_id = rows[0]['id']
+    lead_county = rows[0]['county_id']
+    lead_debtor_id = rows[0]['debtor_reg_name_id']
+    request_id = rows[0]['request_id']
+
+    add_info = ''
+    if rows[0]['additional_info'] is not None:
+        add_info = rows[0]['additional_info']
+
+    data = {
+        'registration': {
+            'number': rows[0]['registration_no'],
+            'date': rows[0]['date'].strftime('%Y-%m-%d'),
+            'sequence': rows[0]['reg_sequence_no']
+        },
+        'details_id': details_id,
+        'class_of_charge': rows[0]['class_of_charge'],
+        'status': 'current',
+        'entered_addl_info': add_info
+        # 'additional_information': add_info
+    }
+
+    if rows[0]['expired_on'] is None:
+        data['expired_date'] = None
+    else:
+        data['expired_date'] = rows[0]['expired_on'].strftime("%Y-%m-%d")
+
+    if data['class_of_charge'] not in ['PAB', 'WOB']:
+        if rows[0]['priority_notice_ind']:
+            data['priority_notice'] = {
+                "expires": rows[0]['prio_notice_expires'].strftime('%Y-%m-%d')
+            }
+
+        data['particulars'] = {
+            'counties': get_lc_counties(cursor, details_id, lead_county),
+            'district': rows[0]['district'],
+            'description': rows[0]['short_description']
+        }
+
+        if rows[0]['priority_notice_no']:
+            data['particulars']['priority_notice'] = rows[0]['priority_notice_no']
+
+    register_id = rows[0]['register_id']
+    data['register_id'] = rows[0]['register_id']
+    if len(rows) > 1:
+        data['alternate_register_ids'] = []
+        for row in rows[1:]:
+            data['alternate_register_ids'].append(row['register_id'])
+
+    logging.debug('------------------')
+
+    legal_ref = rows[0]['legal_body_ref']
+    logging.debug(legal_ref)
+    logging.debug(add_info)
+
+    if legal_ref is not None and add_info is not None:
+        if re.search("^\d+ OF \d{4}$", legal_ref, re.IGNORECASE) and re.search("\d+ OF \d{4}", add_info, re.IGNORECASE):
+            # loading migration record
+            legal_ref = add_info
+
+    if rows[0]['amends'] is not None:
+        amend_of = get_registration_no_from_details_id(cursor, rows[0]['amends'])
+        if not fetch_amend_detail and (amend_of['number'] == data['registration']['number'] and amend_of['date'] == data['registration']['date']):
+            pass  # Don't show 'amends_registration' where its an update to an existing regn
+
+        else:
+            data['amends_registration'] = amend_of
+            data['amends_registration']['type'] = rows[0]['amendment_type']
+
+            ait = rows[0]['amend_info_type']
+            if ait in ['instrument', 'chargee']:
+                data['amends_registration'][ait] = {
+                    'original': rows[0]['amend_info_details_orig'],
+                    'current': rows[0]['amend_info_details']
+                }
+            else:
+                data['amends_registration'][ait] = rows[0]['amend_info_details']
+
+    if rows[0]['cancelled_by'] is not None:
+        cursor.execute("select amends, amendment_type from register_details where amends=%(id)s",
+                       {"id": details_id})
+        amd_rows = cursor.fetchall()
+        if len(amd_rows) > 0:
+            data['status'] = 'superseded'
+        else:
+            data['status'] = 'cancelled'
+            data['cancellation'] = {'reference': rows[0]['cancelled_by']}
+            # TODO: this is bugged
+            # cursor.execute('select application_date from request where id=%(id)s', {'id': data['cancellation_ref']})
+            # cancel_rows = cursor.fetchall()
+            # data['cancellation']['date'] = cancel_rows[0]['application_date'].isoformat()
+
+    cursor.execute('select r.registration_no, r.date, d.amendment_type, d.amends FROM register r, register_details d ' +
+                   'WHERE r.details_id=d.id AND d.amends=%(id)s', {'id': details_id})
+    rows = cursor.fetchall()
+    if len(rows) > 0:
+        data['amended_by'] = {
+            'number': rows[0]['registration_no'],
+            'date': rows[0]['date'].strftime('%Y-%m-%d'),
+            'type': rows[0]['amendment_type']
+        }
+
+    read_parties(cursor, data, details_id, legal_ref, lead_debtor_id)
+
+    cursor.execute("select key_number, application_reference, customer_name, customer_address, "
+                   "customer_addr_type FROM "
+                   "request WHERE id=%(rid)s", {'rid': request_id})
+    rows = cursor.fetchall()
+    if len(rows) > 0:
+            data['applicant'] = {
+                'name': rows[0]['customer_name'],
+                'address': rows[0]['customer_address'],
+                'key_number': rows[0]['key_number'],
+                'reference': rows[0]['application_reference'],
+                'address_type': rows[0]['customer_addr_type'],
+            }
+
+    cursor.execute("SELECT extra_data, original_regn_no FROM migration_status WHERE register_id=%(id)s", {
+        "id": register_id
+    })
+    rows = cursor.fetchall()
+    if len(rows) > 0:
+        data['migrated'] = {
+            'original_number': rows[0]['original_regn_no'],
+            'extra_data': rows[0]['extra_data']
+        }
+
+    # name, address, keyn, ref
+    return data
+
+
+def get_addl_class(cursor, data):
+    # Determing whether to use new reg no or original...
+
+    if data['registration']['sequence'] > 1:  # This data can only exist for migrated records
+        return
+
+    if 'migrated' in data and data['migrated']['original_number'] != data['registration']['number']:
+        cursor.execute("SELECT class_of_charge FROM addl_class_of_charge WHERE "
+                       "orig_number =%(no)s AND date=%(date)s ",
+                       {
+                           "no": data['migrated']['original_number'],
+                           "date": data['registration']['date']
+                       })
+    else:
+        cursor.execute("SELECT class_of_charge FROM addl_class_of_charge WHERE "
+                       "number=%(no)s AND date=%(date)s ",
+                       {
+                           "no": data['registration']['number'],
+                           "date": data['registration']['date']
+                       })
+    rows = cursor.fetchall()
+    classes = []
+    for row in rows:
+        classes.append(row['class_of_charge'])
+
+    if len(classes) > 0:
+        data['additional_classes'] = classes
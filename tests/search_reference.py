@@ -0,0 +1,114 @@
+# The search rules as they were written against the register tables, before search_index and the EXISTS
+# county test. Quirks included: the complex-number match on the full search ignores name type over all
+# counties but not over selected ones, and drops the court filter there. The parity tests run these through
+# application.search's batched statement as the reference for its own matches.
+
+BANKRUPTCY_CLASS_CLAUSE = "  AND rd.class_of_charge in ('PAB', 'WOB', 'PA', 'WO', 'DA') "
+
+BANKRUPTCY_NAME_MATCH = "SELECT r.id " \
+                        "FROM party_name n, register r, register_details rd, party p, party_name_rel pnr " \
+                        "WHERE n.searchable_string = ANY(i.keys) " \
+                        "  AND n.id = pnr.party_name_id " \
+                        "  AND pnr.party_id = p.id " \
+                        "  and p.party_type != 'Court' " \
+                        "  AND p.register_detl_id = rd.id " \
+                        "  AND r.details_id = rd.id " \
+                        "  AND r.date <= %(date)s " \
+                        "  AND (r.expired_on is NULL OR %(date)s < r.expired_on) " + \
+                        BANKRUPTCY_CLASS_CLAUSE + \
+                        "  AND n.name_type_ind = i.name_type"
+
+BANKRUPTCY_NUMBER_MATCH = "SELECT r.id " \
+                          "FROM party_name n, register r, register_details rd, party p, party_name_rel pnr " \
+                          "WHERE n.complex_number = i.number " \
+                          "  AND n.id = pnr.party_name_id " \
+                          "  AND pnr.party_id = p.id " \
+                          "  and p.party_type != 'Court' " \
+                          "  AND p.register_detl_id = rd.id " \
+                          "  AND r.details_id = rd.id " \
+                          "  AND r.date <= %(date)s" \
+                          "  AND (r.expired_on is NULL OR %(date)s < r.expired_on)" + \
+                          BANKRUPTCY_CLASS_CLAUSE + \
+                          "  AND n.name_type_ind = 'Complex Name' "
+
+# Conditions shared by every full search query, after the name match
+FULL_SEARCH_CONDITIONS = "  and (r.debtor_reg_name_id is null or r.debtor_reg_name_id = pn.id) " \
+                         "  and (" \
+                         "      rd.priority_notice_ind='f' " \
+                         "      or rd.priority_notice_ind IS NULL " \
+                         "      or (priority_notice_ind='y' and rd.prio_notice_expires >= %(exdate)s) " \
+                         "  )"
+
+FULL_SEARCH_ALL_COUNTIES_CONDITIONS = FULL_SEARCH_CONDITIONS + \
+    "  and ( " \
+    "     extract(year from r.date) between i.year_from and i.year_to " \
+    "     or rd.class_of_charge in ('PA', 'WO', 'DA', 'PAB', 'WOB')" \
+    "  ) " \
+    "  and r.date <= %(date)s " \
+    "  AND (r.expired_on is NULL OR %(date)s < r.expired_on)"
+
+FULL_SEARCH_COUNTIES_CONDITIONS = FULL_SEARCH_CONDITIONS + \
+    "  AND (" \
+    "      rd.class_of_charge in ('PA', 'WO', 'DA', 'PAB', 'WOB' ) " \
+    "      OR ( " \
+    "          extract(year from r.date) between i.year_from and i.year_to " \
+    "          AND ( " \
+    "              rd.class_of_charge = 'A' " \
+    "              OR UPPER(c.name) = ANY(%(counties)s) " \
+    "              OR c.name IS NULL" \
+    "          ) " \
+    "      ) " \
+    "  ) " \
+    " and r.date <= %(date)s " \
+    "  AND (r.expired_on is NULL OR %(date)s < r.expired_on)"
+
+FULL_SEARCH_FROM = "FROM party_name pn, register r, party_name_rel pnr, party p, register_details rd "
+
+FULL_SEARCH_COUNTIES_FROM = FULL_SEARCH_FROM + \
+    "FULL OUTER JOIN detl_county_rel dcr on rd.id = dcr.details_id " \
+    "FULL OUTER JOIN county c on dcr.county_id = c.id "
+
+FULL_NAME_MATCH_ALL_COUNTIES = "SELECT r.id " + FULL_SEARCH_FROM + \
+                               "WHERE pn.searchable_string = ANY(i.keys) " \
+                               "  and pnr.party_name_id = pn.id and pnr.party_id=p.id " \
+                               "  and p.party_type != 'Court' " \
+                               "  and p.register_detl_id=rd.id " \
+                               "  and rd.id=r.details_id " \
+                               "  and pn.name_type_ind = ANY(i.name_types) " + \
+                               FULL_SEARCH_ALL_COUNTIES_CONDITIONS
+
+FULL_NUMBER_MATCH_ALL_COUNTIES = "SELECT r.id " + FULL_SEARCH_FROM + \
+                                 "WHERE pn.complex_number = i.number " \
+                                 "  and pnr.party_name_id = pn.id and pnr.party_id=p.id " \
+                                 "  and p.party_type != 'Court' " \
+                                 "  and p.register_detl_id=rd.id " \
+                                 "  and rd.id=r.details_id " + \
+                                 FULL_SEARCH_ALL_COUNTIES_CONDITIONS
+
+FULL_NAME_MATCH_COUNTIES = "SELECT r.id " + FULL_SEARCH_COUNTIES_FROM + \
+                           "WHERE pn.searchable_string= ANY(i.keys) " \
+                           "  and pnr.party_name_id = pn.id and pnr.party_id=p.id " \
+                           "  and p.party_type != 'Court' " \
+                           "  and p.register_detl_id=rd.id " \
+                           "  and rd.id=r.details_id " \
+                           "  and pn.name_type_ind = ANY(i.name_types) " + \
+                           FULL_SEARCH_COUNTIES_CONDITIONS
+
+FULL_NUMBER_MATCH_COUNTIES = "SELECT r.id " + FULL_SEARCH_COUNTIES_FROM + \
+                             "WHERE pn.complex_number = i.number " \
+                             "  and pnr.party_name_id = pn.id and pnr.party_id=p.id " \
+                             "  and p.register_detl_id=rd.id " \
+                             "  and rd.id=r.details_id " \
+                             "  and pn.name_type_ind = i.name_type " + \
+                             FULL_SEARCH_COUNTIES_CONDITIONS
+
+# (name match, number match) by (search type, over all counties), as application.search.BATCHED_MATCHES
+REFERENCE_MATCHES = {
+    ('banks', True): (BANKRUPTCY_NAME_MATCH, BANKRUPTCY_NUMBER_MATCH),
+    ('full', True): (FULL_NAME_MATCH_ALL_COUNTIES, FULL_NUMBER_MATCH_ALL_COUNTIES),
+    ('full', False): (FULL_NAME_MATCH_COUNTIES, FULL_NUMBER_MATCH_COUNTIES),
+}
+
+
+def reference_matches(search_type, all_counties):
+    return REFERENCE_MATCHES[('banks', True) if search_type != 'full' else ('full', all_counties)]
@@ -0,0 +1,120 @@
+from unittest import mock
+from application.data import connect, complete, rollback, allocate_registration_no, insert_registration
+import psycopg2
+import psycopg2.extras
+import pytest
+import threading
+
+
+class TestAllocation:
+    def test_counter_seeded_on_first_use(self):
+        cursor = mock.Mock(**{'fetchone.side_effect': [None, {'reg': 1000}]})
+        assert allocate_registration_no(cursor, 2016) == 1000
+        sql = [call[0][0] for call in cursor.execute.call_args_list]
+        assert sql[0].startswith('UPDATE registration_counter')
+        assert 'INSERT INTO registration_counter' in sql[2]
+        assert sql[-1].startswith('UPDATE registration_counter')
+
+    def test_register_not_locked(self):
+        cursor = mock.Mock(**{
+            'fetchone.side_effect': [{'reg': 1042}, [77]],
+            'fetchall.return_value': [{'seq_no': None}]
+        })
+        assert insert_registration(cursor, 5, 6, '2016-03-01', 3) == (1042, 77)
+        for call in cursor.execute.call_args_list:
+            assert 'LOCK TABLE' not in call[0][0]
+
+
+class TestAllocationConcurrency:
+    # Needs a database. Allocates numbers for a year far enough ahead not to collide with real data,
+    # and rolls back a share of the transactions to check those numbers are handed out again.
+    year = 2097
+
+    def test_parallel_allocation_has_no_duplicates_or_gaps(self):
+        try:
+            cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
+        except psycopg2.OperationalError:
+            pytest.skip('database not available')
+        cursor.execute("DELETE FROM registration_counter WHERE year = %(year)s", {'year': self.year})
+        complete(cursor)
+
+        allocated = []
+        errors = []
+
+        def register(index):
+            try:
+                cur = connect(cursor_factory=psycopg2.extras.DictCursor)
+                number = allocate_registration_no(cur, self.year)
+                if index % 4 == 0:
+                    rollback(cur)
+                else:
+                    allocated.append(number)
+                    complete(cur)
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=register, args=(i,)) for i in range(40)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
+        cursor.execute("DELETE FROM registration_counter WHERE year = %(year)s", {'year': self.year})
+        complete(cursor)
+
+        assert errors == []
+        assert sorted(allocated) == list(range(1000, 1000 + len(allocated)))
+
+    def test_parallel_registrations_get_distinct_numbers(self):
+        # Two connections registering at once, as two requests would. The entries reuse an existing entry's
+        # details and are deleted again afterwards.
+        try:
+            cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
+        except psycopg2.OperationalError:
+            pytest.skip('database not available')
+        cursor.execute("SELECT details_id, debtor_reg_name_id, county_id FROM register ORDER BY id "
+                       "FETCH FIRST 1 ROW ONLY")
+        template = cursor.fetchone()
+        cursor.execute("DELETE FROM registration_counter WHERE year = %(year)s", {'year': self.year})
+        complete(cursor)
+        if template is None:
+            pytest.skip('no register entries to copy')
+
+        registered = []
+        errors = []
+        start = threading.Barrier(2)
+
+        def register():
+            try:
+                start.wait()
+                for _ in range(10):
+                    cur = connect(cursor_factory=psycopg2.extras.DictCursor)
+                    try:
+                        registered.append(insert_registration(cur, template['details_id'],
+                                                              template['debtor_reg_name_id'],
+                                                              '{}-03-01'.format(self.year), template['county_id']))
+                        complete(cur)
+                    except:
+                        rollback(cur)
+                        raise
+            except Exception as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=register) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
+        register_ids = [reg_id for reg_no, reg_id in registered]
+        cursor.execute("DELETE FROM search_index WHERE register_id = ANY(%(ids)s)", {'ids': register_ids})
+        cursor.execute("DELETE FROM register WHERE id = ANY(%(ids)s)", {'ids': register_ids})
+        cursor.execute("DELETE FROM registration_counter WHERE year = %(year)s", {'year': self.year})
+        complete(cursor)
+
+        assert errors == []
+        numbers = [reg_no for reg_no, reg_id in registered]
+        assert len(numbers) == 20
+        assert len(set(numbers)) == len(numbers)
@@ -0,0 +1,62 @@
+from unittest import mock
+from application.cache import LRUCache
+from application.data import get_additional_info, invalidate_additional_info, additional_info_cache
+
+
+details = {
+    'details_id': 12,
+    'registration': {'number': 1004, 'date': '2015-11-05'}
+}
+
+
+class TestCache:
+    def test_least_recently_used_evicted(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.hits == 2
+        assert cache.misses == 1
+
+    def test_discard_where(self):
+        cache = LRUCache(10)
+        cache.put('a', (1, 'x'))
+        cache.put('b', (2, 'y'))
+        cache.discard_where(lambda key, value: value[0] == 1)
+        assert len(cache) == 1
+        assert cache.get('b') == (2, 'y')
+
+    @mock.patch('application.data.compute_additional_info', return_value='AMENDED BY 1005')
+    @mock.patch('application.data.chain_version', return_value=(10, '2-14-1'))
+    def test_additional_info_cached_until_chain_changes(self, mock_version, mock_compute):
+        additional_info_cache.clear()
+        cursor = mock.Mock()
+        assert get_additional_info(cursor, details) == 'AMENDED BY 1005'
+        assert get_additional_info(cursor, details) == 'AMENDED BY 1005'
+        assert mock_compute.call_count == 1
+
+        mock_version.return_value = (10, '3-20-2')
+        get_additional_info(cursor, details)
+        assert mock_compute.call_count == 2
+
+    @mock.patch('application.data.compute_additional_info', return_value='')
+    @mock.patch('application.data.chain_version', return_value=(10, '2-14-1'))
+    @mock.patch('application.data.get_chain_id', return_value=10)
+    def test_invalidated_by_chain(self, mock_chain_id, mock_version, mock_compute):
+        additional_info_cache.clear()
+        cursor = mock.Mock()
+        get_additional_info(cursor, details)
+        invalidate_additional_info(cursor, 14)
+        get_additional_info(cursor, details)
+        assert mock_compute.call_count == 2
+
+    @mock.patch('application.data.compute_additional_info', return_value='')
+    @mock.patch('application.data.chain_version', return_value=None)
+    def test_not_cached_without_chain(self, mock_version, mock_compute):
+        additional_info_cache.clear()
+        get_additional_info(mock.Mock(), details)
+        get_additional_info(mock.Mock(), details)
+        assert mock_compute.call_count == 2
@@ -0,0 +1,76 @@
+from unittest import mock
+from application.chain import find_head, history_from_details, history_from_head, history_from_registration, \
+    link_chain
+import datetime
+import pytest
+
+
+def member(details_id, amends, number, amendment_type=None, sequence=1, is_start=False):
+    return {
+        'details_id': details_id, 'is_start': is_start, 'registration_no': number,
+        'date': datetime.date(2014, 5, 1), 'reg_sequence_no': sequence, 'expired_on': None,
+        'amendment_type': amendment_type, 'amends': amends, 'class_of_charge': 'PAB'
+    }
+
+
+def cursor_returning(rows):
+    return mock.Mock(**{'fetchall.return_value': rows})
+
+
+# 10 <- 14 (rectification) <- 20 (renewal); 14 also has a part cancellation pseudo-entry, 16
+def chain(start=10):
+    return [
+        member(10, None, 1000, is_start=start == 10),
+        member(14, 10, 1001, 'Rectification', is_start=start == 14),
+        member(14, 10, 1002, 'Rectification', sequence=2, is_start=start == 14),
+        member(16, 14, 1003, 'Part Cancellation', is_start=start == 16),
+        member(20, 14, 1004, 'Renewal', is_start=start == 20)
+    ]
+
+
+class TestChain:
+    def test_head_skips_part_cancellations(self):
+        cursor = cursor_returning(chain())
+        assert find_head(cursor, 1000, '2014-05-01') == 20
+        assert cursor.execute.call_count == 1
+
+    def test_head_following_part_cancellations_must_be_unambiguous(self):
+        with pytest.raises(RuntimeError):
+            find_head(cursor_returning(chain()), 1000, '2014-05-01', True)
+
+    def test_head_from_middle_of_chain(self):
+        assert find_head(cursor_returning(chain(14)), 1001, '2014-05-01') == 20
+
+    def test_unknown_registration(self):
+        with pytest.raises(RuntimeError):
+            find_head(cursor_returning([]), 1000, '2014-05-01')
+        assert history_from_registration(cursor_returning([]), 1000, '2014-05-01') == []
+
+    def test_history_back_to_origin(self):
+        history = history_from_details(cursor_returning(chain(16)), 16)
+        assert [entry['id'] for entry in history] == [16, 14, 10]
+        assert [reg['number'] for reg in history[1]['registrations']] == [1001, 1002]
+        assert history[0]['application'] == 'Part Cancellation'
+        assert history[2]['application'] == 'New Registration'
+
+    def test_history_from_head_single_query(self):
+        cursor = cursor_returning(chain())
+        history = history_from_head(cursor, 1000, '2014-05-01')
+        assert [entry['id'] for entry in history] == [20, 14, 10]
+        assert cursor.execute.call_count == 1
+
+    def test_history_with_missing_ancestor(self):
+        with pytest.raises(RuntimeError):
+            history_from_details(cursor_returning([member(14, 10, 1001, 'Rectification', is_start=True)]), 14)
+
+    def test_link_chain_rewrites_whole_chain(self):
+        cursor = mock.Mock(**{
+            'fetchall.return_value': [
+                {'chain_id': 10, 'id': 10, 'position': 0},
+                {'chain_id': 10, 'id': 14, 'position': 1}
+            ],
+            'mogrify.side_effect': lambda sql, params: (sql % params).encode('utf-8')
+        })
+        link_chain(cursor, 14)
+        assert cursor.execute.call_args_list[1][0][1] == {'ids': [10, 14]}
+        assert cursor.execute.call_args_list[2][0][0].endswith('VALUES (10, 10, 0),(10, 14, 1)')
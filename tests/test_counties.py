@@ -0,0 +1,94 @@
+from application.routes import app
+from application.counties import CountyReference, ReferenceCache
+from application.search_key import fetch_name_key
+from unittest import mock
+import json
+import pytest
+
+
+county_rows = [
+    {'id': 1, 'name': 'Devon', 'welsh_name': None},
+    {'id': 2, 'name': 'Gwynedd', 'welsh_name': 'Gwynedd'},
+    {'id': 3, 'name': 'Isle of Anglesey', 'welsh_name': 'Sir Ynys Mon'}
+]
+
+search_key_rows = [
+    {'name': 'DEVON', 'key': 'DEVON', 'county_council': True},
+    {'name': 'PLYMOUTH', 'key': 'PLYMOUTH', 'county_council': False},
+    {'name': 'YORK', 'key': 'YORK', 'county_council': True},
+    {'name': 'YORK', 'key': 'YORKSHIRE', 'county_council': True}
+]
+
+
+def reference():
+    return CountyReference(county_rows, search_key_rows)
+
+
+class TestCountyReference:
+    def test_lookups(self):
+        counties = reference()
+        assert counties.ids_by_name['ISLE OF ANGLESEY'] == 3
+        assert counties.english_by_welsh == {'GWYNEDD': 'GWYNEDD', 'SIR YNYS MON': 'ISLE OF ANGLESEY'}
+        assert counties.english_names('sir ynys mon') == ['Isle of Anglesey']
+        assert counties.welsh_names_of('isle of anglesey') == ['Sir Ynys Mon']
+
+    def test_ids_of_every_county_with_a_name(self):
+        counties = CountyReference(county_rows + [{'id': 4, 'name': 'DEVON', 'welsh_name': None}], [])
+        assert counties.ids_by_name['DEVON'] == 1
+        assert counties.ids_of(['DEVON', 'GWYNEDD', 'DEVON', 'NOWHERE']) == [1, 2, 4]
+        assert counties.ids_of([]) == []
+
+    def test_name_key_errors_kept(self):
+        with mock.patch('application.search_key.county_reference', return_value=reference()):
+            assert fetch_name_key(None, 'Devon') == 'DEVON'
+            with pytest.raises(RuntimeError):
+                fetch_name_key(None, 'York')
+            with pytest.raises(RuntimeError):
+                fetch_name_key(None, 'Nowhere')
+
+
+class TestReferenceCache:
+    def test_loads_once_within_ttl(self):
+        loader = mock.Mock(return_value='loaded')
+        cache = ReferenceCache('test', loader, 60)
+        assert cache.get('cursor') == 'loaded'
+        assert cache.get('cursor') == 'loaded'
+        assert loader.call_count == 1
+        assert (cache.hits, cache.misses) == (1, 1)
+
+    def test_reloads_when_invalidated_or_expired(self):
+        loader = mock.Mock(return_value='loaded')
+        cache = ReferenceCache('test', loader, 60)
+        cache.get('cursor')
+        cache.invalidate()
+        cache.get('cursor')
+        cache.ttl = 0
+        cache.get('cursor')
+        assert loader.call_count == 3
+
+
+class TestCountyRoutes:
+    def setup_method(self, method):
+        self.app = app.test_client()
+
+    @mock.patch('application.routes.complete')
+    @mock.patch('application.routes.connect')
+    @mock.patch('application.routes.county_reference', return_value=reference())
+    def test_counties_list(self, mock_reference, mock_connect, mock_complete):
+        response = self.app.get('/counties?welsh=yes')
+        assert json.loads(response.data.decode()) == ['Devon', 'Gwynedd', 'Isle of Anglesey', 'Sir Ynys Mon']
+
+    @mock.patch('application.routes.complete')
+    @mock.patch('application.routes.connect')
+    @mock.patch('application.routes.county_reference', return_value=reference())
+    def test_translated_county(self, mock_reference, mock_connect, mock_complete):
+        response = self.app.get('/county/Sir Ynys Mon')
+        assert json.loads(response.data.decode()) == ['Sir Ynys Mon', 'Isle of Anglesey']
+
+    @mock.patch('application.routes.complete')
+    @mock.patch('application.routes.connect')
+    @mock.patch('application.routes.county_reference', return_value=reference())
+    def test_county_council(self, mock_reference, mock_connect, mock_complete):
+        assert self.app.get('/county_council/devon').status_code == 200
+        assert self.app.get('/county_council/plymouth').status_code == 404
+        assert self.app.get('/county_council/york').status_code == 404
@@ -0,0 +1,126 @@
+from application.data import connect, complete, build_details, get_details_from_rows, \
+    get_registration_details_bulk, restrict_to_lead_county
+from tests.details_reference import get_details_from_rows_iterative, get_addl_class
+from unittest import mock
+import datetime
+import json
+import psycopg2
+import psycopg2.extras
+import pytest
+
+
+def lead_row(**kwargs):
+    row = {
+        'registration_no': 1004, 'date': datetime.date(2015, 11, 5), 'expired_on': None,
+        'class_of_charge': 'C1', 'id': 12, 'register_id': 40, 'legal_body_ref': None, 'cancelled_by': None,
+        'amends': None, 'request_id': 7, 'additional_info': None, 'district': 'Plymouth',
+        'short_description': 'A house', 'county_id': 3, 'debtor_reg_name_id': None, 'amendment_type': None,
+        'priority_notice_ind': False, 'prio_notice_expires': None, 'amend_info_type': None,
+        'amend_info_details': None, 'amend_info_details_orig': None, 'reg_sequence_no': 1,
+        'priority_notice_no': None
+    }
+    row.update(kwargs)
+    return row
+
+
+def related_row(**kwargs):
+    row = {
+        'register_id': 40, 'lead_county': 'Devon', 'counties': ['Devon', 'Cornwall'],
+        'amends_registration': None, 'has_amendment': False, 'amended_by': None, 'parties': [],
+        'applicant': None, 'is_migrated': False, 'original_regn_no': None, 'extra_data': None,
+        'addl_classes': None
+    }
+    row.update(kwargs)
+    return row
+
+
+def name_row(name_id, forename, surname):
+    return {
+        'id': name_id, 'forename': forename, 'middle_names': '', 'surname': surname, 'complex_number': None,
+        'complex_name': None, 'name_type_ind': 'Private Individual', 'company_name': None,
+        'local_authority_name': None, 'local_authority_area': None, 'other_name': None,
+        'searchable_string': forename + surname, 'subtype': None
+    }
+
+
+class TestBuildDetails:
+    def test_counties_lead_first_without_duplicates(self):
+        data = build_details([lead_row()], related_row())
+        assert data['particulars']['counties'] == ['Devon', 'Cornwall']
+        assert data['status'] == 'current'
+
+    def test_lead_debtor_name_first(self):
+        party = {
+            'id': 1, 'party_type': 'Debtor', 'occupation': None, 'date_of_birth': None,
+            'residence_withheld': False, 'addresses': None,
+            'names': [name_row(5, 'Bob', 'Howard'), name_row(6, 'Robert', 'Howard')]
+        }
+        data = build_details([lead_row(class_of_charge='PAB', debtor_reg_name_id=6)], related_row(parties=[party]))
+        assert 'particulars' not in data
+        assert data['parties'][0]['names'][0]['private']['forenames'] == ['Robert']
+        assert data['parties'][0]['addresses'] == []
+
+    def test_missing_amended_registration(self):
+        with pytest.raises(RuntimeError):
+            build_details([lead_row(amends=11)], related_row())
+
+    def test_superseded(self):
+        data = build_details([lead_row(cancelled_by=9)], related_row(has_amendment=True))
+        assert data['status'] == 'superseded'
+        assert 'cancellation' not in data
+
+    def test_additional_classes_only_for_first_sequence(self):
+        related = related_row(addl_classes=['C2', 'D1'])
+        assert build_details([lead_row()], related, with_addl_class=True)['additional_classes'] == ['C2', 'D1']
+        assert 'additional_classes' not in build_details([lead_row(reg_sequence_no=2)], related,
+                                                         with_addl_class=True)
+
+
+class TestDetailsBulk:
+    def test_bulk_loads_in_two_queries(self):
+        rows = [lead_row(), lead_row(register_id=41, id=13, registration_no=1005)]
+        related = [related_row(), related_row(register_id=41, counties=None)]
+        cursor = mock.Mock(**{'fetchall.side_effect': [rows, related]})
+
+        details = get_registration_details_bulk(cursor, [40, 41, 40])
+        assert cursor.execute.call_count == 2
+        assert details[40]['registration']['number'] == 1004
+        assert details[41]['particulars']['counties'] == ['Devon']
+
+    def test_bulk_nothing_to_load(self):
+        cursor = mock.Mock()
+        assert get_registration_details_bulk(cursor, []) == {}
+        assert not cursor.execute.called
+
+    def test_restrict_to_lead_county(self):
+        details = build_details([lead_row()], related_row())
+        restrict_to_lead_county(details)
+        assert details['particulars']['counties'] == ['Devon']
+
+
+class TestDetailsParity:
+    # Compares the single-query loader against the original per-relation one over whatever data the
+    # configured database holds.
+    def test_matches_iterative_loader(self):
+        try:
+            cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
+        except psycopg2.OperationalError:
+            pytest.skip('database not available')
+
+        try:
+            cursor.execute("SELECT r.registration_no, r.date, r.expired_on, rd.class_of_charge, rd.id, "
+                           "r.id as register_id, rd.legal_body_ref, rd.cancelled_by, rd.amends, rd.request_id, "
+                           "rd.additional_info, rd.district, rd.short_description, r.county_id, "
+                           "r.debtor_reg_name_id, rd.amendment_type, rd.priority_notice_ind, "
+                           "rd.prio_notice_expires, rd.amend_info_type, rd.amend_info_details, "
+                           "rd.amend_info_details_orig, r.reg_sequence_no, rd.priority_notice_no "
+                           "FROM register r, register_details rd WHERE r.details_id = rd.id "
+                           "ORDER BY r.id DESC FETCH FIRST 500 ROWS ONLY")
+            for row in cursor.fetchall():
+                for fetch_amend_detail in [False, True]:
+                    expected = get_details_from_rows_iterative(cursor, [row], fetch_amend_detail)
+                    get_addl_class(cursor, expected)
+                    actual = get_details_from_rows(cursor, [row], fetch_amend_detail, with_addl_class=True)
+                    assert json.dumps(actual) == json.dumps(expected)
+        finally:
+            complete(cursor)
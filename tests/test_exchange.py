@@ -0,0 +1,77 @@
+from application.exchange import ErrorPublisher
+from unittest import mock
+import kombu
+
+
+def read_all(queue_name):
+    with kombu.Connection('memory://') as connection:
+        simple_queue = connection.SimpleQueue(queue_name)
+        messages = []
+        while simple_queue.qsize() > 0:
+            message = simple_queue.get(block=False)
+            messages.append(message.payload)
+            message.ack()
+        simple_queue.close()
+    return messages
+
+
+class TestErrorPublisher:
+    def test_publishes_over_one_connection(self):
+        publisher = ErrorPublisher('memory://', queue_name='test_errors_one')
+        with mock.patch('kombu.Connection', wraps=kombu.Connection) as mock_connection:
+            for n in range(3):
+                publisher.publish({'type': 'E', 'message': str(n)})
+            publisher.flush()
+        publisher.stop()
+        assert mock_connection.call_count == 1
+        assert [m['message'] for m in read_all('test_errors_one')] == ['0', '1', '2']
+        assert publisher.published == 3
+
+    def test_reconnects_after_failure(self):
+        publisher = ErrorPublisher('memory://', queue_name='test_errors_retry', retry_seconds=0)
+        real_connection = kombu.Connection
+        attempts = []
+
+        def connection(*args, **kwargs):
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise ConnectionRefusedError('broker down')
+            return real_connection(*args, **kwargs)
+
+        with mock.patch('kombu.Connection', side_effect=connection):
+            publisher.publish({'type': 'E'})
+            publisher.flush()
+        publisher.stop()
+        assert len(attempts) == 2
+        assert read_all('test_errors_retry') == [{'type': 'E'}]
+
+    def test_stop_publishes_queued_errors(self):
+        publisher = ErrorPublisher('memory://', queue_name='test_errors_stop')
+        real_connection = kombu.Connection
+
+        def connection(*args, **kwargs):
+            # Hold the first attempt until stop() has begun, so every error is still queued when it does
+            assert publisher._stopping.wait(5)
+            return real_connection(*args, **kwargs)
+
+        with mock.patch('kombu.Connection', side_effect=connection):
+            for n in range(3):
+                publisher.publish({'type': 'E', 'message': str(n)})
+            publisher.stop()
+        assert publisher.published == 3
+        assert [m['message'] for m in read_all('test_errors_stop')] == ['0', '1', '2']
+
+    def test_stop_skips_retries(self):
+        publisher = ErrorPublisher('memory://', queue_name='test_errors_stop_down', retry_seconds=30)
+        publisher._stopping.set()
+        with mock.patch('kombu.Connection', side_effect=ConnectionRefusedError('broker down')) as mock_connection:
+            publisher._publish_with_retry({'type': 'E'})
+        assert mock_connection.call_count == 1
+        assert publisher.dropped == 1
+
+    def test_drops_when_buffer_full(self):
+        publisher = ErrorPublisher('memory://', queue_name='test_errors_full', max_pending=1)
+        with mock.patch.object(publisher, '_ensure_started'):
+            publisher.publish({'n': 1})
+            publisher.publish({'n': 2})
+        assert publisher.dropped == 1
@@ -0,0 +1,24 @@
+from application.data import group_by_request
+import datetime
+
+
+def reg_row(request_id, number, amends=None, amendment_type=None):
+    return {
+        'registration_no': number, 'date': datetime.date(2016, 3, 1), 'class_of_charge': 'C1', 'amends': amends,
+        'cancelled_by': None, 'request_id': request_id, 'amendment_type': amendment_type, 'register_id': number + 1
+    }
+
+
+class TestGrouping:
+    def test_rows_grouped_by_request_in_order(self):
+        rows = [reg_row(5, 1000), reg_row(5, 1001), reg_row(7, 1002, 3, 'Rectification'), reg_row(5, 1003)]
+        results = group_by_request(rows)
+        assert [item['id'] for item in results] == [5, 7]
+        assert [reg['number'] for reg in results[0]['data']] == [1000, 1001, 1003]
+        assert results[0]['application'] == 'new'
+        assert results[1]['application'] == 'Rectification'
+        assert 'register_id' not in results[0]['data'][0]
+
+    def test_register_ids_included(self):
+        results = group_by_request([reg_row(5, 1000)], with_register_id=True)
+        assert results[0]['data'][0]['register_id'] == 1001
@@ -0,0 +1,53 @@
+from application.routes import app
+from application.instrument import fingerprint, instrumented
+from application.logformat import start_request, repeated_queries
+from flask import g
+from unittest import mock
+
+
+class FakeCursor(object):
+    rowcount = 3
+
+    def execute(self, query, vars=None):
+        self.executed = (query, vars)
+
+
+class TestFingerprint:
+    def test_parameters_and_literals(self):
+        assert fingerprint("SELECT * FROM register  WHERE registration_no = %(reg_no)s AND\n date = '2016-01-01'") == \
+            "SELECT * FROM register WHERE registration_no = ? AND date = ?"
+
+    def test_values_lists_collapse(self):
+        two = fingerprint("INSERT INTO t (a, b) VALUES (1, 'x'),(2, 'y')")
+        three = fingerprint("INSERT INTO t (a, b) VALUES (1, 'x'),(2, 'y'), (3, 'it''s')")
+        assert two == three == "INSERT INTO t (a, b) VALUES (?)..."
+        assert fingerprint("SELECT 1 FROM t WHERE id IN (1, 2, 3)") == "SELECT ? FROM t WHERE id IN (?...)"
+
+
+class TestInstrumentedCursor:
+    def test_totals_per_request(self):
+        cursor = instrumented(FakeCursor)()
+        with app.test_request_context('/'):
+            start_request()
+            cursor.execute("SELECT * FROM party WHERE id = %s", (1,))
+            cursor.execute("SELECT * FROM party WHERE id = %s", (2,))
+            assert cursor.executed == ("SELECT * FROM party WHERE id = %s", (2,))
+            assert g.query_count == 2
+            assert g.rows_fetched == 6
+            assert repeated_queries() == [("SELECT * FROM party WHERE id = ?", 2, mock.ANY)]
+
+    def test_same_class_reused(self):
+        assert instrumented(FakeCursor) is instrumented(FakeCursor)
+
+    def test_slow_query_logged_without_values(self):
+        cursor = instrumented(FakeCursor)()
+        with app.test_request_context('/'), mock.patch.dict(app.config, {'SLOW_QUERY_MS': 0}), \
+                mock.patch('logging.warning') as mock_warning:
+            start_request()
+            cursor.execute("SELECT * FROM party_name WHERE forename = 'Bob'")
+        assert mock_warning.call_args[0][3] == "SELECT * FROM party_name WHERE forename = ?"
+
+    def test_query_count_header(self):
+        with mock.patch.dict(app.config, {'QUERY_COUNT_HEADER': True}):
+            response = app.test_client().get('/')
+        assert response.headers['X-LC-Query-Count'] == '0'
@@ -0,0 +1,44 @@
+from application.routes import app
+from application.logformat import format_message, start_request, record_query, request_summary, log_context
+from flask import Response, g
+from unittest import mock
+
+
+headers = {'X-Transaction-ID': 'abc123', 'X-LC-Username': 'bob'}
+
+
+class TestLogFormat:
+    def test_message_from_request_context(self):
+        with app.test_request_context('/', headers=headers):
+            start_request()
+            assert format_message('Hello') == 'T:abc123 U:bob Hello'
+            g.user = 'alice'
+            assert format_message('Hello') == 'T:abc123 U:alice Hello'
+
+    def test_message_without_headers(self):
+        with app.test_request_context('/'):
+            assert format_message('Hello') == ' U:? Hello'
+
+    def test_json_message_is_bare(self):
+        with app.test_request_context('/', headers=headers), \
+                mock.patch.dict(app.config, {'LOG_FORMAT': 'json'}):
+            start_request()
+            assert format_message('Hello') == 'Hello'
+            assert log_context() == {'transaction_id': 'abc123', 'user': 'bob'}
+
+    def test_request_summary(self):
+        with app.test_request_context('/registrations/2016-01-01', headers=headers):
+            app.preprocess_request()
+            record_query(0.002, 5)
+            record_query(0.003, -1)
+            summary = request_summary(Response(status=404))
+        assert summary['route'] == '/registrations/<date>'
+        assert summary['status'] == 404
+        assert summary['query_count'] == 2
+        assert summary['rows_fetched'] == 5
+        assert summary['db_time_ms'] == 5.0
+        assert summary['latency_ms'] >= 0
+
+    def test_no_context_outside_request(self):
+        record_query(0.1, 1)
+        assert log_context() is None
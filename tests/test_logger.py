@@ -0,0 +1,124 @@
+from unittest import mock
+from log.logger import record_factory, audit, BoundedQueueHandler, JsonFormatter
+import json
+import logging
+import sys
+
+
+class CaptureHandler(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def logging_function():
+    logging.debug('A debug message')
+
+
+def auditing_function():
+    audit('An audit message')
+
+
+class TestLogger:
+    def setup_method(self, method):
+        self.old_factory = logging.getLogRecordFactory()
+        logging.setLogRecordFactory(record_factory)
+        self.handler = CaptureHandler()
+        self.root = logging.getLogger()
+        self.old_level = self.root.level
+        self.root.addHandler(self.handler)
+        self.root.setLevel(logging.DEBUG)
+
+    def teardown_method(self, method):
+        self.root.removeHandler(self.handler)
+        self.root.setLevel(self.old_level)
+        logging.setLogRecordFactory(self.old_factory)
+
+    @mock.patch('inspect.stack', side_effect=AssertionError('inspect.stack called'))
+    def test_caller_recorded(self, mock_stack):
+        logging_function()
+        record = self.handler.records[-1]
+        assert record.method == 'logging_function'
+        assert record.file == __file__
+        assert record.line == logging_function.__code__.co_firstlineno + 1
+
+    def test_audit_caller_recorded(self):
+        auditing_function()
+        record = self.handler.records[-1]
+        assert record.levelno == 25
+        assert record.method == 'auditing_function'
+
+    def test_disabled_level_skips_factory(self):
+        self.root.setLevel(logging.INFO)
+        with mock.patch('log.logger.old_factory') as mock_factory:
+            logging_function()
+        assert not mock_factory.called
+
+
+class TestQueueHandler:
+    def setup_method(self, method):
+        self.target = CaptureHandler()
+        self.handler = BoundedQueueHandler(1, 0.01, [self.target])
+
+    def record(self, level, message):
+        return logging.LogRecord('test', level, __file__, 1, message, None, None)
+
+    def test_debug_dropped_when_full(self):
+        self.handler.handle(self.record(logging.DEBUG, 'first'))
+        self.handler.handle(self.record(logging.DEBUG, 'second'))
+        assert self.handler.dropped == 1
+        assert self.target.records == []
+
+    def test_audit_written_directly_when_full(self):
+        self.handler.handle(self.record(logging.DEBUG, 'first'))
+        self.handler.handle(self.record(25, 'audited'))
+        assert [r.getMessage() for r in self.target.records] == ['audited']
+        assert self.handler.dropped == 0
+
+    def test_stop_drains_queue(self):
+        self.handler.handle(self.record(logging.INFO, 'queued'))
+        self.handler.start()
+        self.handler.stop()
+        assert [r.getMessage() for r in self.target.records] == ['queued']
+
+    def test_restart_in_child_discards_parent_records(self):
+        self.handler.handle(self.record(logging.INFO, 'parent'))
+        self.handler.restart_in_child()
+        self.handler.handle(self.record(logging.INFO, 'child'))
+        self.handler.stop()
+        assert [r.getMessage() for r in self.target.records] == ['child']
+
+
+class TestJsonFormatter:
+    def test_fields_and_context(self):
+        record = logging.LogRecord('test', logging.INFO, __file__, 10, 'END %s', ('GET',), None)
+        record.appname = 'lc-land-charges'
+        record.file, record.line, record.method = __file__, 10, 'after_request'
+        record.context = {'transaction_id': 'abc123', 'user': 'bob'}
+        record.fields = {'status': 200, 'latency_ms': 12.5}
+        entry = json.loads(JsonFormatter().format(record))
+        assert entry['message'] == 'END GET'
+        assert entry['level'] == 'INFO'
+        assert entry['user'] == 'bob'
+        assert entry['latency_ms'] == 12.5
+        assert entry['method'] == 'after_request'
+
+    def test_exception_through_queue_handler(self):
+        # With LOG_ASYNC the formatter runs on the listener thread, after BoundedQueueHandler.prepare
+        target = CaptureHandler()
+        target.setFormatter(JsonFormatter())
+        handler = BoundedQueueHandler(10, 0.01, [target])
+        try:
+            raise ValueError('bad county')
+        except ValueError:
+            record = logging.LogRecord('test', logging.ERROR, __file__, 1, 'Failed %s', ('search',), sys.exc_info())
+        handler.start()
+        handler.handle(record)
+        handler.stop()
+        entry = json.loads(target.format(target.records[0]))
+        assert entry['message'] == 'Failed search'
+        assert 'ValueError: bad county' in entry['exception']
+        assert 'Traceback' not in entry['message']
@@ -0,0 +1,53 @@
+from application.routes import app
+from application.metrics import count_committed, update_pool_metrics, mark_worker_dead
+from prometheus_client import REGISTRY
+from unittest import mock
+import os
+
+
+class TestMetrics:
+    def test_request_latency_recorded(self):
+        labels = {'endpoint': 'index', 'method': 'GET', 'status': '200'}
+        before = REGISTRY.get_sample_value('lc_request_latency_seconds_count', labels) or 0
+        client = app.test_client()
+        client.get('/')
+        response = client.get('/metrics')
+        assert response.status_code == 200
+        assert response.mimetype == 'text/plain'
+        assert REGISTRY.get_sample_value('lc_request_latency_seconds_count', labels) == before + 1
+        assert b'lc_request_latency_seconds_bucket' in response.data
+
+    def test_committed_counters(self):
+        before = REGISTRY.get_sample_value('lc_entries_committed_total', {'application': 'renewal'}) or 0
+        count_committed('renewal', 3)
+        assert REGISTRY.get_sample_value('lc_entries_committed_total', {'application': 'renewal'}) == before + 3
+
+    def test_pool_gauges(self):
+        update_pool_metrics({'in_use': 2, 'idle': 1, 'max_size': 10, 'checkouts': 40, 'waits': 3, 'timeouts': 0,
+                             'wait_time': 0.25})
+        assert REGISTRY.get_sample_value('lc_db_pool_connections', {'state': 'in_use'}) == 2
+        update_pool_metrics(None)
+
+    def test_pool_counters(self):
+        def checkouts():
+            return REGISTRY.get_sample_value('lc_db_pool_events_total', {'event': 'checkouts'}) or 0
+
+        def stats(count, wait_time):
+            return {'in_use': 0, 'idle': 1, 'max_size': 10, 'checkouts': count, 'waits': 0, 'timeouts': 0,
+                    'wait_time': wait_time}
+
+        with mock.patch('application.metrics._pool_totals', {}):
+            before, waited = checkouts(), REGISTRY.get_sample_value('lc_db_pool_wait_seconds_total') or 0
+            update_pool_metrics(stats(40, 0.25))
+            update_pool_metrics(stats(45, 0.5))
+            assert checkouts() == before + 45
+            assert REGISTRY.get_sample_value('lc_db_pool_wait_seconds_total') == waited + 0.5
+            # A replacement pool's totals start again from zero
+            update_pool_metrics(stats(2, 0.0))
+            assert checkouts() == before + 47
+
+    def test_single_process_mode(self):
+        with mock.patch.dict(os.environ, clear=True), \
+                mock.patch('prometheus_client.multiprocess.mark_process_dead') as mock_dead:
+            mark_worker_dead(123)
+        assert not mock_dead.called
@@ -0,0 +1,83 @@
+from application.exchange import publish_new_bankruptcy, relay_batch, OUTBOX_RELAY_LOCK
+from application.data import REGISTER_SEQUENCE_LOCK
+from unittest import mock
+import json
+import kombu
+import pytest
+
+
+def outbox_cursor(rows, locked=True):
+    return mock.Mock(**{'fetchone.return_value': {'locked': locked}, 'fetchall.return_value': rows})
+
+
+def event(event_id, application, data):
+    return {'id': event_id, 'application': application, 'payload': data}
+
+
+class TestOutbox:
+    def setup_method(self, method):
+        self.connection = kombu.Connection('memory://')
+        exchange = kombu.Exchange(type="topic", name="new.bankruptcy")
+        self.queue = kombu.Queue('test_outbox', exchange=exchange, routing_key='simple')
+        self.queue(self.connection.channel()).declare()
+        self.producer = kombu.Producer(self.connection.channel(), exchange=exchange, routing_key='simple',
+                                       serializer='json')
+
+    def teardown_method(self, method):
+        self.queue(self.connection.channel()).purge()
+        self.connection.release()
+
+    def received(self):
+        messages = []
+        with self.connection.Consumer(self.queue, callbacks=[lambda body, message: messages.append(
+                (body, message.headers))], accept=['json']):
+            while True:
+                try:
+                    self.connection.drain_events(timeout=0.1)
+                except Exception:
+                    return messages
+
+    def test_event_written_in_callers_transaction(self):
+        cursor = mock.Mock()
+        with mock.patch('application.exchange.record_events', True):
+            publish_new_bankruptcy(cursor, [{'number': 1000, 'date': '2016-01-01'}])
+        sql, params = cursor.execute.call_args[0]
+        assert sql.startswith('INSERT INTO event_outbox')
+        assert params['application'] == 'new'
+        assert json.loads(params['payload']) == [{'number': 1000, 'date': '2016-01-01'}]
+
+    def test_no_event_without_relay(self):
+        # Nothing would ever publish or delete it
+        cursor = mock.Mock()
+        with mock.patch('application.exchange.record_events', False):
+            publish_new_bankruptcy(cursor, [{'number': 1000, 'date': '2016-01-01'}])
+        assert not cursor.execute.called
+
+    def test_relay_publishes_in_order_and_marks(self):
+        cursor = outbox_cursor([event(5, 'new', [1000]), event(6, 'cancel', [1000])])
+        assert relay_batch(cursor, self.producer, 100) == 2
+        assert cursor.execute.call_args[0][1] == {'ids': [5, 6]}
+        assert self.received() == [
+            ({'application': 'new', 'data': [1000]}, mock.ANY),
+            ({'application': 'cancel', 'data': [1000]}, mock.ANY)
+        ]
+
+    def test_event_id_header(self):
+        relay_batch(outbox_cursor([event(7, 'amend', {})]), self.producer, 100)
+        assert self.received()[0][1]['event_id'] == 7
+
+    def test_relay_without_lock_does_nothing(self):
+        cursor = outbox_cursor([event(5, 'new', [1000])], locked=False)
+        assert relay_batch(cursor, self.producer, 100) == 0
+        assert cursor.execute.call_count == 1
+        assert self.received() == []
+
+    def test_partial_failure_marks_only_published(self):
+        producer = mock.Mock(**{'publish.side_effect': [None, ConnectionError('broker gone')]})
+        cursor = outbox_cursor([event(5, 'new', [1000]), event(6, 'new', [1001])])
+        with pytest.raises(ConnectionError):
+            relay_batch(cursor, producer, 100)
+        assert cursor.execute.call_args[0][1] == {'ids': [5]}
+
+    def test_lock_classes_distinct(self):
+        assert OUTBOX_RELAY_LOCK != REGISTER_SEQUENCE_LOCK
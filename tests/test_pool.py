@@ -0,0 +1,86 @@
+from unittest import mock
+from application.pool import ConnectionPool, PoolTimeout
+import psycopg2.extensions
+import time
+
+
+def mock_connection():
+    return mock.Mock(**{
+        'closed': False,
+        'get_transaction_status.return_value': psycopg2.extensions.TRANSACTION_STATUS_IDLE
+    })
+
+
+class TestPool:
+    @mock.patch('psycopg2.connect')
+    def test_connections_are_reused(self, mock_connect):
+        mock_connect.side_effect = lambda dsn: mock_connection()
+        pool = ConnectionPool('dsn', max_size=2)
+
+        first = pool.checkout()
+        pool.release(first)
+        second = pool.checkout()
+
+        assert first is second
+        assert mock_connect.call_count == 1
+        assert pool.stats()['checkouts'] == 2
+
+    @mock.patch('psycopg2.connect')
+    def test_max_size_times_out(self, mock_connect):
+        mock_connect.side_effect = lambda dsn: mock_connection()
+        pool = ConnectionPool('dsn', max_size=1, timeout=0.05)
+        pool.checkout()
+        try:
+            pool.checkout()
+            assert False
+        except PoolTimeout:
+            pass
+        assert pool.stats()['timeouts'] == 1
+
+    @mock.patch('psycopg2.connect')
+    def test_checkout_with_shorter_timeout(self, mock_connect):
+        mock_connect.side_effect = lambda dsn: mock_connection()
+        pool = ConnectionPool('dsn', max_size=1, timeout=30)
+        pool.checkout()
+        start = time.time()
+        try:
+            pool.checkout(0.05)
+            assert False
+        except PoolTimeout:
+            pass
+        assert time.time() - start < 1
+
+    @mock.patch('psycopg2.connect')
+    def test_closed_connection_replaced_on_checkout(self, mock_connect):
+        mock_connect.side_effect = lambda dsn: mock_connection()
+        pool = ConnectionPool('dsn', max_size=1)
+        first = pool.checkout()
+        pool.release(first)
+        first.closed = True
+
+        second = pool.checkout()
+        assert second is not first
+        assert pool.stats()['discarded'] == 1
+
+    @mock.patch('psycopg2.connect')
+    def test_idle_connections_reaped(self, mock_connect):
+        mock_connect.side_effect = lambda dsn: mock_connection()
+        pool = ConnectionPool('dsn', min_size=1, max_size=3, idle_timeout=0)
+        conns = [pool.checkout() for _ in range(3)]
+        for conn in conns:
+            pool.release(conn)
+        time.sleep(0.01)
+
+        pool.checkout()
+        stats = pool.stats()
+        assert stats['reaped'] == 2
+        assert stats['size'] == 1
+
+    @mock.patch('psycopg2.connect')
+    def test_open_transaction_rolled_back_on_release(self, mock_connect):
+        conn = mock_connection()
+        conn.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+        mock_connect.return_value = conn
+        pool = ConnectionPool('dsn')
+        pool.release(pool.checkout())
+        assert conn.rollback.called
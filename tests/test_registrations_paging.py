@@ -0,0 +1,65 @@
+from unittest import mock
+from application.routes import app
+from application.data import all_registrations_query
+import datetime
+import json
+
+
+def page_rows(count):
+    return [{
+        'register_id': 50 + i, 'registration_no': 1000 + i, 'date': datetime.date(2016, 3, 1), 'class_of_charge': 'C1'
+    } for i in range(count)]
+
+
+def summaries(count):
+    return ({
+        'number': 1000 + i, 'date': '2016-03-01', 'class': 'C1', 'uri': '2016-03-01/' + str(1000 + i)
+    } for i in range(count))
+
+
+class TestRegistrationsPaging:
+    def setup_method(self, method):
+        self.app = app.test_client()
+
+    def test_keyset_query(self):
+        sql, params = all_registrations_query(('2016-03-01', 1004, 53), 10)
+        assert '(r.date, r.registration_no, r.id) > ' in sql
+        assert params == {'date': '2016-03-01', 'no': 1004, 'id': 53, 'limit': 10}
+
+        sql, params = all_registrations_query(('2016-03-01', 1004))
+        assert '(r.date, r.registration_no) > ' in sql
+        assert 'limit' not in sql
+
+    @mock.patch('application.routes.complete')
+    @mock.patch('application.routes.connect')
+    def test_full_page_has_next_link(self, mock_connect, mock_complete):
+        mock_connect.return_value = mock.Mock(**{'fetchall.return_value': page_rows(2)})
+        response = self.app.get('/registrations?limit=2&after=2016-02-29/17')
+        assert response.status_code == 200
+        assert len(json.loads(response.data.decode())) == 2
+        assert 'after=2016-03-01%2F1001%2F51' in response.headers['Link']
+
+    @mock.patch('application.routes.complete')
+    @mock.patch('application.routes.connect')
+    def test_last_page_has_no_link(self, mock_connect, mock_complete):
+        mock_connect.return_value = mock.Mock(**{'fetchall.return_value': page_rows(1)})
+        response = self.app.get('/registrations?limit=2')
+        assert 'Link' not in response.headers
+
+    def test_bad_parameters(self):
+        assert self.app.get('/registrations?after=yesterday').status_code == 400
+        assert self.app.get('/registrations?limit=0').status_code == 400
+        assert self.app.get('/registrations?stream=xml').status_code == 400
+
+    @mock.patch('application.routes.iter_all_registrations', side_effect=lambda *args: summaries(3))
+    def test_stream_json(self, mock_iter):
+        response = self.app.get('/registrations?stream=json')
+        assert [item['number'] for item in json.loads(response.data.decode())] == [1000, 1001, 1002]
+
+    @mock.patch('application.routes.iter_all_registrations', side_effect=lambda *args: summaries(3))
+    def test_stream_ndjson(self, mock_iter):
+        response = self.app.get('/registrations?stream=ndjson')
+        lines = response.data.decode().splitlines()
+        assert len(lines) == 3
+        assert json.loads(lines[2])['number'] == 1002
+        assert response.mimetype == 'application/x-ndjson'
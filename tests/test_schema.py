@@ -0,0 +1,46 @@
+from application.schema import validate_registration, validate_update, validate, SEARCH_SCHEMA
+from unittest import mock
+import copy
+import json
+import os
+
+
+directory = os.path.dirname(__file__)
+valid_data = json.loads(open(os.path.join(directory, 'data/valid_data.json'), 'r').read())
+valid_data['applicant']['address_type'] = 'RM'  # the fixture predates address_type
+
+
+class TestSchema:
+    @mock.patch('application.schema.Draft4Validator')
+    def test_validators_built_at_import(self, mock_validator):
+        assert validate_registration(valid_data) == []
+        assert not mock_validator.called
+
+    def test_schema_error_locations(self):
+        data = copy.deepcopy(valid_data)
+        data['parties'][0]['names'][0]['type'] = 'Nobody'
+        errors = validate_registration(data)
+        assert len(errors) > 0
+        assert all(error['location'].startswith('$.parties[0].names[0]') for error in errors)
+
+    def test_party_errors_before_name_errors(self):
+        data = copy.deepcopy(valid_data)
+        data['class_of_charge'] = 'C1'
+        data['particulars'] = {'counties': ['Devon'], 'district': 'Plymouth', 'description': 'A house'}
+        del data['parties'][0]['names'][0]['private']
+        data['parties'][0]['names'][0]['company'] = 'Bob Ltd'
+        errors = validate_registration(data)
+        messages = [error['error_message'] for error in errors]
+        assert messages[0] == "Party of type 'Debtor' not allowed for land charge"
+        assert messages[-1] == "Attribute 'private' required for private individual"
+
+    def test_update_requires_update_type_fields(self):
+        data = copy.deepcopy(valid_data)
+        data['update_registration'] = {'type': 'Part Cancellation'}
+        assert validate_update(data) == [
+            {'error_message': "Part cancellation requires plan_attached or part_cancelled"}
+        ]
+
+    def test_generic_validate_valid_is_none(self):
+        assert validate({}, SEARCH_SCHEMA)[0]['location'] == '$.'
+        assert validate({'type': 'object'}, {'type': 'object'}) is None
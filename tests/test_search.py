@@ -0,0 +1,311 @@
+from application.data import connect, rollback
+from application.search import perform_search, perform_batched_search, batched_search_sql, merge_lists, \
+    distinct_results, result_id, split_items, perform_parallel_search, search_in_snapshot, get_search_executor
+from application.pool import PoolTimeout
+from application import app
+from application.search_index import rebuild_search_index
+from tests.search_reference import reference_matches
+from unittest import mock
+from hypothesis import given, strategies
+import collections
+import datetime
+import time
+import psycopg2
+import psycopg2.extras
+import pytest
+
+
+def mogrify(template, params):
+    return repr(params).encode('utf-8')
+
+
+def search_cursor(rows):
+    return mock.Mock(**{'fetchall.return_value': rows, 'mogrify.side_effect': mogrify})
+
+
+def distinct(ids):
+    return list(collections.OrderedDict.fromkeys(ids))
+
+
+def item(name_id, name_type='Private Individual', **name):
+    return {'name_id': name_id, 'name_type': name_type, 'name': name, 'year_from': 1925, 'year_to': 2016}
+
+
+class TestBatchedSearch:
+    @mock.patch('application.search.create_search_keys', side_effect=lambda cursor, name_type, name: ['KEY'])
+    @mock.patch('application.search.load_county_dictionary', return_value={})
+    def test_one_query_results_per_item(self, mock_welsh, mock_keys):
+        cursor = search_cursor([
+            {'ord': 0, 'part': 0, 'id': 12}, {'ord': 0, 'part': 0, 'id': 12},
+            {'ord': 2, 'part': 0, 'id': 30}, {'ord': 2, 'part': 1, 'id': 30}, {'ord': 2, 'part': 1, 'id': 31}
+        ])
+        parameters = {'search_type': 'full', 'counties': [], 'search_items': [
+            item(5), item(6), item(7, 'Complex Name', complex_name='KING', complex_number=1001)
+        ]}
+        results = perform_search(cursor, parameters, '2016-05-01')
+        assert cursor.execute.call_count == 1
+        assert results == [
+            {'name_result': [12, 12], 'name_id': 5},
+            {'name_result': [], 'name_id': 6},
+            {'name_result': [30, 31], 'name_id': 7}
+        ]
+        assert parameters['counties'] == ['ALL']
+
+    @mock.patch('application.search.county_ids', return_value=[1, 4])
+    def test_query_shape_follows_search_type(self, mock_ids):
+        cursor = search_cursor([])
+        items = [(['KEY'], 'Private Individual', None, 1925, 2016)]
+        perform_batched_search(cursor, 'banks', True, ['ALL'], items, '2016-05-01')
+        assert "s.name_type_ind = i.name_type" in cursor.execute.call_args[0][0]
+        assert not mock_ids.called
+        perform_batched_search(cursor, 'full', False, ['DEVON'], items, '2016-05-01')
+        sql, params = cursor.execute.call_args[0]
+        assert "dcr.county_id = ANY(%(county_ids)s)" in sql
+        assert "JOIN county" not in sql
+        assert params['county_ids'] == [1, 4]
+        assert "['Private Individual', 'Other']" in sql
+        mock_ids.assert_called_once_with(cursor, ['DEVON'])
+
+    @mock.patch('application.search.county_ids', return_value=[1])
+    def test_reads_search_index_only(self, mock_ids):
+        cursor = search_cursor([])
+        items = [(['KEY'], 'Complex Name', 1001, 1925, 2016)]
+        for search_type, all_counties in [('banks', True), ('full', True), ('full', False)]:
+            perform_batched_search(cursor, search_type, all_counties, ['DEVON'], items, '2016-05-01')
+            sql = cursor.execute.call_args[0][0]
+            assert sql.count('FROM search_index s') == 2
+            assert 'register_details' not in sql
+            assert 'JOIN county' not in sql
+            perform_batched_search(cursor, search_type, all_counties, ['DEVON'], items, '2016-05-01',
+                                   reference_matches(search_type, all_counties))
+            assert 'search_index' not in cursor.execute.call_args[0][0]
+
+    def test_literal_percent_escaped(self):
+        cursor = search_cursor([])
+        perform_batched_search(cursor, 'banks', True, ['ALL'], [(['100%'], 'Other', None, None, None)], '2016-05-01')
+        assert "100%%" in cursor.execute.call_args[0][0]
+
+    def test_no_items(self):
+        cursor = search_cursor([])
+        assert perform_batched_search(cursor, 'banks', True, ['ALL'], [], '2016-05-01') == []
+        assert not cursor.execute.called
+
+
+# Results as the per-item searches return them: one register's date and class are always the same
+result_ids = strategies.lists(strategies.integers(min_value=1, max_value=40))
+
+
+def as_results(ids):
+    return [{'id': i, 'date': datetime.date(2000 + i % 10, 1, 1), 'class': 'PAB' if i % 2 else 'C1'} for i in ids]
+
+
+class TestMergeLists:
+    # Against the original merge: a + [x for x in b if x not in a]
+    @given(result_ids, result_ids)
+    def test_merge_matches_original(self, a, b):
+        assert merge_lists(a, b) == a + [x for x in b if x not in a]
+        a, b = as_results(a), as_results(b)
+        assert merge_lists(a, b) == a + [x for x in b if x not in a]
+
+    @given(result_ids)
+    def test_distinct_results(self, ids):
+        # As get_search_details uses it, against the sorted(set(...)) it replaced
+        unique = sorted(distinct_results(ids), key=result_id)
+        assert unique == sorted(set(ids))
+        assert sorted(distinct_results(as_results(ids)), key=result_id) == as_results(sorted(set(ids)))
+
+    def test_inputs_untouched(self):
+        a, b = [3, 1, 3], [2, 1, 2]
+        assert merge_lists(a, b) == [3, 1, 3, 2, 2]
+        assert a == [3, 1, 3] and b == [2, 1, 2]
+
+
+def chunk_results(snapshot, checkout_timeout, search_type, all_counties, counties, items, cert_date):
+    # Stands in for search_in_snapshot: later chunks finish first
+    time.sleep(0.05 / (1 + items[0][2]))
+    return [[number] for keys, name_type, number, year_from, year_to in items]
+
+
+class TestParallelSearch:
+    items = [(['KEY'], 'Complex Name', number, 1925, 2016) for number in range(10)]
+
+    @given(strategies.lists(strategies.integers()), strategies.integers(min_value=1, max_value=8))
+    def test_split_items(self, items, chunk_count):
+        chunks = split_items(items, chunk_count)
+        assert [x for chunk in chunks for x in chunk] == items
+        assert len(chunks) == min(len(items), chunk_count)
+        assert all(len(chunk) > 0 for chunk in chunks)
+        assert max(len(c) for c in chunks or [[]]) - min(len(c) for c in chunks or [[]]) <= 1
+
+    @mock.patch('application.search.search_in_snapshot', side_effect=chunk_results)
+    def test_results_in_request_order(self, mock_chunk):
+        cursor = mock.Mock(**{'fetchone.return_value': {'snapshot': '00000003-0000001B-1'}})
+        results = perform_parallel_search(cursor, 'full', True, ['ALL'], self.items, '2016-05-01', 4, 0.5)
+        assert results == [[number] for number in range(10)]
+        assert mock_chunk.call_count == 4
+        assert all(call[0][0] == '00000003-0000001B-1' for call in mock_chunk.call_args_list)
+        assert 'pg_export_snapshot' in cursor.execute.call_args[0][0]
+
+    @mock.patch('application.search.perform_batched_search', return_value=['sequential'])
+    @mock.patch('application.search.search_in_snapshot', side_effect=[[[0]] * 5, PoolTimeout('busy')])
+    def test_falls_back_to_one_query(self, mock_chunk, mock_batched):
+        cursor = mock.Mock(**{'fetchone.return_value': {'snapshot': 'S'}})
+        assert perform_parallel_search(cursor, 'banks', True, ['ALL'], self.items, '2016-05-01', 2, 0.5) == \
+            ['sequential']
+        mock_batched.assert_called_once_with(cursor, 'banks', True, ['ALL'], self.items, '2016-05-01')
+
+    @mock.patch('application.search.search_in_snapshot')
+    @mock.patch('application.search.perform_batched_search', return_value=[[1]])
+    def test_single_chunk_runs_on_callers_cursor(self, mock_batched, mock_chunk):
+        cursor = mock.Mock()
+        assert perform_parallel_search(cursor, 'banks', True, ['ALL'], self.items[:1], '2016-05-01', 4, 0.5) == \
+            [[1]]
+        assert not mock_chunk.called
+        assert not cursor.execute.called
+
+    @mock.patch('application.search.perform_batched_search', side_effect=psycopg2.OperationalError('gone'))
+    @mock.patch('application.search.get_pool')
+    def test_chunk_imports_snapshot_and_releases(self, mock_pool, mock_batched):
+        connection = mock_pool.return_value.checkout.return_value
+        with pytest.raises(psycopg2.OperationalError):
+            search_in_snapshot('S', 0.5, 'banks', True, ['ALL'], self.items, '2016-05-01')
+        mock_pool.return_value.checkout.assert_called_once_with(0.5)
+        statements = [call[0][0] for call in connection.cursor.return_value.execute.call_args_list]
+        assert statements == ["SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY",
+                              "SET TRANSACTION SNAPSHOT %(snapshot)s"]
+        mock_pool.return_value.release.assert_called_once_with(connection)
+
+    @mock.patch('application.search.perform_batched_search', return_value=['sequential'])
+    @mock.patch('application.search.search_in_snapshot')
+    def test_falls_back_when_workers_busy(self, mock_chunk, mock_batched):
+        executor, slots = get_search_executor(4)
+        for _ in range(3):
+            slots.acquire()
+        try:
+            cursor = mock.Mock()
+            assert perform_parallel_search(cursor, 'banks', True, ['ALL'], self.items, '2016-05-01', 4, 0.5) == \
+                ['sequential']
+            assert not mock_chunk.called
+            assert not cursor.execute.called
+        finally:
+            for _ in range(3):
+                slots.release()
+        # The one free slot was handed back
+        assert slots.acquire(blocking=False)
+        slots.release()
+
+    @mock.patch('application.search.search_in_snapshot', side_effect=chunk_results)
+    def test_splits_over_free_workers(self, mock_chunk):
+        executor, slots = get_search_executor(4)
+        slots.acquire()
+        try:
+            cursor = mock.Mock(**{'fetchone.return_value': {'snapshot': 'S'}})
+            results = perform_parallel_search(cursor, 'full', True, ['ALL'], self.items, '2016-05-01', 4, 0.5)
+        finally:
+            slots.release()
+        assert results == [[number] for number in range(10)]
+        assert mock_chunk.call_count == 3
+        # Every chunk's slot is free again (released by a done callback, which may trail the result slightly)
+        assert all(slots.acquire(timeout=1) for _ in range(4))
+        for _ in range(4):
+            slots.release()
+
+    def test_executor_follows_worker_setting(self):
+        executor, slots = get_search_executor(4)
+        assert get_search_executor(4) == (executor, slots)
+        resized, resized_slots = get_search_executor(2)
+        assert resized is not executor
+        assert resized._max_workers == 2
+        get_search_executor(4)
+
+    @mock.patch('application.search.create_search_keys', return_value=['KEY'])
+    @mock.patch('application.search.load_county_dictionary', return_value={})
+    @mock.patch('application.search.perform_parallel_search', return_value=[[1]] * 10)
+    @mock.patch('application.search.perform_batched_search', return_value=[[1]] * 10)
+    def test_opt_in(self, mock_batched, mock_parallel, mock_welsh, mock_keys):
+        parameters = {'search_type': 'banks', 'counties': [], 'search_items': [item(n) for n in range(10)]}
+        perform_search(mock.Mock(), parameters, '2016-05-01')
+        assert mock_batched.called and not mock_parallel.called
+        with mock.patch.dict(app.config, {'SEARCH_PARALLEL': True, 'SEARCH_PARALLEL_MIN_ITEMS': 10}):
+            perform_search(mock.Mock(), parameters, '2016-05-01')
+            assert mock_parallel.call_count == 1
+        with mock.patch.dict(app.config, {'SEARCH_PARALLEL': True, 'SEARCH_PARALLEL_MIN_ITEMS': 11}):
+            perform_search(mock.Mock(), parameters, '2016-05-01')
+            assert mock_parallel.call_count == 1
+
+
+class TestSearchIndexParity:
+    # Runs the batched search against search_index and against the register tables it is projected from,
+    # over names the configured database holds. The index is rebuilt inside the test's transaction. The join
+    # queries repeat an entry for each of its counties on the county-restricted search; only the first of
+    # each is compared.
+    def test_matches_join_queries(self):
+        try:
+            cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
+        except psycopg2.OperationalError:
+            pytest.skip('database not available')
+
+        try:
+            rebuild_search_index(cursor)
+            cursor.execute("SELECT searchable_string, name_type_ind, complex_number FROM party_name "
+                           "WHERE searchable_string IS NOT NULL ORDER BY id DESC FETCH FIRST 50 ROWS ONLY")
+            items = [([row['searchable_string']], row['name_type_ind'], row['complex_number'], 1900, 2100)
+                     for row in cursor.fetchall()]
+            counties = ['DEVON', 'CORNWALL']
+            for date in [datetime.date.today(), datetime.date(2010, 1, 1)]:
+                for search_type, all_counties in [('banks', True), ('full', True), ('full', False)]:
+                    index = perform_batched_search(cursor, search_type, all_counties, counties, items, date)
+                    joins = perform_batched_search(cursor, search_type, all_counties, counties, items, date,
+                                                   reference_matches(search_type, all_counties))
+                    assert [distinct(ids) for ids in index] == [distinct(ids) for ids in joins]
+        finally:
+            rollback(cursor)
+
+
+class TestCountySearchPlan:
+    # The county-restricted search should reach search_index and detl_county_rel through their indexes. Seq
+    # scans are switched off so a near-empty database doesn't favour them; what's checked is that nothing
+    # forces one.
+    def test_county_search_uses_indexes(self):
+        try:
+            cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
+        except psycopg2.OperationalError:
+            pytest.skip('database not available')
+
+        try:
+            cursor.execute("SET LOCAL enable_seqscan = off")
+            items = [(['SMITHJOHN'], 'Private Individual', None, 1925, 2016),
+                     (['KING'], 'Complex Name', 1001, 1925, 2016)]
+            sql = batched_search_sql(cursor, 'full', False, items)
+            cursor.execute("EXPLAIN " + sql, {'date': datetime.date.today(), 'exdate': datetime.date.today(),
+                                              'county_ids': [1, 2]})
+            plan = "\n".join(row[0] for row in cursor.fetchall())
+            assert 'search_index_name_ix' in plan
+            assert 'search_index_number_ix' in plan
+            assert 'detl_county_details' in plan
+            assert 'Seq Scan on search_index' not in plan
+            assert 'Seq Scan on detl_county_rel' not in plan
+        finally:
+            rollback(cursor)
+
+
+class TestParallelSearchParity:
+    # Runs a search over names the configured database holds both as one query and split over connections
+    def test_matches_sequential(self):
+        try:
+            cursor = connect(cursor_factory=psycopg2.extras.DictCursor)
+        except psycopg2.OperationalError:
+            pytest.skip('database not available')
+
+        try:
+            cursor.execute("SELECT searchable_string, name_type_ind, complex_number FROM party_name "
+                           "WHERE searchable_string IS NOT NULL ORDER BY id DESC FETCH FIRST 50 ROWS ONLY")
+            items = [([row['searchable_string']], row['name_type_ind'], row['complex_number'], 1900, 2100)
+                     for row in cursor.fetchall()]
+            date = datetime.date.today()
+            for search_type, all_counties in [('banks', True), ('full', True), ('full', False)]:
+                sequential = perform_batched_search(cursor, search_type, all_counties, ['DEVON'], items, date)
+                parallel = perform_parallel_search(cursor, search_type, all_counties, ['DEVON'], items, date, 3, 5)
+                assert parallel == sequential
+        finally:
+            rollback(cursor)
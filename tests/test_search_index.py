@@ -0,0 +1,42 @@
+from unittest import mock
+from application.data import insert_registration, mark_as_no_reveal, mark_as_no_reveal_by_details, \
+    mark_as_no_reveal_by_id
+from application.search_index import refresh_search_index, rebuild_search_index
+
+
+class TestSearchIndexMaintenance:
+    def test_new_register_row_projected(self):
+        cursor = mock.Mock(**{
+            'fetchone.side_effect': [{'reg': 1042}, [77]],
+            'fetchall.return_value': [{'seq_no': None}]
+        })
+        insert_registration(cursor, 5, 6, '2016-03-01', 3)
+        delete, insert = cursor.execute.call_args_list[-2:]
+        assert delete[0] == ("DELETE FROM search_index WHERE register_id = ANY(%(ids)s)", {'ids': [77]})
+        assert insert[0][0].startswith('INSERT INTO search_index')
+        assert insert[0][1] == {'ids': [77]}
+
+    def test_expiry_copied_across(self):
+        for mark, args, params in [
+            (mark_as_no_reveal, (1004, '2016-03-01'), {'regno': 1004, 'date': '2016-03-01'}),
+            (mark_as_no_reveal_by_details, (12,), {'did': 12}),
+            (mark_as_no_reveal_by_id, (40,), {'id': 40})
+        ]:
+            cursor = mock.Mock()
+            mark(cursor, *args)
+            sql, actual = cursor.execute.call_args[0]
+            assert sql.startswith('UPDATE search_index s SET expired_on = r.expired_on FROM register r')
+            assert actual == params
+
+    def test_rebuild(self):
+        cursor = mock.Mock(rowcount=120)
+        assert rebuild_search_index(cursor) == 120
+        assert cursor.execute.call_args_list[0][0][0] == 'TRUNCATE search_index'
+        assert 'WHERE' not in cursor.execute.call_args[0][0].split('FROM')[-1]
+
+    def test_refresh_matches_rebuild(self):
+        # Both project through the same SELECT; a refresh only narrows it
+        refresh, rebuild = mock.Mock(), mock.Mock()
+        refresh_search_index(refresh, [1, 2])
+        rebuild_search_index(rebuild)
+        assert refresh.execute.call_args[0][0].startswith(rebuild.execute.call_args[0][0])
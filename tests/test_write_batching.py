@@ -0,0 +1,68 @@
+from unittest import mock
+from application.data import insert_details, insert_counties
+import itertools
+
+
+def person(forename):
+    return {'type': 'Private Individual', 'private': {'forenames': [forename], 'surname': 'Howard'}}
+
+
+def registration(name_count, address_count):
+    return {
+        'class_of_charge': 'PAB',
+        'parties': [{
+            'type': 'Debtor', 'residence_withheld': False, 'case_reference': '1 of 2016',
+            'names': [person('Bob{}'.format(i)) for i in range(name_count)],
+            'addresses': [{
+                'type': 'Debtor Residence', 'address_lines': ['{} High St'.format(i), 'Plymouth'],
+                'county': 'Devon', 'postcode': 'PL1 1AA'
+            } for i in range(address_count)]
+        }]
+    }
+
+
+def write_cursor():
+    ids = itertools.count(100)
+
+    def fetchall():
+        return [[next(ids)] for _ in range(cursor.allocating)]
+
+    def execute(sql, params=None):
+        cursor.allocating = params['count'] if params and 'count' in params else 0
+
+    cursor = mock.Mock(**{
+        'fetchone.return_value': [7],
+        'fetchall.side_effect': fetchall,
+        'execute.side_effect': execute,
+        'mogrify.side_effect': lambda template, row: repr(row).encode('utf-8')
+    })
+    return cursor
+
+
+class TestWriteBatching:
+    @mock.patch('application.data.link_chain')
+    def test_statements_independent_of_row_count(self, mock_link):
+        small = write_cursor()
+        insert_details(small, 1, registration(1, 1), '2016-03-01', None)
+        large = write_cursor()
+        insert_details(large, 1, registration(5, 4), '2016-03-01', None)
+        assert small.execute.call_count == large.execute.call_count
+
+    @mock.patch('application.data.link_chain')
+    def test_names_returned_in_order_with_ids(self, mock_link):
+        data = registration(3, 2)
+        names, details_id = insert_details(write_cursor(), 1, data, '2016-03-01', None)
+        assert details_id == 7
+        assert [name['name']['private']['forenames'][0] for name in names] == ['Bob0', 'Bob1', 'Bob2']
+        assert len(set(name['id'] for name in names)) == 3
+        assert len(set(address['id'] for address in data['parties'][0]['addresses'])) == 2
+
+    @mock.patch('application.data.county_reference')
+    def test_counties_keep_order(self, mock_reference):
+        mock_reference.return_value.ids_by_name = {'DEVON': 4, 'CORNWALL': 9}
+        cursor = mock.Mock(**{
+            'mogrify.side_effect': lambda template, row: repr(row).encode('utf-8')
+        })
+        counties = insert_counties(cursor, 12, ['Cornwall', 'Devon'])
+        assert counties == [{'id': 9, 'name': 'Cornwall'}, {'id': 4, 'name': 'Devon'}]
+        assert cursor.execute.call_count == 1